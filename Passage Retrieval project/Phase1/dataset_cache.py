@@ -0,0 +1,257 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+'''
+Columnar cache of the TSV datasets (candidate-passages-top1000.tsv,
+validation_data.tsv, train_data.tsv...)
+    - each TSV is parsed once, in chunks, into a directory next to it
+      (<name>_cache/) that is rebuilt when the TSV changes:
+        meta.json:              format version, source size and mtime, number
+                                of rows and names of the source columns
+        qids.npy, pids.npy:     int64 qid and pid of each row, in file order
+        relevancy.npy:          float64 relevancy of each row (if present)
+        group_qids.npy:         sorted unique qids
+        group_rows.npy:         int64 row numbers grouped by qid (file order
+                                inside a group)
+        group_pids.npy:         int64 pids of the rows of group_rows
+        group_offsets.npy:      int64 array of length no_qids + 1, the rows
+                                of the qid group_qids[g] are
+                                [group_offsets[g], group_offsets[g + 1]) of
+                                group_rows and group_pids
+        <text>_keys.npy, <text>_starts.npy, <text>_ends.npy, <text>.bin:
+                                query texts by qid and passage texts by pid,
+                                stored once each: sorted keys and the byte
+                                range of their UTF-8 text in <text>.bin
+    - all arrays are memory mapped, so scripts only read the columns they
+      use; the candidates of a query are a slice of group_pids
+'''
+DATASET_FORMAT = 1
+CHUNK_SIZE = 100000
+# Columns holding the qid, pid, query text, passage text and relevancy,
+# with the names they have in the coursework files
+COLUMN_NAMES = {'qid': 'qid', 'pid': 'pid', 'query': 'query', 'queries': 'query',
+                'passage': 'passage', 'relevancy': 'relevancy'}
+# Text columns and the key they are stored by
+TEXT_KEYS = {'query': 'qid', 'passage': 'pid'}
+
+
+def get_dataset_cache_path(path):
+    return os.path.splitext(path)[0] + '_cache'
+
+
+def get_source_info(path):
+    stat = os.stat(path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def is_cache_valid(path, cache_path):
+    meta_path = os.path.join(cache_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta.get('format') == DATASET_FORMAT and all(meta.get(name) == value for name, value in get_source_info(path).items())
+
+
+class TextWriter:
+    # Appends the texts of keys not seen yet to <name>.bin
+    def __init__(self, cache_path, name):
+        self.cache_path = cache_path
+        self.name = name
+        self.file = open(os.path.join(cache_path, name + '.bin'), 'wb')
+        self.seen = set()
+        self.keys = []
+        self.starts = []
+        self.ends = []
+        self.position = 0
+
+    def add(self, keys, texts):
+        for key, text in zip(keys, texts):
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            data = str(text).encode('utf-8')
+            self.file.write(data)
+            self.keys.append(key)
+            self.starts.append(self.position)
+            self.position += len(data)
+            self.ends.append(self.position)
+
+    def close(self):
+        self.file.close()
+        keys = np.asarray(self.keys, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        np.save(os.path.join(self.cache_path, self.name + '_keys.npy'), keys[order])
+        np.save(os.path.join(self.cache_path, self.name + '_starts.npy'), np.asarray(self.starts, dtype=np.int64)[order])
+        np.save(os.path.join(self.cache_path, self.name + '_ends.npy'), np.asarray(self.ends, dtype=np.int64)[order])
+
+
+def build_dataset_cache(path, cache_path, chunk_size=CHUNK_SIZE, **read_csv_args):
+    # Built in a temporary directory, then moved in place
+    build_path = '%s.%s.tmp' % (cache_path, os.getpid())
+    if os.path.exists(build_path):
+        shutil.rmtree(build_path)
+    os.makedirs(build_path)
+    source_info = get_source_info(path)
+    qids, pids, relevancies = [], [], []
+    text_writers = {}
+    source_columns = None
+    for chunk in pd.read_csv(path, sep='\t', chunksize=chunk_size, **read_csv_args):
+        if source_columns is None:
+            source_columns = [str(column) for column in chunk.columns]
+            columns = {COLUMN_NAMES[column]: column for column in source_columns if column in COLUMN_NAMES}
+            if 'qid' not in columns or 'pid' not in columns:
+                raise Exception('The dataset %s has no qid or pid column!' % path)
+            text_writers = {name: TextWriter(build_path, name) for name in TEXT_KEYS if name in columns}
+        chunk_qids = chunk[columns['qid']].to_numpy(dtype=np.int64)
+        chunk_pids = chunk[columns['pid']].to_numpy(dtype=np.int64)
+        qids.append(chunk_qids)
+        pids.append(chunk_pids)
+        if 'relevancy' in columns:
+            relevancies.append(chunk[columns['relevancy']].to_numpy(dtype=np.float64))
+        for name, text_writer in text_writers.items():
+            keys = chunk_qids if TEXT_KEYS[name] == 'qid' else chunk_pids
+            text_writer.add(keys.tolist(), chunk[columns[name]].fillna('').tolist())
+    for text_writer in text_writers.values():
+        text_writer.close()
+
+    qids = np.concatenate(qids) if qids else np.empty(0, dtype=np.int64)
+    pids = np.concatenate(pids) if pids else np.empty(0, dtype=np.int64)
+    np.save(os.path.join(build_path, 'qids.npy'), qids)
+    np.save(os.path.join(build_path, 'pids.npy'), pids)
+    if relevancies:
+        np.save(os.path.join(build_path, 'relevancy.npy'), np.concatenate(relevancies))
+
+    # Rows grouped by qid (sorted, as groupby('qid') does), file order inside a group
+    group_rows = np.argsort(qids, kind='stable')
+    sorted_qids = qids[group_rows]
+    group_starts = np.flatnonzero(np.r_[True, sorted_qids[1:] != sorted_qids[:-1]]) if len(qids) else np.empty(0, dtype=np.int64)
+    np.save(os.path.join(build_path, 'group_qids.npy'), sorted_qids[group_starts])
+    np.save(os.path.join(build_path, 'group_offsets.npy'), np.r_[group_starts, len(qids)].astype(np.int64))
+    np.save(os.path.join(build_path, 'group_rows.npy'), group_rows.astype(np.int64))
+    np.save(os.path.join(build_path, 'group_pids.npy'), pids[group_rows])
+
+    meta = dict(source_info, format=DATASET_FORMAT, source=os.path.basename(path), no_rows=len(qids),
+                columns=source_columns, texts=list(text_writers))
+    with open(os.path.join(build_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(build_path, cache_path)
+
+
+def load_dataset(path, cache_path=None, **read_csv_args):
+    # Dataset of a TSV file, its cache is built on first use; read_csv_args
+    # (header, names...) describe the layout of the TSV
+    cache_path = cache_path or get_dataset_cache_path(path)
+    if not is_cache_valid(path, cache_path):
+        build_dataset_cache(path, cache_path, **read_csv_args)
+    return Dataset(cache_path)
+
+
+class Dataset:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != DATASET_FORMAT:
+            raise Exception('Unsupported dataset cache format, rebuild the cache!')
+        self.qids = self.load_array('qids')
+        self.pids = self.load_array('pids')
+        self.relevancy = self.load_array('relevancy') if os.path.exists(os.path.join(path, 'relevancy.npy')) else None
+        self.group_qids = np.load(os.path.join(path, 'group_qids.npy'))
+        self.group_offsets = np.load(os.path.join(path, 'group_offsets.npy'))
+        self.group_rows = self.load_array('group_rows')
+        self.group_pids = self.load_array('group_pids')
+        self.texts = {}
+
+    def __reduce__(self):
+        # Workers reopen the memory maps
+        return (Dataset, (self.path,))
+
+    def __len__(self):
+        return len(self.qids)
+
+    def load_array(self, name):
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def get_groups(self, qids):
+        # Positions of qids in group_qids
+        qids = np.asarray(qids, dtype=np.int64)
+        groups = np.searchsorted(self.group_qids, qids)
+        if np.any(groups >= len(self.group_qids)) or np.any(self.group_qids[np.minimum(groups, len(self.group_qids) - 1)] != qids):
+            raise Exception('Some queries are not part of the dataset!')
+        return groups
+
+    def get_candidates(self, qid):
+        group = self.get_groups([qid])[0]
+        return self.group_pids[self.group_offsets[group]:self.group_offsets[group + 1]]
+
+    def get_candidates_lists(self, qids=None):
+        # Candidate pids of each query (all queries, by qid, by default), as
+        # memory mapped slices
+        groups = np.arange(len(self.group_qids)) if qids is None else self.get_groups(qids)
+        return [self.group_pids[self.group_offsets[group]:self.group_offsets[group + 1]] for group in groups.tolist()]
+
+    def get_text_column(self, name):
+        if name not in self.texts:
+            if name not in self.meta['texts']:
+                raise Exception('The dataset has no %s text!' % name)
+            data_path = os.path.join(self.path, name + '.bin')
+            data = np.memmap(data_path, dtype=np.uint8, mode='r') if os.path.getsize(data_path) else np.empty(0, dtype=np.uint8)
+            self.texts[name] = (self.load_array(name + '_keys'), self.load_array(name + '_starts'),
+                                self.load_array(name + '_ends'), data)
+        return self.texts[name]
+
+    def get_texts(self, name, keys):
+        # Texts of the queries (by qid) or passages (by pid) of the dataset
+        text_keys, starts, ends, data = self.get_text_column(name)
+        keys = np.asarray(keys, dtype=np.int64)
+        positions = np.searchsorted(text_keys, keys)
+        if np.any(positions >= len(text_keys)) or np.any(text_keys[np.minimum(positions, len(text_keys) - 1)] != keys):
+            raise Exception('Some %s texts are not part of the dataset!' % name)
+        return [bytes(data[start:end]).decode('utf-8')
+                for start, end in zip(starts[positions].tolist(), ends[positions].tolist())]
+
+    def get_queries(self, qids=None):
+        qids = self.group_qids if qids is None else qids
+        return self.get_texts('query', qids)
+
+    def get_passages(self, pids):
+        return self.get_texts('passage', pids)
+
+    def passage_blocks(self, block_size):
+        # Stream [pid, passage] pairs in blocks, each passage once (pid order)
+        pids = self.get_text_column('passage')[0]
+        for start in range(0, len(pids), block_size):
+            block_pids = np.asarray(pids[start:start + block_size])
+            yield [list(pair) for pair in zip(block_pids.tolist(), self.get_passages(block_pids))]
+
+    def to_frame(self, columns=('qid', 'pid')):
+        # Rows of the dataset in file order, with only the columns asked for;
+        # query texts may be asked as 'query' or 'queries'
+        data = {}
+        for column in columns:
+            name = COLUMN_NAMES.get(column)
+            if name in ('qid', 'pid'):
+                data[column] = np.asarray(self.qids if name == 'qid' else self.pids)
+            elif name == 'relevancy':
+                if self.relevancy is None:
+                    raise Exception('The dataset has no relevancy!')
+                data[column] = np.asarray(self.relevancy)
+            elif name in TEXT_KEYS:
+                keys = self.qids if TEXT_KEYS[name] == 'qid' else self.pids
+                unique_keys, inverse = np.unique(np.asarray(keys), return_inverse=True)
+                data[column] = np.asarray(self.get_texts(name, unique_keys), dtype=object)[inverse]
+            else:
+                raise Exception('Unknown dataset column: %s' % column)
+        return pd.DataFrame(data)
+
+    def get_queries_frame(self):
+        # One row per query, in order of first appearance: qid, query and its candidates
+        qids = np.asarray(self.group_qids)[np.argsort(self.group_rows[self.group_offsets[:-1]], kind='stable')]
+        return pd.DataFrame({'qid': qids, 'query': self.get_queries(qids), 'candidates': self.get_candidates_lists(qids)})
@@ -0,0 +1,68 @@
+import hashlib
+import heapq
+import numpy as np
+
+
+'''
+Bounded-memory term frequency summary (space-saving heavy hitters)
+    - at most capacity terms are kept with an estimated count; a new term
+      enters with the smallest kept count as its error, so estimates never
+      underestimate and overestimate by at most min_count
+    - summaries are merged with exact per-chunk counters: terms missing from
+      the summary are counted from min_count and only the capacity best
+      estimates are kept, which is the mergeable space-saving update
+    - the total number of tokens is exact and the number of distinct terms is
+      estimated with a HyperLogLog sketch, both are needed by the Zipf plot
+'''
+HLL_PRECISION = 14
+
+
+class SpaceSavingSummary:
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.counts = {}
+        self.min_count = 0
+        self.total = 0
+        self.registers = np.zeros(1 << HLL_PRECISION, dtype=np.uint8)
+
+    def update(self, term_frequency):
+        # Merge an exact Counter of a chunk of passages
+        self.total += sum(term_frequency.values())
+        self.add_distinct_terms(term_frequency)
+        counts = self.counts
+        for term, count in term_frequency.items():
+            counts[term] = counts.get(term, self.min_count) + count
+        if len(counts) > self.capacity:
+            kept = heapq.nlargest(self.capacity + 1, counts.items(), key=lambda item: item[1])
+            # Counts of evicted terms are bounded by the best evicted count
+            self.min_count = kept.pop()[1]
+            self.counts = dict(kept)
+
+    def add_distinct_terms(self, terms):
+        hashes = np.fromiter((int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+                              for term in terms), dtype=np.uint64, count=len(terms))
+        no_rest_bits = 64 - HLL_PRECISION
+        buckets = (hashes >> np.uint64(no_rest_bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << no_rest_bits) - 1)
+        # Position of the leftmost 1 bit of the rest, float64 holds the 50 bits exactly
+        bit_lengths = np.frexp(rest.astype(np.float64))[1]
+        np.maximum.at(self.registers, buckets, (no_rest_bits - bit_lengths + 1).astype(np.uint8))
+
+    def no_distinct_terms(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        no_empty = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and no_empty:
+            # Linear counting for small cardinalities
+            estimate = m * np.log(m / no_empty)
+        return max(int(round(estimate)), len(self.counts))
+
+    def most_common(self, n=None):
+        items = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return items if n is None else items[:n]
+
+    def values(self):
+        return self.counts.values()
+
+    def __len__(self):
+        return len(self.counts)
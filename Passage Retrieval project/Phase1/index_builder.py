@@ -0,0 +1,233 @@
+import concurrent.futures
+import os
+import shutil
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from functools import partial
+import numpy as np
+import pandas as pd
+from task1 import get_passages_vocabularies
+from inverted_index import InvertedIndex, write_inverted_index, save_index_arrays, get_passage_fingerprint, close_inverted_index
+from instrumentation import stage, count, timed_iter, instrumented, merge_task_result
+
+
+'''
+Single-pass in-memory (SPIMI) index construction
+    - workers invert blocks of passages and flush a sorted on-disk segment
+      every time their in-memory postings reach the memory budget
+    - the segments are merged by term ranges in parallel (k-way merge of the
+      sorted term dictionaries) and the parts are concatenated into the index
+'''
+# Approximate size in bytes of one posting held in a {term: {pid: tf}} dict
+POSTING_SIZE = 120
+
+
+def read_passage_blocks(filename, block_size, pid_column='pid', passage_column='passage', **read_csv_args):
+    # Stream (pid, passage) pairs in blocks, skipping passages already seen
+    seen_pids = set()
+    block = []
+    for chunk in pd.read_csv(filename, sep='\t', chunksize=block_size, **read_csv_args):
+        for pid, passage in zip(chunk[pid_column].tolist(), chunk[passage_column].tolist()):
+            if pid in seen_pids:
+                continue
+            seen_pids.add(pid)
+            block.append([pid, passage])
+            if len(block) == block_size:
+                yield block
+                block = []
+    if block:
+        yield block
+
+
+def get_block_vocabularies(remove_stopwords, passages_info, batch_size):
+    # Tokenize the block in nlp.pipe batches
+    for i in range(0, len(passages_info), batch_size):
+        batch = passages_info[i:i + batch_size]
+        vocabularies = get_passages_vocabularies(remove_stopwords, [passage for _, passage in batch], batch_size=batch_size)
+        yield from zip([pid for pid, _ in batch], [passage for _, passage in batch], vocabularies)
+
+
+def invert_block(remove_stopwords, segments_dir, memory_budget, batch_size, block_info):
+    block_no, passages_info = block_info
+    segment_paths = []
+    block_index = defaultdict(dict)
+    block_pids = []
+    block_hashes = []
+    no_postings = 0
+    for pid, passage, passage_vocabulary in get_block_vocabularies(remove_stopwords, passages_info, batch_size):
+        passage_voc = Counter(passage_vocabulary)
+        for term, tf in passage_voc.items():
+            block_index[term][pid] = tf
+        block_pids.append(pid)
+        block_hashes.append(get_passage_fingerprint(passage))
+        no_postings += len(passage_voc)
+        # Flush a segment when the memory budget is reached
+        if no_postings * POSTING_SIZE >= memory_budget:
+            segment_paths.append(flush_segment(segments_dir, block_no, len(segment_paths), block_index, block_pids, block_hashes, remove_stopwords))
+            block_index = defaultdict(dict)
+            block_pids = []
+            block_hashes = []
+            no_postings = 0
+    if block_pids:
+        segment_paths.append(flush_segment(segments_dir, block_no, len(segment_paths), block_index, block_pids, block_hashes, remove_stopwords))
+    return segment_paths
+
+
+def flush_segment(segments_dir, block_no, segment_no, block_index, block_pids, block_hashes, remove_stopwords):
+    segment_path = os.path.join(segments_dir, f'segment_{block_no:06d}_{segment_no:03d}')
+    write_inverted_index(segment_path, block_index, remove_stopwords, doc_pids=block_pids, doc_hashes=block_hashes)
+    return segment_path
+
+
+def merge_segments_part(segment_paths, global_docids_paths, part_path, terms):
+    # Concatenate the posting lists of every segment for the terms of this part
+    term_ids = {term: term_id for term_id, term in enumerate(terms)}
+    terms_docids = [[] for _ in terms]
+    terms_tfs = [[] for _ in terms]
+    for segment_path, global_docids_path in zip(segment_paths, global_docids_paths):
+        segment = InvertedIndex(segment_path)
+        # Segment docids to docids of the merged index, -1 for deleted passages
+        global_docids = np.load(global_docids_path, mmap_mode='r')
+        lo = bisect_left(segment.terms, terms[0])
+        hi = bisect_right(segment.terms, terms[-1])
+        for segment_term_id in range(lo, hi):
+            term_id = term_ids[segment.terms[segment_term_id]]
+            segment_docids, segment_tfs = segment.compressed_postings.postings(segment_term_id)
+            docids = global_docids[segment_docids]
+            terms_docids[term_id].append(docids[docids >= 0])
+            terms_tfs[term_id].append(segment_tfs[docids >= 0])
+
+    # Keep postings sorted by docid
+    counts = np.zeros(len(terms), dtype=np.int64)
+    for term_id in range(len(terms)):
+        if len(terms_docids[term_id]) > 1:
+            docids = np.concatenate(terms_docids[term_id])
+            order = np.argsort(docids, kind='stable')
+            terms_docids[term_id] = [docids[order]]
+            terms_tfs[term_id] = [np.concatenate(terms_tfs[term_id])[order]]
+        counts[term_id] = sum(len(docids) for docids in terms_docids[term_id])
+
+    no_postings = int(counts.sum())
+    np.save(part_path + '_docids.npy', np.concatenate([docids for term_docids in terms_docids for docids in term_docids]).astype(np.int32) if no_postings else np.empty(0, dtype=np.int32))
+    np.save(part_path + '_tfs.npy', np.concatenate([tfs for term_tfs in terms_tfs for tfs in term_tfs]).astype(np.int32) if no_postings else np.empty(0, dtype=np.int32))
+    return counts
+
+
+def split_terms_in_parts(dfs, no_parts):
+    # Cut the sorted vocabulary in ranges with roughly the same number of postings
+    terms = sorted(dfs)
+    if not terms:
+        return []
+    cumulative_postings = np.cumsum([dfs[term] for term in terms])
+    bounds = np.searchsorted(cumulative_postings, np.linspace(0, cumulative_postings[-1], no_parts + 1)[1:-1])
+    bounds = [0] + sorted(set(bounds.tolist()) - {0}) + [len(terms)]
+    return [terms[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+def merge_segments(segment_paths, index_path, remove_stopwords, max_workers, segments_live=None):
+    # segments_live optionally masks the passages of each segment that are kept
+    # (by local docid), the postings of the other passages are dropped
+    if segments_live is None:
+        segments_live = [None] * len(segment_paths)
+
+    # Global document frequencies, used to balance the merge parts
+    dfs = Counter()
+    segments_doc_pids = []
+    segments_doc_hashes = []
+    for segment_path, live in zip(segment_paths, segments_live):
+        segment = InvertedIndex(segment_path)
+        dfs.update(dict(zip(segment.terms, segment.dfs().tolist())))
+        live = np.ones(len(segment.doc_pids), dtype=bool) if live is None else live
+        segments_doc_pids.append(np.where(live, segment.doc_pids, -1))
+        segments_doc_hashes.append(np.asarray(segment.doc_hashes))
+    terms_parts = split_terms_in_parts(dfs, max_workers * 4)
+
+    # Docids of the merged index follow the pid order of all live passages
+    os.makedirs(index_path, exist_ok=True)
+    parts_dir = os.path.join(index_path, 'parts')
+    os.makedirs(parts_dir, exist_ok=True)
+    live_doc_pids = [segment_doc_pids[segment_doc_pids >= 0] for segment_doc_pids in segments_doc_pids]
+    doc_pids = np.unique(np.concatenate(live_doc_pids)) if live_doc_pids else np.empty(0, dtype=np.int32)
+    doc_hashes = np.zeros(len(doc_pids), dtype=np.uint64)
+    global_docids_paths = []
+    for segment_no, (segment_doc_pids, segment_doc_hashes) in enumerate(zip(segments_doc_pids, segments_doc_hashes)):
+        global_docids = np.where(segment_doc_pids >= 0, np.searchsorted(doc_pids, segment_doc_pids), -1).astype(np.int32)
+        doc_hashes[global_docids[global_docids >= 0]] = segment_doc_hashes[global_docids >= 0]
+        global_docids_paths.append(os.path.join(parts_dir, f'global_docids_{segment_no:06d}.npy'))
+        np.save(global_docids_paths[-1], global_docids)
+
+    # Merge the term ranges in parallel
+    part_paths = [os.path.join(parts_dir, f'part_{part_no:04d}') for part_no in range(len(terms_parts))]
+    merge_part = instrumented(partial(merge_segments_part, segment_paths, global_docids_paths), 'merge part')
+    with stage('merge parts'), concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parts_counts = [merge_task_result(task_result) for task_result in executor.map(merge_part, part_paths, terms_parts)]
+
+    # Concatenate the parts into uncompressed posting arrays, terms of deleted
+    # passages only are dropped
+    terms = [term for terms_part in terms_parts for term in terms_part]
+    counts = np.concatenate(parts_counts) if parts_counts else np.empty(0, dtype=np.int64)
+    terms = [term for term, count in zip(terms, counts.tolist()) if count > 0]
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts[counts > 0])
+    docids = np.lib.format.open_memmap(os.path.join(parts_dir, 'docids.npy'), mode='w+', dtype=np.int32, shape=(int(offsets[-1]),))
+    tfs = np.lib.format.open_memmap(os.path.join(parts_dir, 'tfs.npy'), mode='w+', dtype=np.int32, shape=(int(offsets[-1]),))
+    position = 0
+    for part_path in part_paths:
+        part_docids = np.load(part_path + '_docids.npy', mmap_mode='r')
+        docids[position:position + len(part_docids)] = part_docids
+        tfs[position:position + len(part_docids)] = np.load(part_path + '_tfs.npy', mmap_mode='r')
+        position += len(part_docids)
+    docids.flush()
+    tfs.flush()
+
+    # Compress the postings, passage and collection statistics are computed
+    # once the postings are merged
+    with stage('compress postings'):
+        save_index_arrays(index_path, terms, offsets, docids, tfs, doc_pids, remove_stopwords, doc_hashes)
+    del docids, tfs
+    shutil.rmtree(parts_dir)
+
+
+def invert_blocks(blocks_info, segments_dir, remove_stopwords, memory_budget, max_workers, batch_size):
+    # (block_no, [pid, passage] pairs) blocks are inverted by a pool of
+    # workers into segments of segments_dir, returns their sorted paths
+    invert_block_partial = instrumented(partial(invert_block, remove_stopwords, segments_dir, memory_budget * 1024 * 1024, batch_size), 'invert block')
+    segment_paths = []
+    with stage('invert blocks'), concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # Keep a bounded number of blocks in flight
+        pending = set()
+        for block_info in blocks_info:
+            count('passages', len(block_info[1]))
+            if len(pending) >= 2 * max_workers:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                segment_paths.extend(path for future in done for path in merge_task_result(future.result()))
+            pending.add(executor.submit(invert_block_partial, block_info))
+        for future in concurrent.futures.as_completed(pending):
+            segment_paths.extend(merge_task_result(future.result()))
+    return sorted(segment_paths)
+
+
+def build_inverted_index(passages_blocks, index_path, remove_stopwords, memory_budget=256, max_workers=12, batch_size=1000):
+    # Memory budget is given in MB for each worker
+    # The index is built in a temporary directory, then moved in place, so an
+    # interrupted build never leaves a partial index at index_path
+    segments_dir = index_path + '_segments'
+    build_path = index_path + '_building'
+    for path in (segments_dir, build_path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    os.makedirs(segments_dir)
+
+    # Invert blocks of passages into sorted segments
+    segment_paths = invert_blocks(enumerate(timed_iter('read passages', passages_blocks)), segments_dir, remove_stopwords,
+                                  memory_budget, max_workers, batch_size)
+    count('segments', len(segment_paths))
+
+    # Merge segments into the final index
+    with stage('merge segments'):
+        merge_segments(segment_paths, build_path, remove_stopwords, max_workers)
+        shutil.rmtree(segments_dir)
+    if os.path.exists(index_path):
+        shutil.rmtree(index_path)
+    os.rename(build_path, index_path)
+    close_inverted_index(index_path)
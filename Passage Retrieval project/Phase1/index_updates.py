@@ -0,0 +1,244 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+from index_builder import invert_blocks, merge_segments
+from instrumentation import stage, count, timed_iter
+from inverted_index import (MANIFEST_FILE, SEGMENTS_DIR, SegmentedInvertedIndex, InvertedIndex,
+                            close_inverted_index, get_passage_fingerprint)
+
+
+'''
+Incremental index updates
+    - new and changed passages are split in blocks tokenized by a pool of
+      workers, as in a full build, and written as the segments of a new
+      generation (segments/<generation>/segment_<block>_<n>), changed and
+      deleted passages get a tombstone; both are recorded in the segments.json manifest, each update
+      with a new generation
+    - readers open the base index, its segments and tombstones as a
+      SegmentedInvertedIndex, so document frequencies, collection statistics
+      and the average passage length include the update right away
+    - segments are merged into a new base index in a background process once
+      there are max_segments of them; updates made during the merge are kept.
+      The process is spawned, not forked, so the merge pool it starts never
+      forks from a process with other threads or open SQLite connections
+    - writers of an index are serialised with a lock file next to it
+    - a merge is built in <index>_merged and swapped with the index by two
+      renames; the index stays complete until the swap, and a swap
+      interrupted between its renames is finished by recover_index, which
+      also removes the leftovers of interrupted merges
+'''
+MAX_SEGMENTS = 8
+
+
+@contextmanager
+def index_lock(index_path, blocking=True):
+    # Yields False when the lock is held elsewhere and blocking is False
+    with open(os.path.abspath(index_path) + '.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_manifest(index_path):
+    manifest_path = os.path.join(index_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        with open(os.path.join(index_path, 'meta.json')) as f:
+            generation = json.load(f).get('generation', 0)
+        return {'generation': generation, 'base_generation': generation, 'segments': [], 'tombstones': []}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(index_path, manifest):
+    # Replace the manifest atomically, readers see the old or the new one
+    manifest_path = os.path.join(index_path, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    close_inverted_index(index_path)
+
+
+def restore_index(index_path):
+    # Call with the index lock held and no merge running
+    index_path = os.path.abspath(index_path)
+    merged_path = index_path + '_merged'
+    old_path = index_path + '_old'
+    if not os.path.exists(index_path):
+        # The merged index is complete once the old index has been moved away
+        if os.path.exists(merged_path):
+            os.rename(merged_path, index_path)
+        elif os.path.exists(old_path):
+            os.rename(old_path, index_path)
+        close_inverted_index(index_path)
+    for path in (merged_path, old_path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+
+def recover_index(index_path):
+    # Repair the index after an interrupted merge, unless a merge is running
+    with index_lock(index_path + '.merge', blocking=False) as locked:
+        if locked:
+            with index_lock(index_path):
+                restore_index(index_path)
+
+
+def open_index_for_update(index_path):
+    if os.path.exists(os.path.join(index_path, MANIFEST_FILE)):
+        return SegmentedInvertedIndex(index_path)
+    return InvertedIndex(index_path)
+
+
+def get_changed_passages(index, passages):
+    # Passages whose pid is not indexed or whose text changed
+    if not passages:
+        return []
+    pids = np.array([pid for pid, _ in passages], dtype=np.int64)
+    hashes = np.array([get_passage_fingerprint(passage) for _, passage in passages], dtype=np.uint64)
+    doc_pids = np.asarray(index.doc_pids)
+    docids = np.minimum(np.searchsorted(doc_pids, pids), max(len(doc_pids) - 1, 0))
+    if len(doc_pids):
+        unchanged = (doc_pids[docids] == pids) & (np.asarray(index.doc_hashes)[docids] == hashes)
+    else:
+        unchanged = np.zeros(len(pids), dtype=bool)
+    return [passage_info for passage_info, is_unchanged in zip(passages, unchanged.tolist()) if not is_unchanged]
+
+
+def append_passages(index_path, passages, remove_stopwords, delete_pids=(), batch_size=1000,
+                    memory_budget=256, max_segments=MAX_SEGMENTS, max_workers=12):
+    # passages: [pid, passage] pairs to add or replace, delete_pids: pids to remove
+    # Returns the background merge process, if one was started
+    recover_index(index_path)
+    with index_lock(index_path):
+        index = open_index_for_update(index_path)
+        passages = get_changed_passages(index, passages)
+        indexed_pids = set(np.asarray(index.doc_pids).tolist())
+        delete_pids = [pid for pid in delete_pids if pid in indexed_pids]
+        if not passages and not delete_pids:
+            return None
+
+        manifest = read_manifest(index_path)
+        generation = manifest['generation'] + 1
+        segments_dir = os.path.join(index_path, SEGMENTS_DIR)
+        segment_paths = []
+        if passages:
+            generation_dir = os.path.join(segments_dir, f'{generation:06d}')
+            if os.path.exists(generation_dir):
+                # Segments of an update interrupted before its manifest was written
+                shutil.rmtree(generation_dir)
+            os.makedirs(generation_dir)
+            # Only the new and changed passages are tokenized, in blocks spread
+            # over the workers
+            block_size = max(batch_size, -(-len(passages) // max_workers))
+            blocks_info = enumerate(passages[i:i + block_size] for i in range(0, len(passages), block_size))
+            with stage('append passages'):
+                segment_paths = invert_blocks(blocks_info, generation_dir, remove_stopwords, memory_budget, max_workers, batch_size)
+        count('passages appended', len(passages))
+        count('passages deleted', len(delete_pids))
+
+        # Older versions of changed passages and deleted passages are tombstoned
+        replaced_pids = [pid for pid, _ in passages if pid in indexed_pids]
+        manifest['tombstones'] += [[int(pid), generation] for pid in replaced_pids + list(delete_pids)]
+        manifest['segments'] += [{'name': os.path.relpath(segment_path, segments_dir), 'generation': generation} for segment_path in segment_paths]
+        manifest['generation'] = generation
+        write_manifest(index_path, manifest)
+        count('index updates')
+        count('segments appended', len(segment_paths))
+
+    if len(manifest['segments']) >= max_segments:
+        return merge_index_segments_in_background(index_path, remove_stopwords, max_workers)
+    return None
+
+
+def delete_passages(index_path, pids, remove_stopwords, **append_args):
+    return append_passages(index_path, [], remove_stopwords, delete_pids=pids, **append_args)
+
+
+def merge_index_segments(index_path, remove_stopwords, max_workers=12):
+    # Merge the base index and its segments into a new base index, returns
+    # the last merged generation (None when there was nothing to merge or
+    # another merge is running)
+    index_path = os.path.abspath(index_path)
+    with index_lock(index_path + '.merge', blocking=False) as locked:
+        if not locked:
+            # Another merge is running
+            return
+        with stage('merge index segments'):
+            with index_lock(index_path):
+                restore_index(index_path)
+                if not os.path.exists(os.path.join(index_path, MANIFEST_FILE)):
+                    return
+                index = SegmentedInvertedIndex(index_path)
+                manifest = read_manifest(index_path)
+            merged_generation = manifest['generation']
+            segment_paths = [segment.path for segment in index.segments]
+            segments_live = [segment_docids >= 0 for segment_docids in index.segment_docids]
+            merged_path = index_path + '_merged'
+            merge_segments(segment_paths, merged_path, remove_stopwords, max_workers, segments_live)
+            with open(os.path.join(merged_path, 'meta.json')) as f:
+                meta = json.load(f)
+            meta['generation'] = merged_generation
+            with open(os.path.join(merged_path, 'meta.json'), 'w') as f:
+                json.dump(meta, f, indent=4)
+
+            with index_lock(index_path):
+                # Keep the segments and tombstones of updates made during the merge
+                manifest = read_manifest(index_path)
+                segments = [segment for segment in manifest['segments'] if segment['generation'] > merged_generation]
+                tombstones = [tombstone for tombstone in manifest['tombstones'] if tombstone[1] > merged_generation]
+                if segments or tombstones:
+                    # Hard links, the index keeps its segments until the swap
+                    os.makedirs(os.path.join(merged_path, SEGMENTS_DIR), exist_ok=True)
+                    for segment in segments:
+                        shutil.copytree(os.path.join(index_path, SEGMENTS_DIR, segment['name']),
+                                        os.path.join(merged_path, SEGMENTS_DIR, segment['name']), copy_function=os.link)
+                    write_manifest(merged_path, {'generation': manifest['generation'], 'base_generation': merged_generation,
+                                                 'segments': segments, 'tombstones': tombstones})
+
+                # Swap the indexes, open memory maps of the old one stay valid
+                old_path = index_path + '_old'
+                os.rename(index_path, old_path)
+                os.rename(merged_path, index_path)
+                close_inverted_index(index_path)
+            shutil.rmtree(old_path)
+        count('segments merged', len(segment_paths))
+    return merged_generation
+
+
+def merge_index_segments_in_background(index_path, remove_stopwords, max_workers=12):
+    process = multiprocessing.get_context('spawn').Process(target=merge_index_segments,
+                                                           args=(index_path, remove_stopwords, max_workers))
+    process.start()
+    return process
+
+
+def update_inverted_index(passages_blocks, index_path, remove_stopwords, delete_missing=True, segment_size=10000, **append_args):
+    # Apply a new version of the whole collection: unchanged passages are only
+    # fingerprinted, new and changed ones are appended in segments of
+    # segment_size passages and, with delete_missing, passages that are not
+    # part of the collection anymore are deleted
+    recover_index(index_path)
+    index = open_index_for_update(index_path)
+    seen_pids = []
+    pending = []
+    merge_processes = []
+    for passages_info in timed_iter('read passages', passages_blocks):
+        seen_pids.extend(pid for pid, _ in passages_info)
+        with stage('fingerprint passages'):
+            pending.extend(get_changed_passages(index, passages_info))
+        if len(pending) >= segment_size:
+            merge_processes.append(append_passages(index_path, pending, remove_stopwords, **append_args))
+            pending = []
+    deleted_pids = np.setdiff1d(np.asarray(index.doc_pids), np.array(seen_pids, dtype=np.int64)).tolist() if delete_missing else []
+    merge_processes.append(append_passages(index_path, pending, remove_stopwords, delete_pids=deleted_pids, **append_args))
+    return [process for process in merge_processes if process is not None]
@@ -0,0 +1,250 @@
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import numpy as np
+
+
+'''
+Instrumentation of the pipeline stages
+    - stage(name) times a block (context manager or decorator): wall and CPU
+      time and its memory peak, the RSS high-water mark and, once
+      enable_tracemalloc() was called, the peak of traced Python allocations;
+      nested stages are named parent/child and every stage accumulates over
+      its calls
+    - memory peaks are process-wide: they are only reset when an outermost
+      stage of the main thread starts (where Linux allows it), so nested
+      stages and stages of other threads report the peak since then; CPU
+      time is that of the process in the main thread and that of the thread
+      in other threads (e.g. parallel Optuna trials)
+    - count(name, value) increments a counter, record_latency(name, seconds)
+      or the latency(name) block adds a sample to a latency histogram
+    - tasks sent to process pools are wrapped with instrumented(function,
+      name): the worker times the task as a stage, collects its metrics in a
+      fresh Metrics and returns them with the result; merge_task_result adds
+      them to the metrics of the parent under pool/, so stages of workers add
+      up their time over all tasks
+    - get_report() returns a JSON-serialisable summary, save_report(path)
+      writes it and print_report() prints the stages
+'''
+# Upper bounds of the latency histogram buckets, in ms
+LATENCY_BUCKETS_MS = 2.0 ** np.arange(-10, 21)
+
+
+def get_rss_peak():
+    # High-water mark of the resident set size in MB
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_rss_peak():
+    # Linux >= 4.0, elsewhere peaks are those of the whole process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_traced_peak():
+    return tracemalloc.get_traced_memory()[1] / (1024 * 1024) if tracemalloc.is_tracing() else None
+
+
+def enable_tracemalloc():
+    # Traced allocations are precise but slow Python code down noticeably
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.counters = Counter()
+        self.latencies = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, calls, wall_time, cpu_time, rss_peak, traced_peak):
+        with self.lock:
+            stage_metrics = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                          'peak_rss_mb': 0.0, 'peak_traced_mb': None})
+            stage_metrics['calls'] += calls
+            stage_metrics['wall_seconds'] += wall_time
+            stage_metrics['cpu_seconds'] += cpu_time
+            stage_metrics['peak_rss_mb'] = max(stage_metrics['peak_rss_mb'], rss_peak)
+            if traced_peak is not None:
+                stage_metrics['peak_traced_mb'] = max(stage_metrics['peak_traced_mb'] or 0.0, traced_peak)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record_latency(self, name, seconds):
+        with self.lock:
+            self.latencies[name].append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {'stages': {name: dict(stage_metrics) for name, stage_metrics in self.stages.items()},
+                    'counters': dict(self.counters),
+                    'latencies': {name: list(samples) for name, samples in self.latencies.items()}}
+
+    def merge(self, snapshot):
+        for name, stage_metrics in snapshot['stages'].items():
+            self.add_stage(name, stage_metrics['calls'], stage_metrics['wall_seconds'], stage_metrics['cpu_seconds'],
+                           stage_metrics['peak_rss_mb'], stage_metrics['peak_traced_mb'])
+        with self.lock:
+            self.counters.update(snapshot['counters'])
+            for name, samples in snapshot['latencies'].items():
+                self.latencies[name].extend(samples)
+
+
+# Metrics of the current process, and the stages open in each thread
+metrics = Metrics()
+_open_stages = threading.local()
+_start_time = time.time()
+
+
+def get_stage_stack():
+    if not hasattr(_open_stages, 'stack'):
+        _open_stages.stack = []
+    return _open_stages.stack
+
+
+@contextmanager
+def stage(name):
+    stack = get_stage_stack()
+    full_name = stack[-1] + '/' + name if stack else name
+    main_thread = threading.current_thread() is threading.main_thread()
+    if main_thread and not stack:
+        reset_rss_peak()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+    stack.append(full_name)
+    cpu_clock = time.process_time if main_thread else time.thread_time
+    start_time = time.perf_counter()
+    start_cpu_time = cpu_clock()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start_time
+        cpu_time = cpu_clock() - start_cpu_time
+        stack.pop()
+        metrics.add_stage(full_name, 1, wall_time, cpu_time, get_rss_peak(), get_traced_peak())
+
+
+def timed_iter(name, iterable):
+    # Times the production of each item of an iterable (e.g. blocks read from
+    # a file) as the stage name
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count(name, value=1):
+    metrics.count(name, value)
+
+
+def record_latency(name, seconds):
+    metrics.record_latency(name, seconds)
+
+
+@contextmanager
+def latency(name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record_latency(name, time.perf_counter() - start_time)
+
+
+class InstrumentedTask:
+    # Picklable wrapper timing the call as a stage and returning (result, metrics of the call)
+    def __init__(self, function, name):
+        self.function = function
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        global metrics
+        # Stages open in the parent when the worker was forked are not
+        # part of the task
+        parent_metrics, metrics = metrics, Metrics()
+        parent_stack, _open_stages.stack = get_stage_stack(), []
+        try:
+            with latency(self.name), stage(self.name):
+                result = self.function(*args, **kwargs)
+            task_metrics = metrics.snapshot()
+        finally:
+            metrics = parent_metrics
+            _open_stages.stack = parent_stack
+        task_metrics['finished_at'] = time.time()
+        return result, task_metrics
+
+
+def instrumented(function, name):
+    return InstrumentedTask(function, name)
+
+
+def merge_task_result(task_result):
+    # Result of an instrumented task, its metrics are added to this process
+    # under pool/<stage>
+    result, task_metrics = task_result
+    metrics.merge({'stages': {'pool/' + name: stage_metrics for name, stage_metrics in task_metrics['stages'].items()},
+                   'counters': task_metrics['counters'],
+                   'latencies': {'pool/' + name: samples for name, samples in task_metrics['latencies'].items()}})
+    # Time between the end of the task and the parent receiving the result
+    metrics.record_latency('pool/result delay', max(time.time() - task_metrics['finished_at'], 0))
+    return result
+
+
+def get_latency_summary(samples):
+    samples_ms = np.asarray(samples, dtype=np.float64) * 1000
+    counts = np.bincount(np.searchsorted(LATENCY_BUCKETS_MS, samples_ms), minlength=len(LATENCY_BUCKETS_MS) + 1)
+    return {'count': len(samples_ms), 'mean_ms': float(samples_ms.mean()),
+            'p50_ms': float(np.percentile(samples_ms, 50)), 'p95_ms': float(np.percentile(samples_ms, 95)),
+            'p99_ms': float(np.percentile(samples_ms, 99)), 'max_ms': float(samples_ms.max()),
+            # [upper bound in ms (None for the last bucket), count] of the non-empty buckets
+            'histogram': [[float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else None, int(c)]
+                          for i, c in enumerate(counts.tolist()) if c]}
+
+
+def get_report():
+    snapshot = metrics.snapshot()
+    return {'pid': os.getpid(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(_start_time)),
+            'wall_seconds': time.time() - _start_time, 'cpu_seconds': time.process_time(),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_children_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            'stages': snapshot['stages'], 'counters': snapshot['counters'],
+            'latencies': {name: get_latency_summary(samples) for name, samples in snapshot['latencies'].items() if samples}}
+
+
+def save_report(path):
+    with open(path, 'w') as f:
+        json.dump(get_report(), f, indent=4)
+
+
+def print_report():
+    report = get_report()
+    print("%-48s %6s %10s %10s %10s" % ('stage', 'calls', 'wall (s)', 'cpu (s)', 'peak (MB)'))
+    for name, stage_metrics in report['stages'].items():
+        print("%-48s %6s %10.3f %10.3f %10.1f" % (name, stage_metrics['calls'], stage_metrics['wall_seconds'],
+                                                  stage_metrics['cpu_seconds'], stage_metrics['peak_rss_mb']))
+    for name, summary in report['latencies'].items():
+        print("%-48s %6s p50 %.3f ms, p95 %.3f ms, p99 %.3f ms" % (name, summary['count'], summary['p50_ms'],
+                                                                  summary['p95_ms'], summary['p99_ms']))
+    for name, value in report['counters'].items():
+        print("%-48s %s" % (name, value))
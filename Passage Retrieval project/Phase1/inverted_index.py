@@ -0,0 +1,554 @@
+import hashlib
+import json
+import os
+import numpy as np
+from posting_compression import CompressedPostings, save_compressed_postings
+
+
+'''
+Binary inverted index format (one directory per index):
+    - meta.json:         format version, preprocessing, index sizes and
+                         collection statistics (no_passages, collection_size, avg_dl)
+    - terms.json:        sorted term dictionary, the id of a term is its position
+    - offsets.npy:       int64 array of length no_terms + 1, the postings of the
+                         term with id t are [offsets[t], offsets[t + 1])
+    - postings.npy and block_*.npy: compressed posting lists of internal
+                         passage ids (docids), sorted by docid inside each
+                         posting list, and term frequencies (see
+                         posting_compression.py)
+    - cfs.npy:           int64 collection frequency of each term
+    - doc_pids.npy:      int32 sorted pids of all indexed passages (including
+                         passages without any term), the docid of a passage
+                         is its position in this array
+    - doc_lengths.npy:   int32 length of each passage, indexed by docid
+    - doc_hashes.npy:    uint64 fingerprint of the text of each passage,
+                         indexed by docid (finds changed passages on updates)
+    - tf_idf_norms.npy:  float64 L2 norm of the TF-IDF vector of each passage,
+                         indexed by docid
+    - max_tfs.npy:       int32 highest term frequency in the posting list of
+                         each term
+    - min_dl_tf_ratios.npy: float64 lowest passage length / term frequency
+                         ratio in the posting list of each term
+    - forward_offsets.npy, forward_term_ids.npy, forward_tfs.npy: forward
+                         index, the term ids (sorted) and term frequencies
+                         of the passage with docid d are
+                         [forward_offsets[d], forward_offsets[d + 1]) of
+                         the int32 forward_term_ids and forward_tfs
+The max_tfs and min_dl_tf_ratios are parameter-free per-term statistics
+from which the score upper bounds of dynamic pruning (see retrieval.py) are
+derived for any BM25 or query likelihood parameters.
+The compressed postings are memory mapped, so only the posting blocks that
+are read by a scorer are loaded from disk. Document frequencies are the lengths
+of the posting lists (np.diff(offsets)). Docids are dense and follow the pid
+order, so candidates are mapped to docids once and passage statistics are
+read by direct indexing. The forward index is the transpose of the
+postings, written with them and memory mapped, so the terms of candidate
+passages are read without decoding posting lists.
+
+Incremental updates (see index_updates.py) add, next to the arrays above:
+    - segments.json:     manifest of the segments appended since the last
+                         merge and of the tombstones of deleted or replaced
+                         passages, with the generation of each update
+    - segments/:         one directory per appended segment, in the format above
+An index with a manifest is opened as a SegmentedInvertedIndex, a view over
+the base arrays and the segments without the tombstoned passages.
+'''
+INDEX_FORMAT = 7
+MANIFEST_FILE = 'segments.json'
+SEGMENTS_DIR = 'segments'
+# Number of postings processed at once when computing statistics
+STATISTICS_CHUNK_SIZE = 10000000
+
+
+def get_index_path(remove_stopwords, prefix=''):
+    if remove_stopwords:
+        return prefix + 'inverted_index_no_stopwords'
+    return prefix + 'inverted_index'
+
+
+def get_passage_fingerprint(passage):
+    return int.from_bytes(hashlib.blake2b(passage.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def save_index_arrays(path, terms, offsets, docids, tfs, doc_pids, remove_stopwords, doc_hashes=None):
+    # doc_pids must be sorted and unique, docids are positions in doc_pids;
+    # docids and tfs are the uncompressed postings (arrays or memory maps)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'terms.json'), 'w') as f:
+        json.dump(terms, f)
+    np.save(os.path.join(path, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(path, 'doc_pids.npy'), np.asarray(doc_pids, dtype=np.int32))
+    # Passages without a fingerprint are seen as changed by updates
+    if doc_hashes is None:
+        doc_hashes = np.zeros(len(doc_pids), dtype=np.uint64)
+    np.save(os.path.join(path, 'doc_hashes.npy'), np.asarray(doc_hashes, dtype=np.uint64))
+    save_compressed_postings(path, offsets, docids, tfs)
+    finalize_index(path, remove_stopwords, docids, tfs)
+
+
+def get_postings_chunks(offsets, chunk_size=STATISTICS_CHUNK_SIZE):
+    # Yield (start, end, term ids of the postings in [start, end))
+    no_postings = int(offsets[-1])
+    for start in range(0, no_postings, chunk_size):
+        end = min(start + chunk_size, no_postings)
+        term_ids = np.searchsorted(offsets, np.arange(start, end), side='right') - 1
+        yield start, end, term_ids
+
+
+def save_index_statistics(path, docids, tfs):
+    offsets = np.load(os.path.join(path, 'offsets.npy'))
+    no_terms = len(offsets) - 1
+    no_passages = len(np.load(os.path.join(path, 'doc_pids.npy'), mmap_mode='r'))
+
+    # Passage lengths and collection frequencies
+    doc_lengths = np.zeros(no_passages, dtype=np.float64)
+    cfs = np.zeros(no_terms, dtype=np.float64)
+    for start, end, term_ids in get_postings_chunks(offsets):
+        doc_lengths += np.bincount(docids[start:end], weights=tfs[start:end], minlength=no_passages)
+        cfs += np.bincount(term_ids, weights=tfs[start:end], minlength=no_terms)
+    doc_lengths = doc_lengths.astype(np.int64)
+    cfs = cfs.astype(np.int64)
+
+    # TF-IDF norms
+    squared_norms = np.zeros(no_passages, dtype=np.float64)
+    for start, end, term_ids in get_postings_chunks(offsets):
+        squared_norms += get_tf_idf_squared_norms(offsets, term_ids, docids[start:end], tfs[start:end], doc_lengths)
+
+    # Per-term score upper bound statistics
+    max_tfs = np.zeros(no_terms, dtype=np.int64)
+    min_dl_tf_ratios = np.full(no_terms, np.inf)
+    for start, end, term_ids in get_postings_chunks(offsets):
+        chunk_tfs = np.asarray(tfs[start:end])
+        ratios = doc_lengths[docids[start:end]] / chunk_tfs
+        # Postings are grouped by term, reduce each group of the chunk
+        group_starts = np.flatnonzero(np.r_[True, term_ids[1:] != term_ids[:-1]])
+        group_terms = term_ids[group_starts]
+        max_tfs[group_terms] = np.maximum(max_tfs[group_terms], np.maximum.reduceat(chunk_tfs, group_starts))
+        min_dl_tf_ratios[group_terms] = np.minimum(min_dl_tf_ratios[group_terms], np.minimum.reduceat(ratios, group_starts))
+
+    np.save(os.path.join(path, 'cfs.npy'), cfs)
+    np.save(os.path.join(path, 'max_tfs.npy'), max_tfs.astype(np.int32))
+    np.save(os.path.join(path, 'min_dl_tf_ratios.npy'), min_dl_tf_ratios)
+    np.save(os.path.join(path, 'doc_lengths.npy'), doc_lengths.astype(np.int32))
+    np.save(os.path.join(path, 'tf_idf_norms.npy'), np.sqrt(squared_norms))
+    collection_size = int(doc_lengths.sum())
+    return {
+        'no_terms': no_terms,
+        'no_postings': int(offsets[-1]),
+        'no_passages': no_passages,
+        'collection_size': collection_size,
+        'avg_dl': collection_size / no_passages if no_passages else 0,
+    }
+
+
+def get_tf_idf_squared_norms(offsets, term_ids, docids, tfs, doc_lengths):
+    # Contribution of some postings to the squared TF-IDF norms of the passages,
+    # with TF normalised by the passage length and IDF = log10(N / df)
+    no_passages = len(doc_lengths)
+    idf = np.log10(no_passages / np.maximum(np.diff(offsets), 1))
+    tf_idf = tfs / doc_lengths[docids] * idf[term_ids]
+    return np.bincount(docids, weights=tf_idf ** 2, minlength=no_passages)
+
+
+def save_forward_index(path, docids, tfs):
+    # Transpose the postings (term order) into docid order, one chunk at a
+    # time; inside a passage, term ids stay sorted
+    offsets = np.load(os.path.join(path, 'offsets.npy'))
+    no_passages = len(np.load(os.path.join(path, 'doc_pids.npy'), mmap_mode='r'))
+    doc_lengths = np.zeros(no_passages, dtype=np.int64)
+    for start, end, _ in get_postings_chunks(offsets):
+        doc_lengths += np.bincount(docids[start:end], minlength=no_passages)
+    forward_offsets = np.zeros(no_passages + 1, dtype=np.int64)
+    forward_offsets[1:] = np.cumsum(doc_lengths)
+    np.save(os.path.join(path, 'forward_offsets.npy'), forward_offsets)
+
+    forward_term_ids = np.lib.format.open_memmap(os.path.join(path, 'forward_term_ids.npy'), mode='w+',
+                                                 dtype=np.int32, shape=(int(offsets[-1]),))
+    forward_tfs = np.lib.format.open_memmap(os.path.join(path, 'forward_tfs.npy'), mode='w+',
+                                            dtype=np.int32, shape=(int(offsets[-1]),))
+    # Next free position of each passage
+    cursors = forward_offsets[:-1].copy()
+    for start, end, term_ids in get_postings_chunks(offsets):
+        chunk_docids = np.asarray(docids[start:end], dtype=np.int64)
+        order = np.argsort(chunk_docids, kind='stable')
+        sorted_docids = chunk_docids[order]
+        # Rank of each posting among the postings of its passage in the chunk
+        group_starts = np.flatnonzero(np.r_[True, sorted_docids[1:] != sorted_docids[:-1]])
+        ranks = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(order)]))
+        positions = cursors[sorted_docids] + ranks
+        forward_term_ids[positions] = term_ids[order]
+        forward_tfs[positions] = np.asarray(tfs[start:end])[order]
+        cursors += np.bincount(chunk_docids, minlength=no_passages)
+    forward_term_ids.flush()
+    forward_tfs.flush()
+    del forward_term_ids, forward_tfs
+
+
+def finalize_index(path, remove_stopwords, docids, tfs):
+    statistics = save_index_statistics(path, docids, tfs)
+    save_forward_index(path, docids, tfs)
+    # Metadata is written last, an index without it is incomplete
+    meta = {
+        'format': INDEX_FORMAT,
+        'remove_stopwords': remove_stopwords,
+        **statistics,
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+def write_inverted_index(path, inverted_index, remove_stopwords, doc_pids=None, doc_hashes=None):
+    # Convert {term: {pid: tf}} to contiguous arrays
+    terms = sorted(inverted_index)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(inverted_index[term]) for term in terms])
+    pids = np.empty(offsets[-1], dtype=np.int32)
+    tfs = np.empty(offsets[-1], dtype=np.int32)
+    for term_id, term in enumerate(terms):
+        postings = sorted(inverted_index[term].items())
+        start, end = offsets[term_id], offsets[term_id + 1]
+        pids[start:end] = [int(pid) for pid, _ in postings]
+        tfs[start:end] = [tf for _, tf in postings]
+    # Without an explicit list, passages without terms are not part of the index
+    if doc_pids is None:
+        doc_pids = pids
+    doc_pids, first_positions = np.unique(np.asarray(doc_pids, dtype=np.int32), return_index=True)
+    if doc_hashes is not None:
+        doc_hashes = np.asarray(doc_hashes, dtype=np.uint64)[first_positions]
+    docids = np.searchsorted(doc_pids, pids)
+    save_index_arrays(path, terms, offsets, docids, tfs, doc_pids, remove_stopwords, doc_hashes)
+
+
+class InvertedIndex:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            raise Exception(f'No inverted index found at {path}!')
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != INDEX_FORMAT:
+            raise Exception(f'Inverted index at {path} has format {self.meta["format"]}, expected {INDEX_FORMAT}!')
+        self.remove_stopwords = self.meta['remove_stopwords']
+        # Number of updates applied to the index, see index_updates.py
+        self.generation = self.meta.get('generation', 0)
+        self.version = get_index_version(self.path)
+
+        self.no_passages = self.meta['no_passages']
+        self.collection_size = self.meta['collection_size']
+        self.avg_dl = self.meta['avg_dl']
+
+        # Term dictionary, offsets and collection frequencies are small, keep them in memory
+        with open(os.path.join(path, 'terms.json')) as f:
+            self.terms = json.load(f)
+        self.term_ids = {term: term_id for term_id, term in enumerate(self.terms)}
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.cfs = np.load(os.path.join(path, 'cfs.npy'))
+        self.max_tfs = np.load(os.path.join(path, 'max_tfs.npy'))
+        self.min_dl_tf_ratios = np.load(os.path.join(path, 'min_dl_tf_ratios.npy'))
+        # Postings and passage statistics are memory mapped
+        self.compressed_postings = CompressedPostings(path, self.offsets)
+        self.doc_pids = np.load(os.path.join(path, 'doc_pids.npy'), mmap_mode='r')
+        self.doc_lengths = np.load(os.path.join(path, 'doc_lengths.npy'), mmap_mode='r')
+        self.doc_hashes = np.load(os.path.join(path, 'doc_hashes.npy'), mmap_mode='r')
+        self.tf_idf_norms = np.load(os.path.join(path, 'tf_idf_norms.npy'), mmap_mode='r')
+        self.forward_offsets = np.load(os.path.join(path, 'forward_offsets.npy'), mmap_mode='r')
+        self.forward_term_ids = np.load(os.path.join(path, 'forward_term_ids.npy'), mmap_mode='r')
+        self.forward_tfs = np.load(os.path.join(path, 'forward_tfs.npy'), mmap_mode='r')
+
+    # Pickle by path, so that process pools do not serialize the postings
+    def __reduce__(self):
+        return (open_inverted_index, (self.path,))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.term_ids
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def df(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return 0
+        return int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def dfs(self):
+        return np.diff(self.offsets)
+
+    def cf(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return 0
+        return int(self.cfs[term_id])
+
+    def get_docids(self, pids):
+        # Map pids to docids, once per candidate list
+        pids = np.asarray(pids)
+        docids = np.searchsorted(self.doc_pids, pids)
+        if np.any(docids >= len(self.doc_pids)) or np.any(self.doc_pids[np.minimum(docids, len(self.doc_pids) - 1)] != pids):
+            raise Exception('Some passages are not part of the inverted index!')
+        return docids
+
+    def get_pids(self, docids):
+        return np.asarray(self.doc_pids[docids])
+
+    def get_doc_lengths(self, docids):
+        return np.asarray(self.doc_lengths[docids])
+
+    def get_tf_idf_norms(self, docids):
+        return np.asarray(self.tf_idf_norms[docids])
+
+    def postings(self, term, lo=None, hi=None):
+        # Docids and term frequencies of the posting list of a term, restricted
+        # to docids in [lo, hi) when given (only the blocks in range are decoded)
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        return self.compressed_postings.postings(term_id, lo, hi)
+
+    def get_term_frequencies(self, term, docids):
+        # Frequency of a term in sorted docids, 0 when absent
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return np.zeros(len(docids))
+        return self.compressed_postings.get_term_frequencies(term_id, docids)
+
+    def all_postings(self):
+        # Docids and term frequencies of all posting lists, in term order
+        return self.compressed_postings.all_postings()
+
+    def get_forward_postings(self, docids):
+        # Forward index rows of some passages: (row offsets, term ids, tfs),
+        # the terms of docids[i] are [row_offsets[i], row_offsets[i + 1])
+        docids = np.asarray(docids, dtype=np.int64)
+        starts = np.asarray(self.forward_offsets[docids])
+        lengths = np.asarray(self.forward_offsets[docids + 1]) - starts
+        row_offsets = np.zeros(len(docids) + 1, dtype=np.int64)
+        row_offsets[1:] = np.cumsum(lengths)
+        positions = np.repeat(starts - row_offsets[:-1], lengths) + np.arange(row_offsets[-1])
+        return row_offsets, np.asarray(self.forward_term_ids[positions], dtype=np.int64), np.asarray(self.forward_tfs[positions])
+
+    def get_term_frequency_matrix(self, terms, docids):
+        # (terms x passages) term frequencies, read from the forward rows of
+        # the passages
+        term_frequencies = np.zeros((len(terms), len(docids)))
+        rows = {self.term_ids[term]: row for row, term in enumerate(terms) if term in self.term_ids}
+        if not rows or len(docids) == 0:
+            return term_frequencies
+        row_offsets, term_ids, tfs = self.get_forward_postings(docids)
+        query_term_ids = np.array(sorted(rows), dtype=np.int64)
+        query_rows = np.array([rows[term_id] for term_id in query_term_ids.tolist()], dtype=np.int64)
+        positions = np.minimum(np.searchsorted(query_term_ids, term_ids), len(query_term_ids) - 1)
+        matches = query_term_ids[positions] == term_ids
+        columns = np.repeat(np.arange(len(docids)), np.diff(row_offsets))
+        term_frequencies[query_rows[positions[matches]], columns[matches]] = tfs[matches]
+        return term_frequencies
+
+
+'''
+View over a base index, its appended segments and tombstones
+    - a passage is live in a segment unless a tombstone of a later generation
+      deletes its pid; a changed passage is tombstoned and appended again
+    - docids are positions in the sorted pids of all live passages, each
+      segment keeps a local docid -> docid map (-1 for deleted passages)
+    - document and collection frequencies exclude deleted passages: the
+      postings of deleted passages are found from the skip data of the
+      segments, only the blocks that may contain them are decoded
+    - per-term upper bound statistics are merged over the segments, they
+      stay valid bounds with deleted passages
+'''
+class SegmentedInvertedIndex(InvertedIndex):
+    def __init__(self, path):
+        base = InvertedIndex(path)
+        self.path = base.path
+        self.meta = base.meta
+        self.remove_stopwords = base.remove_stopwords
+        self.version = base.version
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.generation = manifest['generation']
+        self.segments = [base] + [InvertedIndex(os.path.join(path, SEGMENTS_DIR, segment['name'])) for segment in manifest['segments']]
+        generations = [manifest['base_generation']] + [segment['generation'] for segment in manifest['segments']]
+
+        # Live passages of each segment, a pid is deleted from the segments
+        # older than its latest tombstone
+        tombstones = np.array(sorted(manifest['tombstones']), dtype=np.int64).reshape(-1, 2)
+        tombstones = tombstones[np.r_[tombstones[1:, 0] != tombstones[:-1, 0], True]] if len(tombstones) else tombstones
+        segments_live = []
+        for segment, generation in zip(self.segments, generations):
+            pids = np.asarray(segment.doc_pids)
+            positions = np.minimum(np.searchsorted(tombstones[:, 0], pids), max(len(tombstones) - 1, 0))
+            deleted = (tombstones[positions, 0] == pids) & (tombstones[positions, 1] > generation) if len(tombstones) else np.zeros(len(pids), dtype=bool)
+            segments_live.append(~deleted)
+        self.doc_pids = np.unique(np.concatenate([np.asarray(segment.doc_pids)[live] for segment, live in zip(self.segments, segments_live)]))
+        self.segment_docids = [np.where(live, np.searchsorted(self.doc_pids, segment.doc_pids), -1)
+                               for segment, live in zip(self.segments, segments_live)]
+
+        # Passage statistics
+        self.doc_lengths = np.zeros(len(self.doc_pids), dtype=np.int32)
+        self.doc_hashes = np.zeros(len(self.doc_pids), dtype=np.uint64)
+        for segment, segment_docids in zip(self.segments, self.segment_docids):
+            live = segment_docids >= 0
+            self.doc_lengths[segment_docids[live]] = np.asarray(segment.doc_lengths)[live]
+            self.doc_hashes[segment_docids[live]] = np.asarray(segment.doc_hashes)[live]
+        self.no_passages = len(self.doc_pids)
+        self.collection_size = int(self.doc_lengths.sum())
+        self.avg_dl = self.collection_size / self.no_passages if self.no_passages else 0
+
+        # Terms of all segments and term statistics without deleted passages
+        self.terms = sorted(set().union(*[segment.terms for segment in self.segments]))
+        self.term_ids = {term: term_id for term_id, term in enumerate(self.terms)}
+        self.segment_term_ids = [np.array([self.term_ids[term] for term in segment.terms], dtype=np.int64)
+                                 for segment in self.segments]
+        dfs = np.zeros(len(self.terms), dtype=np.int64)
+        self.cfs = np.zeros(len(self.terms), dtype=np.int64)
+        self.max_tfs = np.zeros(len(self.terms), dtype=np.int64)
+        self.min_dl_tf_ratios = np.full(len(self.terms), np.inf)
+        for segment, segment_docids, term_ids in zip(self.segments, self.segment_docids, self.segment_term_ids):
+            segment_dfs = np.diff(segment.offsets)
+            segment_cfs = np.array(segment.cfs)
+            deleted_term_ids, deleted_tfs = segment.compressed_postings.find_postings(np.flatnonzero(segment_docids < 0))
+            segment_dfs -= np.bincount(deleted_term_ids, minlength=len(segment_dfs))
+            segment_cfs -= np.bincount(deleted_term_ids, weights=deleted_tfs, minlength=len(segment_cfs)).astype(np.int64)
+            dfs[term_ids] += segment_dfs
+            self.cfs[term_ids] += segment_cfs
+            self.max_tfs[term_ids] = np.maximum(self.max_tfs[term_ids], segment.max_tfs)
+            self.min_dl_tf_ratios[term_ids] = np.minimum(self.min_dl_tf_ratios[term_ids], segment.min_dl_tf_ratios)
+
+        # Terms only found in deleted passages are not part of the vocabulary,
+        # as in a rebuild of the collection (|V| of the smoothed models); their
+        # segment term ids become -1, they have no live postings
+        live_terms = dfs > 0
+        merged_ids = np.where(live_terms, np.cumsum(live_terms) - 1, -1)
+        self.terms = [term for term, live in zip(self.terms, live_terms.tolist()) if live]
+        self.term_ids = {term: term_id for term_id, term in enumerate(self.terms)}
+        self.segment_term_ids = [merged_ids[term_ids] for term_ids in self.segment_term_ids]
+        dfs = dfs[live_terms]
+        self.cfs = self.cfs[live_terms]
+        self.max_tfs = self.max_tfs[live_terms]
+        self.min_dl_tf_ratios = self.min_dl_tf_ratios[live_terms]
+        self.offsets = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(dfs)
+        self._tf_idf_norms = None
+
+    @property
+    def tf_idf_norms(self):
+        # Depend on N and on every df, computed on first use
+        if self._tf_idf_norms is None:
+            docids, tfs = self.all_postings()
+            term_ids = np.repeat(np.arange(len(self.terms)), self.dfs())
+            self._tf_idf_norms = np.sqrt(get_tf_idf_squared_norms(self.offsets, term_ids, docids, tfs, self.doc_lengths))
+        return self._tf_idf_norms
+
+    def get_local_range(self, segment, lo, hi):
+        # Local docid range of a segment for the docids in [lo, hi)
+        local_lo = local_hi = None
+        if lo is not None:
+            local_lo = np.searchsorted(segment.doc_pids, self.doc_pids[lo]) if lo < self.no_passages else len(segment.doc_pids)
+        if hi is not None and hi < self.no_passages:
+            local_hi = np.searchsorted(segment.doc_pids, self.doc_pids[hi])
+        return local_lo, local_hi
+
+    def postings(self, term, lo=None, hi=None):
+        segments_docids, segments_tfs = [], []
+        for segment, segment_docids in zip(self.segments, self.segment_docids):
+            segment_term_id = segment.term_ids.get(term)
+            if segment_term_id is None:
+                continue
+            local_docids, tfs = segment.compressed_postings.postings(segment_term_id, *self.get_local_range(segment, lo, hi))
+            docids = segment_docids[local_docids]
+            segments_docids.append(docids[docids >= 0])
+            segments_tfs.append(tfs[docids >= 0])
+        if not segments_docids:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        docids, tfs = np.concatenate(segments_docids), np.concatenate(segments_tfs)
+        order = np.argsort(docids, kind='stable')
+        return docids[order].astype(np.int32), tfs[order]
+
+    def get_term_frequencies(self, term, docids):
+        term_frequencies = np.zeros(len(docids))
+        pids = self.doc_pids[np.asarray(docids, dtype=np.int64)]
+        for segment, segment_docids in zip(self.segments, self.segment_docids):
+            segment_term_id = segment.term_ids.get(term)
+            if segment_term_id is None or len(segment.doc_pids) == 0:
+                continue
+            # Passages that are live in this segment
+            local_docids = np.minimum(np.searchsorted(segment.doc_pids, pids), len(segment.doc_pids) - 1)
+            present = (segment.doc_pids[local_docids] == pids) & (segment_docids[local_docids] >= 0)
+            if np.any(present):
+                term_frequencies[present] = segment.compressed_postings.get_term_frequencies(segment_term_id, local_docids[present])
+        return term_frequencies
+
+    def all_postings(self):
+        segments_term_ids, segments_docids, segments_tfs = [], [], []
+        for segment, segment_docids, term_ids in zip(self.segments, self.segment_docids, self.segment_term_ids):
+            local_docids, tfs = segment.all_postings()
+            docids = segment_docids[local_docids]
+            live = docids >= 0
+            segments_term_ids.append(np.repeat(term_ids, segment.dfs())[live])
+            segments_docids.append(docids[live])
+            segments_tfs.append(tfs[live])
+        term_ids, docids, tfs = np.concatenate(segments_term_ids), np.concatenate(segments_docids), np.concatenate(segments_tfs)
+        order = np.lexsort((docids, term_ids))
+        return docids[order].astype(np.int32), tfs[order]
+
+    def get_forward_postings(self, docids):
+        # A live passage is in one segment, its row is read there and its
+        # term ids are mapped to the ids of the merged dictionary
+        docids = np.asarray(docids, dtype=np.int64)
+        pids = self.doc_pids[docids]
+        lengths = np.zeros(len(docids), dtype=np.int64)
+        segments_rows = []
+        for segment, segment_docids, segment_term_ids in zip(self.segments, self.segment_docids, self.segment_term_ids):
+            if len(segment.doc_pids) == 0:
+                continue
+            local_docids = np.minimum(np.searchsorted(segment.doc_pids, pids), len(segment.doc_pids) - 1)
+            present = np.flatnonzero((segment.doc_pids[local_docids] == pids) & (segment_docids[local_docids] >= 0))
+            if len(present):
+                row_offsets, term_ids, tfs = segment.get_forward_postings(local_docids[present])
+                lengths[present] = np.diff(row_offsets)
+                segments_rows.append((present, row_offsets, segment_term_ids[term_ids], tfs))
+        row_offsets = np.zeros(len(docids) + 1, dtype=np.int64)
+        row_offsets[1:] = np.cumsum(lengths)
+        term_ids = np.empty(row_offsets[-1], dtype=np.int64)
+        tfs = np.empty(row_offsets[-1], dtype=np.int32)
+        for present, segment_row_offsets, segment_term_ids, segment_tfs in segments_rows:
+            segment_lengths = np.diff(segment_row_offsets)
+            positions = np.repeat(row_offsets[present] - segment_row_offsets[:-1], segment_lengths) + np.arange(segment_row_offsets[-1])
+            term_ids[positions] = segment_term_ids
+            tfs[positions] = segment_tfs
+        return row_offsets, term_ids, tfs
+
+
+# Indexes opened in the current process, shared by all tasks it runs, with
+# their version
+_open_indexes = {}
+
+
+def get_index_version(path):
+    # Inode and modification time of meta.json and of the manifest (None when
+    # missing): rebuilds and merges write a new meta.json in a new directory,
+    # updates replace the manifest, so any change of the index changes them
+    version = []
+    for name in ('meta.json', MANIFEST_FILE):
+        file_path = os.path.join(path, name)
+        stat = os.stat(file_path) if os.path.exists(file_path) else None
+        version.append((stat.st_ino, stat.st_mtime_ns) if stat is not None else None)
+    return tuple(version)
+
+
+def open_inverted_index(path):
+    # Indexes rebuilt, merged or updated since they were opened are opened again
+    path = os.path.abspath(path)
+    version = get_index_version(path)
+    if path not in _open_indexes or _open_indexes[path][0] != version:
+        index = SegmentedInvertedIndex(path) if version[1] is not None else InvertedIndex(path)
+        _open_indexes[path] = (version, index)
+    return _open_indexes[path][1]
+
+
+def close_inverted_index(path):
+    _open_indexes.pop(os.path.abspath(path), None)
@@ -0,0 +1,218 @@
+import os
+import numpy as np
+
+
+'''
+Compressed posting lists
+    - each posting list is cut in blocks of BLOCK_SIZE postings (the last
+      block of a term may be shorter)
+    - in a block, docids are delta encoded (the first docid is kept in the
+      skip data, its delta is 0) and term frequencies are stored as tf - 1;
+      both are bit-packed with the smallest width that fits the largest value
+      of the block
+    - skip data (first and last docid, bit widths and payload offset of each
+      block) is small and kept in memory, so lookups of a few docids only
+      decode the blocks that may contain them
+    - packing and unpacking are vectorized over all the blocks of a chunk
+Files (in the index directory):
+    - block_offsets.npy:       int64, the blocks of the term with id t are
+                               [block_offsets[t], block_offsets[t + 1])
+    - block_first_docids.npy:  int32 first docid of each block
+    - block_last_docids.npy:   int32 last docid of each block
+    - block_widths.npy:        uint8 (no_blocks, 2) bit widths of the docid
+                               deltas and of the term frequencies of each block
+    - block_data_offsets.npy:  int64 byte offset of the payload of each block
+                               in postings.npy, length no_blocks + 1
+    - postings.npy:            uint8 payloads, the docid deltas then the term
+                               frequencies of each block, each starting on a
+                               byte boundary; padded so that any value can be
+                               read with an unaligned 64-bit load
+'''
+BLOCK_SIZE = 128
+# Number of postings compressed at once
+COMPRESSION_CHUNK_SIZE = 1 << 20
+PADDING = 8
+
+
+def get_bit_widths(values):
+    # Number of bits of each non-negative value (0 for 0)
+    return np.frexp(np.asarray(values, dtype=np.float64))[1].astype(np.int64)
+
+
+def pack_bits(bit_positions, values, widths, no_bytes):
+    # Write each value on widths bits (least significant bit first) from its bit position
+    bits = np.zeros(no_bytes * 8, dtype=np.uint8)
+    field_starts = np.cumsum(widths) - widths
+    owners = np.repeat(np.arange(len(values)), widths)
+    bit_ranks = np.arange(int(widths.sum())) - field_starts[owners]
+    bits[bit_positions[owners] + bit_ranks] = (values[owners] >> bit_ranks) & 1
+    return np.packbits(bits, bitorder='little')
+
+
+def get_words(data):
+    # Little endian 64-bit word starting at each byte of the payloads
+    # (unaligned view, the payloads are padded with PADDING bytes)
+    return np.ndarray(shape=(max(len(data) - PADDING + 1, 0),), dtype='<u8', buffer=data, strides=(1,))
+
+
+def unpack_bits(words, bit_positions, widths):
+    # Read values of up to 32 bits at each bit position
+    masks = (np.uint64(1) << widths.astype(np.uint64)) - np.uint64(1)
+    return ((words[bit_positions >> 3] >> (bit_positions & 7).astype(np.uint64)) & masks).astype(np.int64)
+
+
+def get_term_chunks(offsets, chunk_size=COMPRESSION_CHUNK_SIZE):
+    # Yield ranges of terms [start_term, end_term) with about chunk_size postings
+    no_terms = len(offsets) - 1
+    chunk_terms = np.searchsorted(offsets, np.arange(0, int(offsets[-1]), chunk_size), side='right') - 1
+    bounds = np.unique(np.concatenate(([0], chunk_terms, [no_terms])))
+    for start_term, end_term in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        yield start_term, end_term
+
+
+def get_term_blocks(offsets, start_term, end_term):
+    # Number of blocks of each term and posting ranges of all their blocks
+    dfs = np.diff(offsets[start_term:end_term + 1])
+    no_blocks = -(-dfs // BLOCK_SIZE)
+    block_terms = np.repeat(np.arange(start_term, end_term), no_blocks)
+    block_ranks = np.arange(int(no_blocks.sum())) - np.repeat(np.cumsum(no_blocks) - no_blocks, no_blocks)
+    starts = offsets[block_terms] + BLOCK_SIZE * block_ranks
+    ends = np.minimum(starts + BLOCK_SIZE, offsets[block_terms + 1])
+    return no_blocks, starts, ends
+
+
+def save_compressed_postings(path, offsets, docids, tfs):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    terms_no_blocks, first_docids, last_docids, widths, blocks_bytes, payloads = [], [], [], [], [], []
+    for start_term, end_term in get_term_chunks(offsets):
+        no_blocks, starts, ends = get_term_blocks(offsets, start_term, end_term)
+        terms_no_blocks.append(no_blocks)
+        if len(starts) == 0:
+            continue
+        chunk_start = offsets[start_term]
+        chunk_docids = np.asarray(docids[chunk_start:offsets[end_term]], dtype=np.int64)
+        chunk_tfs = np.asarray(tfs[chunk_start:offsets[end_term]], dtype=np.int64) - 1
+        local_starts = starts - chunk_start
+        counts = ends - starts
+
+        # Docid deltas inside each block
+        deltas = np.diff(chunk_docids, prepend=0)
+        deltas[local_starts] = 0
+        docid_widths = get_bit_widths(np.maximum.reduceat(deltas, local_starts))
+        tf_widths = get_bit_widths(np.maximum.reduceat(chunk_tfs, local_starts))
+
+        # Byte aligned payload of each block
+        docid_bytes = (counts * docid_widths + 7) // 8
+        block_bytes = docid_bytes + (counts * tf_widths + 7) // 8
+        block_starts = np.cumsum(block_bytes) - block_bytes
+        block_of = np.repeat(np.arange(len(starts)), counts)
+        ranks = np.arange(len(chunk_docids)) - local_starts[block_of]
+        docid_positions = block_starts[block_of] * 8 + ranks * docid_widths[block_of]
+        tf_positions = (block_starts + docid_bytes)[block_of] * 8 + ranks * tf_widths[block_of]
+        payloads.append(pack_bits(np.concatenate((docid_positions, tf_positions)),
+                                  np.concatenate((deltas, chunk_tfs)),
+                                  np.concatenate((docid_widths[block_of], tf_widths[block_of])),
+                                  int(block_bytes.sum())))
+
+        first_docids.append(chunk_docids[local_starts])
+        last_docids.append(chunk_docids[ends - chunk_start - 1])
+        widths.append(np.stack((docid_widths, tf_widths), axis=1))
+        blocks_bytes.append(block_bytes)
+
+    block_offsets = np.zeros(len(offsets), dtype=np.int64)
+    block_offsets[1:] = np.cumsum(np.concatenate(terms_no_blocks)) if terms_no_blocks else 0
+    block_data_offsets = np.zeros(int(block_offsets[-1]) + 1, dtype=np.int64)
+    if blocks_bytes:
+        block_data_offsets[1:] = np.cumsum(np.concatenate(blocks_bytes))
+    np.save(os.path.join(path, 'block_offsets.npy'), block_offsets)
+    np.save(os.path.join(path, 'block_first_docids.npy'), np.concatenate(first_docids or [[]]).astype(np.int32))
+    np.save(os.path.join(path, 'block_last_docids.npy'), np.concatenate(last_docids or [[]]).astype(np.int32))
+    np.save(os.path.join(path, 'block_widths.npy'), np.concatenate(widths or [np.empty((0, 2))]).astype(np.uint8))
+    np.save(os.path.join(path, 'block_data_offsets.npy'), block_data_offsets)
+    np.save(os.path.join(path, 'postings.npy'), np.concatenate(payloads + [np.zeros(PADDING, dtype=np.uint8)]))
+
+
+class CompressedPostings:
+    def __init__(self, path, offsets):
+        self.offsets = offsets
+        # Skip data is kept in memory, payloads are memory mapped
+        self.block_offsets = np.load(os.path.join(path, 'block_offsets.npy'))
+        self.block_first_docids = np.load(os.path.join(path, 'block_first_docids.npy'))
+        self.block_last_docids = np.load(os.path.join(path, 'block_last_docids.npy'))
+        self.block_widths = np.load(os.path.join(path, 'block_widths.npy')).astype(np.int64)
+        self.block_data_offsets = np.load(os.path.join(path, 'block_data_offsets.npy'))
+        self.words = get_words(np.load(os.path.join(path, 'postings.npy'), mmap_mode='r'))
+
+    def decode_blocks(self, blocks, return_term_ids=False):
+        # Docids and term frequencies (and term ids) of the postings of the given blocks
+        blocks = np.asarray(blocks, dtype=np.int64)
+        block_terms = np.searchsorted(self.block_offsets, blocks, side='right') - 1
+        starts = self.offsets[block_terms] + BLOCK_SIZE * (blocks - self.block_offsets[block_terms])
+        counts = np.minimum(starts + BLOCK_SIZE, self.offsets[block_terms + 1]) - starts
+        docid_widths = self.block_widths[blocks, 0]
+        tf_widths = self.block_widths[blocks, 1]
+
+        block_of = np.repeat(np.arange(len(blocks)), counts)
+        first_positions = np.cumsum(counts) - counts
+        ranks = np.arange(int(counts.sum())) - first_positions[block_of]
+        docid_starts = self.block_data_offsets[blocks] * 8
+        tf_starts = docid_starts + (counts * docid_widths + 7) // 8 * 8
+        deltas = unpack_bits(self.words, docid_starts[block_of] + ranks * docid_widths[block_of], docid_widths[block_of])
+        tfs = unpack_bits(self.words, tf_starts[block_of] + ranks * tf_widths[block_of], tf_widths[block_of]) + 1
+
+        # Prefix sums of the deltas, restarted at the first docid of each block
+        cumulative_deltas = np.cumsum(deltas)
+        docids = (self.block_first_docids[blocks][block_of]
+                  + cumulative_deltas - cumulative_deltas[first_positions][block_of])
+        if return_term_ids:
+            return docids.astype(np.int32), tfs.astype(np.int32), block_terms[block_of]
+        return docids.astype(np.int32), tfs.astype(np.int32)
+
+    def postings(self, term_id, lo=None, hi=None):
+        # Postings of a term, restricted to docids in [lo, hi) when given
+        first_block, end_block = self.block_offsets[term_id], self.block_offsets[term_id + 1]
+        if lo is not None:
+            first_block += np.searchsorted(self.block_last_docids[first_block:end_block], lo, side='left')
+        if hi is not None:
+            end_block = first_block + np.searchsorted(self.block_first_docids[first_block:end_block], hi, side='left')
+        docids, tfs = self.decode_blocks(np.arange(first_block, end_block))
+        if lo is not None or hi is not None:
+            keep = (docids >= (lo if lo is not None else 0)) & (docids < (hi if hi is not None else np.iinfo(np.int32).max))
+            docids, tfs = docids[keep], tfs[keep]
+        return docids, tfs
+
+    def get_term_frequencies(self, term_id, docids):
+        # Frequency of a term in sorted docids (0 when absent), only the
+        # blocks that may contain them are decoded
+        docids = np.asarray(docids)
+        term_frequencies = np.zeros(len(docids))
+        first_block, end_block = self.block_offsets[term_id], self.block_offsets[term_id + 1]
+        blocks = np.unique(np.searchsorted(self.block_last_docids[first_block:end_block], docids, side='left'))
+        blocks = blocks[blocks < end_block - first_block] + first_block
+        if len(blocks) == 0:
+            return term_frequencies
+        block_docids, block_tfs = self.decode_blocks(blocks)
+        positions = np.minimum(np.searchsorted(block_docids, docids), len(block_docids) - 1)
+        found = block_docids[positions] == docids
+        term_frequencies[found] = block_tfs[positions[found]]
+        return term_frequencies
+
+    def find_postings(self, docids):
+        # Term ids and term frequencies of all the postings of sorted docids,
+        # only the blocks whose docid range holds some of them are decoded
+        docids = np.asarray(docids)
+        no_docids_in_range = (np.searchsorted(docids, self.block_last_docids, side='right')
+                              - np.searchsorted(docids, self.block_first_docids, side='left'))
+        blocks = np.flatnonzero(no_docids_in_range > 0)
+        block_docids, block_tfs, block_term_ids = self.decode_blocks(blocks, return_term_ids=True)
+        found = np.isin(block_docids, docids)
+        return block_term_ids[found], block_tfs[found]
+
+    def all_postings(self, chunk_size=COMPRESSION_CHUNK_SIZE):
+        # Docids and term frequencies of all posting lists, in term order
+        no_blocks = len(self.block_first_docids)
+        chunks = [self.decode_blocks(np.arange(start, min(start + chunk_size // BLOCK_SIZE, no_blocks)))
+                  for start in range(0, no_blocks, chunk_size // BLOCK_SIZE)]
+        if not chunks:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        return np.concatenate([docids for docids, _ in chunks]), np.concatenate([tfs for _, tfs in chunks])
@@ -0,0 +1,74 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+'''
+Query result cache
+    - rankings are keyed on (model, parameters, normalized query terms with
+      their frequencies, hash of the candidate pids in order, k), so queries
+      that only differ by casing, punctuation or stopwords share an entry;
+      full-collection rankings have no candidate hash
+    - at most max_entries rankings are kept, least recently used first out
+    - the cache is emptied when it is used with another index than the one
+      its rankings were computed on, or with another version of it (see
+      get_index_version: updates, merges and rebuilds by other processes)
+    - it is used by the resident retrieval service only, where the same
+      queries come back across requests; the batch rankers (task2 to task4,
+      Phase2/task1_bm25.py) score each query of their query file once per
+      run and do not go through it
+'''
+def get_candidates_hash(candidates):
+    if candidates is None:
+        return None
+    return hashlib.blake2b(np.asarray(candidates, dtype=np.int64).tobytes(), digest_size=16).hexdigest()
+
+
+def get_ranking_key(model, parameters, query_term_frequency, candidates, k):
+    return (model, tuple(sorted(parameters.items())), tuple(sorted(query_term_frequency.items())),
+            get_candidates_hash(candidates), k)
+
+
+class RankingCache:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.rankings = OrderedDict()
+        self.inverted_index = None
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.no_invalidations = 0
+
+    def validate(self, inverted_index):
+        # Rankings of a previous version of the index are dropped
+        if inverted_index is not self.inverted_index or inverted_index.version != self.version:
+            if self.rankings:
+                self.no_invalidations += 1
+            self.rankings.clear()
+            self.inverted_index = inverted_index
+            self.version = inverted_index.version
+
+    def get(self, inverted_index, key):
+        self.validate(inverted_index)
+        ranking = self.rankings.get(key)
+        if ranking is None:
+            self.misses += 1
+            return None
+        self.rankings.move_to_end(key)
+        self.hits += 1
+        return ranking
+
+    def put(self, inverted_index, key, ranking):
+        self.validate(inverted_index)
+        self.rankings[key] = ranking
+        self.rankings.move_to_end(key)
+        if len(self.rankings) > self.max_entries:
+            self.rankings.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def statistics(self):
+        return {'entries': len(self.rankings), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate(), 'invalidations': self.no_invalidations}
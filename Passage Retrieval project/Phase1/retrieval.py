@@ -0,0 +1,244 @@
+import numpy as np
+from topk import top_k
+
+
+'''
+Full-collection retrieval with MaxScore dynamic pruning
+    - the score of a passage is written as
+          constant + prior(passage) + sum of the contributions of the query
+          terms it contains,
+      with an upper bound on the contribution of each term derived from the
+      per-term statistics stored in the index (max_tfs, min_dl_tf_ratios)
+    - passages without any query term only score constant + prior, the best
+      k of them are found first by walking passages in decreasing prior order
+      and give the initial top-k threshold
+    - passages are then processed document-at-a-time, in windows of docids:
+      query terms are sorted by upper bound and the longest prefix whose
+      bounds cannot lift a passage over the threshold is non-essential;
+      only passages of the essential posting lists are candidates, and they
+      are dropped as soon as their partial score plus the bounds of the
+      remaining terms falls under the threshold; essential posting lists are
+      decoded for the window only and non-essential ones are only probed for
+      the remaining candidates, using the skip data of the compressed postings
+    - the final scores of the surviving passages are recomputed in query term
+      order, exactly as exhaustive scoring does, so both return the same top-k
+    - the top-k is selected by the top_k kernel shared with the re-rankers,
+      over passages in docid order: ties are broken by position, i.e. by pid,
+      as when the whole collection is re-ranked as a pid-sorted candidate list
+'''
+# Slack on the pruning bounds, absorbs floating point rounding of the sums
+PRUNING_TOLERANCE = 1e-9
+
+
+'''
+BM25 without relevance information (R = ri = 0), the RSJ weight is
+log((N - ni + 0.5) / (ni + 0.5)); terms with a negative weight get a null
+upper bound
+'''
+class BM25Model:
+    def __init__(self, inverted_index, k1=1.2, k2=100, b=0.75):
+        self.inverted_index = inverted_index
+        self.k1 = k1
+        self.k2 = k2
+        self.b = b
+
+    def weight(self, term_id, qf):
+        N = self.inverted_index.no_passages
+        ni = int(self.inverted_index.offsets[term_id + 1] - self.inverted_index.offsets[term_id])
+        rsj_weight = np.log((N - ni + 0.5) / (ni + 0.5))
+        return rsj_weight * ((self.k2 + 1) * qf) / (self.k2 + qf)
+
+    def contributions(self, term_id, qf, tfs, dls):
+        K = self.k1 * ((1 - self.b) + self.b * dls / self.inverted_index.avg_dl)
+        return self.weight(term_id, qf) * ((self.k1 + 1) * tfs) / (K + tfs)
+
+    def upper_bound(self, term_id, qf):
+        weight = self.weight(term_id, qf)
+        if weight <= 0:
+            return 0.0
+        # tf / (K + tf) = 1 / (1 + k1 (1 - b) / tf + k1 b / avg_dl * dl / tf)
+        saturation = 1 / (1 + self.k1 * (1 - self.b) / self.inverted_index.max_tfs[term_id]
+                          + self.k1 * self.b / self.inverted_index.avg_dl * self.inverted_index.min_dl_tf_ratios[term_id])
+        return weight * (self.k1 + 1) * saturation
+
+    def prior(self, query_term_frequency, dls):
+        return np.zeros(len(dls))
+
+    def is_prior_decreasing_with_length(self, query_term_frequency):
+        # Passages without query terms all score 0, they are ranked by docid
+        return False
+
+    def constant(self, query_term_frequency):
+        return 0.0
+
+
+'''
+Query likelihood, rewritten as a sum over the query terms of the passage:
+    lidstone (laplace: epsilon = 1):
+        sum qf log((tf + epsilon) / (|D| + epsilon |V|))
+        = sum_{t in D} qf log(1 + tf / epsilon) - |q| log(|D| + epsilon |V|) + |q| log(epsilon)
+    dirichlet, with p_c = max(cf, 1) / |C|:
+        sum qf log((tf + miu p_c) / (|D| + miu))
+        = sum_{t in D} qf log(1 + tf / (miu p_c)) - |q| log(|D| + miu) + sum qf log(miu p_c)
+The prior decreases with the passage length, passages without query terms
+are ranked shortest first
+'''
+class QueryLikelihoodModel:
+    def __init__(self, inverted_index, smoothing, parameter=None):
+        if smoothing not in ('laplace', 'lidstone', 'dirichlet'):
+            raise ValueError('Unknown smoothing: %s' % smoothing)
+        self.inverted_index = inverted_index
+        self.smoothing = smoothing
+        self.parameter = 1 if smoothing == 'laplace' else parameter
+
+    def get_smoothing_mass(self, term_id):
+        # Pseudo-count added to the term frequency
+        if self.smoothing == 'dirichlet':
+            cf = max(int(self.inverted_index.cfs[term_id]), 1) if term_id is not None else 1
+            return self.parameter * cf / self.inverted_index.collection_size
+        return self.parameter
+
+    def contributions(self, term_id, qf, tfs, dls):
+        return qf * np.log(1 + tfs / self.get_smoothing_mass(term_id))
+
+    def upper_bound(self, term_id, qf):
+        return qf * np.log(1 + self.inverted_index.max_tfs[term_id] / self.get_smoothing_mass(term_id))
+
+    def prior(self, query_term_frequency, dls):
+        query_length = sum(query_term_frequency.values())
+        if self.smoothing == 'dirichlet':
+            return -query_length * np.log(dls + self.parameter)
+        return -query_length * np.log(dls + self.parameter * len(self.inverted_index))
+
+    def is_prior_decreasing_with_length(self, query_term_frequency):
+        # The prior of an empty query is 0
+        return sum(query_term_frequency.values()) > 0
+
+    def constant(self, query_term_frequency):
+        return float(sum(qf * np.log(self.get_smoothing_mass(self.inverted_index.term_ids.get(term)))
+                         for term, qf in query_term_frequency.items()))
+
+
+class MaxScoreRetriever:
+    def __init__(self, inverted_index, model, window_size=8192):
+        self.inverted_index = inverted_index
+        self.model = model
+        self.window_size = window_size
+        self.doc_lengths = np.asarray(inverted_index.doc_lengths, dtype=np.float64)
+        # Passages by increasing length, ties by docid
+        self.docs_by_length = np.lexsort((np.arange(len(self.doc_lengths)), self.doc_lengths))
+
+    def get_query_terms(self, query_term_frequency):
+        # (term, term id, qf) of the query terms present in the index
+        return [(term, self.inverted_index.term_ids[term], qf)
+                for term, qf in query_term_frequency.items() if term in self.inverted_index]
+
+    def score_docs(self, query_term_frequency, query_terms, docs):
+        # Exact scores of sorted docids, query terms added in query order
+        dls = self.doc_lengths[docs]
+        scores = self.model.prior(query_term_frequency, dls)
+        for term, term_id, qf in query_terms:
+            docs_tfs = self.inverted_index.get_term_frequencies(term, docs)
+            scores = scores + np.where(docs_tfs > 0, self.model.contributions(term_id, qf, docs_tfs, dls), 0)
+        return scores
+
+    def get_top_docs_without_terms(self, query_term_frequency, query_terms, k):
+        # Best k passages that contain none of the query terms, walked in
+        # decreasing prior order with ties by docid
+        if self.model.is_prior_decreasing_with_length(query_term_frequency):
+            prior_order = self.docs_by_length
+        else:
+            prior_order = np.arange(len(self.doc_lengths))
+        top_docs = []
+        no_found = 0
+        for start in range(0, len(prior_order), 4 * k):
+            docs = prior_order[start:start + 4 * k]
+            sorted_docs = np.sort(docs)
+            matching = np.zeros(len(docs), dtype=bool)
+            for term, _, _ in query_terms:
+                matching |= self.inverted_index.get_term_frequencies(term, sorted_docs)[np.searchsorted(sorted_docs, docs)] > 0
+            docs = docs[~matching][:k - no_found]
+            top_docs.append(docs)
+            no_found += len(docs)
+            if no_found == k:
+                break
+        docs = np.concatenate(top_docs) if top_docs else np.empty(0, dtype=np.int64)
+        return docs, self.model.prior(query_term_frequency, self.doc_lengths[docs])
+
+    def retrieve(self, query_term_frequency, k=100, exhaustive=False):
+        # Returns the pids and scores of the k best passages of the collection
+        query_terms = self.get_query_terms(query_term_frequency)
+        constant = self.model.constant(query_term_frequency)
+        if exhaustive:
+            docs = np.arange(len(self.doc_lengths))
+            scores = self.score_docs(query_term_frequency, query_terms, docs)
+            top_docs, top_scores = select_top_k(docs, scores, k)
+            return self.inverted_index.get_pids(top_docs), top_scores + constant
+
+        # Initial top-k and threshold from the passages without query terms
+        top_docs, top_scores = self.get_top_docs_without_terms(query_term_frequency, query_terms, k)
+        top_docs, top_scores = select_top_k(top_docs, top_scores, k)
+
+        # Query terms by increasing upper bound
+        upper_bounds = np.array([self.model.upper_bound(term_id, qf) for _, term_id, qf in query_terms], dtype=np.float64)
+        order = np.argsort(upper_bounds, kind='stable')
+        query_terms_by_bound = [query_terms[i] for i in order]
+        upper_bounds = upper_bounds[order]
+        cumulative_bounds = np.concatenate(([0], np.cumsum(upper_bounds)))
+        prior_bound = self.model.prior(query_term_frequency, self.doc_lengths[self.docs_by_length[:1]]).max(initial=-np.inf)
+
+        no_docs = len(self.doc_lengths)
+        for lo in range(0, no_docs, self.window_size):
+            hi = min(lo + self.window_size, no_docs)
+            threshold = top_scores[-1] if len(top_scores) == k else -np.inf
+            tolerance = PRUNING_TOLERANCE * (1 + abs(threshold)) if np.isfinite(threshold) else 0
+            # Non-essential terms: prefix of bounds that cannot reach the threshold
+            no_non_essential = int(np.searchsorted(prior_bound + cumulative_bounds + tolerance, threshold, side='left')) - 1
+            no_non_essential = max(no_non_essential, 0)
+            if no_non_essential == len(query_terms_by_bound):
+                # No passage can enter the top-k anymore, the threshold only increases
+                break
+
+            # Candidates of the essential posting lists in the window, read
+            # entirely into dense window arrays
+            essential_terms = query_terms_by_bound[no_non_essential:]
+            window_tfs = np.zeros((len(essential_terms), hi - lo))
+            for row, (term, _, _) in enumerate(essential_terms):
+                docids, tfs = self.inverted_index.postings(term, lo, hi)
+                window_tfs[row, docids - lo] = tfs
+            candidates = np.flatnonzero(window_tfs.any(axis=0))
+            if len(candidates) == 0:
+                continue
+            candidates_tfs = window_tfs[:, candidates]
+            candidates += lo
+            dls = self.doc_lengths[candidates]
+            partial_scores = self.model.prior(query_term_frequency, dls)
+            for (_, term_id, qf), term_tfs in zip(essential_terms, candidates_tfs):
+                partial_scores = partial_scores + np.where(term_tfs > 0, self.model.contributions(term_id, qf, term_tfs, dls), 0)
+
+            # Probe the non-essential lists, highest bound first, dropping hopeless candidates
+            for i in range(no_non_essential - 1, -1, -1):
+                keep = partial_scores + cumulative_bounds[i + 1] + tolerance >= threshold
+                candidates, dls, partial_scores = candidates[keep], dls[keep], partial_scores[keep]
+                if len(candidates) == 0:
+                    break
+                term, term_id, qf = query_terms_by_bound[i]
+                candidates_tfs = self.inverted_index.get_term_frequencies(term, candidates)
+                partial_scores = partial_scores + np.where(candidates_tfs > 0, self.model.contributions(term_id, qf, candidates_tfs, dls), 0)
+            keep = partial_scores + tolerance >= threshold
+            candidates = candidates[keep]
+            if len(candidates) == 0:
+                continue
+
+            # Exact scores of the survivors, merged in the top-k
+            scores = self.score_docs(query_term_frequency, query_terms, candidates)
+            top_docs, top_scores = select_top_k(np.concatenate((top_docs, candidates)), np.concatenate((top_scores, scores)), k)
+
+        return self.inverted_index.get_pids(top_docs), top_scores + constant
+
+
+def select_top_k(docs, scores, k):
+    # k best (docid, score) pairs, highest score first and ties by docid
+    by_docid = np.argsort(docs, kind='stable')
+    order = by_docid[top_k(scores[by_docid], k)]
+    return docs[order], scores[order]
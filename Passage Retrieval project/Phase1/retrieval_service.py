@@ -0,0 +1,288 @@
+import asyncio
+import concurrent.futures
+import json
+import time
+import numpy as np
+from inverted_index import get_index_path, open_inverted_index
+from scoring import TfIdfEngine, BM25Engine, QueryLikelihoodEngine, get_queries_term_frequencies
+from topk import top_k
+from ranking_cache import RankingCache, get_ranking_key
+from retrieval import MaxScoreRetriever, BM25Model, QueryLikelihoodModel
+
+
+'''
+Resident retrieval service
+    - the index is opened and the TF-IDF passage matrix is built once, before
+      the worker pool is forked, so workers share them instead of reloading
+      them for every batch of queries; indexes updated in place (see
+      index_updates.py) are reopened on the next query
+    - an asyncio HTTP/1.1 server (TCP or Unix socket) parses requests and
+      dispatches each query to a worker of the pool
+    - POST /rank with a JSON body
+          {"query": "...", "model": "bm25", "k": 100, "candidates": [pids]}
+      ranks the candidates, or the whole collection (MaxScore pruning) when
+      "candidates" is missing; models are bm25 (k1, k2, b), tfidf, laplace,
+      lidstone and dirichlet (parameter), model parameters are optional
+      fields of the body; the answer is {"pids": [...], "scores": [...]}
+    - queries are normalized by a worker first, rankings of previous queries
+      with the same normalized terms, model and candidates are answered from
+      a RankingCache in the server process
+    - GET /health returns the index statistics, the number of queries served
+      and the hit rate of the ranking cache
+'''
+DEFAULT_PARAMETERS = {'bm25': {'k1': 1.2, 'k2': 100, 'b': 0.75},
+                      'tfidf': {},
+                      'laplace': {},
+                      'lidstone': {'parameter': 0.1},
+                      'dirichlet': {'parameter': 50}}
+MAX_BODY_SIZE = 16 * 1024 * 1024
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+'''
+Worker pool with read-only worker state
+    - the index and engines are attached once per worker by the pool
+      initializer instead of being pickled with every task; with the fork
+      start method they are inherited from the server process without copying
+    - tasks only carry their own arguments (a query) and read the shared
+      structures from worker_state
+'''
+worker_state = {}
+
+
+def set_worker_state(state):
+    worker_state.clear()
+    worker_state.update(state)
+
+
+def get_worker_pool(state, max_workers=4):
+    # Also set the state in the parent, so forked workers inherit it and
+    # task functions can be called directly without a pool
+    set_worker_state(state)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                  initializer=set_worker_state,
+                                                  initargs=(state,))
+
+
+def worker_ready():
+    return True
+
+
+def start_workers(executor, max_workers):
+    # Workers are started on the first tasks, start them all now (e.g. before
+    # opening sockets they must not inherit)
+    concurrent.futures.wait([executor.submit(worker_ready) for _ in range(max_workers)])
+
+
+def get_worker_index():
+    # Engines built on an index that was updated since are dropped
+    inverted_index = open_inverted_index(worker_state['index_path'])
+    if worker_state.get('inverted_index') is not inverted_index:
+        worker_state['inverted_index'] = inverted_index
+        worker_state['tf_idf_engine'] = None
+    return inverted_index
+
+
+def get_tf_idf_engine():
+    inverted_index = get_worker_index()
+    if worker_state['tf_idf_engine'] is None:
+        worker_state['tf_idf_engine'] = TfIdfEngine(inverted_index)
+    return worker_state['tf_idf_engine']
+
+
+def get_parameters(model, request):
+    if model not in DEFAULT_PARAMETERS:
+        raise ValueError('Unknown model: %s' % model)
+    parameters = dict(DEFAULT_PARAMETERS[model])
+    for name in parameters:
+        if name in request:
+            parameters[name] = float(request[name])
+    return parameters
+
+
+def rank_candidates(model, parameters, query_term_frequency, candidates, k):
+    inverted_index = get_worker_index()
+    if model == 'bm25':
+        scores = BM25Engine(inverted_index, **parameters).score(query_term_frequency, candidates)
+    elif model == 'tfidf':
+        scores = get_tf_idf_engine().score([query_term_frequency], [candidates])[0]
+    else:
+        scores = QueryLikelihoodEngine(inverted_index, [(model, parameters.get('parameter'))]).score(query_term_frequency, candidates)[0]
+    order = top_k(scores, k)
+    return candidates[order], scores[order]
+
+
+def rank_collection(model, parameters, query_term_frequency, k):
+    inverted_index = get_worker_index()
+    if model == 'tfidf':
+        # Only passages sharing a term with the query have a non-null
+        # similarity, the others follow in docid order
+        tf_idf_engine = get_tf_idf_engine()
+        similarities = (tf_idf_engine.get_queries_matrix([query_term_frequency]) @ tf_idf_engine.passages_tf_idf.T).tocsr()
+        docs, scores = similarities.indices, similarities.data
+        order = np.lexsort((docs, -scores))[:k]
+        docs, scores = docs[order], scores[order]
+        if len(docs) < k:
+            others = np.setdiff1d(np.arange(min(len(inverted_index.doc_pids), k + len(similarities.indices))), similarities.indices)
+            others = others[:k - len(docs)]
+            docs, scores = np.concatenate((docs, others)), np.concatenate((scores, np.zeros(len(others))))
+        return inverted_index.get_pids(docs), scores
+    if model == 'bm25':
+        retrieval_model = BM25Model(inverted_index, **parameters)
+    else:
+        retrieval_model = QueryLikelihoodModel(inverted_index, model, parameters.get('parameter'))
+    return MaxScoreRetriever(inverted_index, retrieval_model).retrieve(query_term_frequency, k=k)
+
+
+def normalize_query(query):
+    # Worker task: normalized terms of a query and their frequencies
+    return get_queries_term_frequencies(worker_state['remove_stopwords'], [str(query)])[0]
+
+
+def rank(request, query_term_frequency):
+    # Worker task: ranking of one normalized query
+    model = request.get('model', 'bm25')
+    parameters = get_parameters(model, request)
+    k = int(request.get('k', 100))
+    if request.get('candidates') is not None:
+        candidates = np.asarray(request['candidates'], dtype=np.int64)
+        pids, scores = rank_candidates(model, parameters, query_term_frequency, candidates, k)
+    else:
+        pids, scores = rank_collection(model, parameters, query_term_frequency, k)
+    return {'pids': np.asarray(pids).tolist(), 'scores': np.asarray(scores, dtype=np.float64).tolist()}
+
+
+def get_index_statistics():
+    inverted_index = get_worker_index()
+    return {'generation': inverted_index.generation, 'no_terms': len(inverted_index),
+            'no_passages': inverted_index.no_passages, 'avg_dl': float(inverted_index.avg_dl)}
+
+
+class RetrievalService:
+    def __init__(self, index_path, remove_stopwords, max_workers=4, tf_idf=True, max_cached_rankings=10000):
+        self.index_path = index_path
+        self.remove_stopwords = remove_stopwords
+        self.max_workers = max_workers
+        self.no_queries = 0
+        self.start_time = time.time()
+        self.ranking_cache = RankingCache(max_cached_rankings)
+
+        # Load the index and statistics once, forked workers inherit them
+        set_worker_state({'index_path': index_path, 'remove_stopwords': remove_stopwords})
+        get_worker_index()
+        if tf_idf:
+            get_tf_idf_engine()
+        self.executor = get_worker_pool(dict(worker_state), max_workers)
+        # Fork the workers before the server sockets exist, so they hold no
+        # listening or client socket
+        start_workers(self.executor, max_workers)
+
+    async def handle_request(self, method, target, body):
+        loop = asyncio.get_running_loop()
+        if method == 'GET' and target == '/health':
+            statistics = get_index_statistics()
+            statistics.update({'no_queries': self.no_queries, 'uptime': time.time() - self.start_time,
+                               'ranking_cache': self.ranking_cache.statistics()})
+            return 200, statistics
+        if method != 'POST' or target != '/rank':
+            return 404, {'error': 'Unknown endpoint: %s %s' % (method, target)}
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict) or 'query' not in request:
+                raise ValueError('The body must be a JSON object with a query')
+            get_parameters(request.get('model', 'bm25'), request)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        try:
+            # Queries normalizing to the same terms share their cached rankings
+            query_term_frequency = await loop.run_in_executor(self.executor, normalize_query, request['query'])
+            model = request.get('model', 'bm25')
+            key = get_ranking_key(model, get_parameters(model, request), query_term_frequency,
+                                  request.get('candidates'), int(request.get('k', 100)))
+            inverted_index = get_worker_index()
+            result = self.ranking_cache.get(inverted_index, key)
+            if result is None:
+                result = await loop.run_in_executor(self.executor, rank, request, query_term_frequency)
+                self.ranking_cache.put(inverted_index, key, result)
+        except Exception as e:
+            # Unknown candidate pids, malformed parameters...
+            return 400, {'error': str(e)}
+        self.no_queries += 1
+        return 200, result
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.write_response(writer, 400, {'error': 'Malformed request line'}, False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                try:
+                    content_length = int(headers.get('content-length', 0))
+                except ValueError:
+                    content_length = -1
+                if content_length < 0:
+                    await self.write_response(writer, 400, {'error': 'Malformed Content-Length'}, False)
+                    break
+                if content_length > MAX_BODY_SIZE:
+                    await self.write_response(writer, 413, {'error': 'Request body too large'}, False)
+                    break
+                body = await reader.readexactly(content_length) if content_length else b''
+                try:
+                    status, payload = await self.handle_request(method, target, body)
+                except Exception as e:
+                    status, payload = 500, {'error': str(e)}
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def write_response(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode('utf-8')
+        writer.write(('HTTP/1.1 %s %s\r\nContent-Type: application/json\r\nContent-Length: %s\r\nConnection: %s\r\n\r\n'
+                      % (status, HTTP_REASONS[status], len(body), 'keep-alive' if keep_alive else 'close')).encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8000, socket_path=None):
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+            print("Serving %s on %s" % (self.index_path, socket_path))
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print("Serving %s on http://%s:%s" % (self.index_path, host, port))
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    # Index computed in Task 2
+    remove_stopwords = True
+    service = RetrievalService(get_index_path(remove_stopwords), remove_stopwords, max_workers=4)
+
+    # Set socket_path to serve on a Unix socket instead of TCP
+    socket_path = None
+    try:
+        asyncio.run(service.serve(host='127.0.0.1', port=8000, socket_path=socket_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
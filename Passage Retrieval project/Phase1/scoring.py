@@ -0,0 +1,155 @@
+from collections import Counter
+from math import log
+import numpy as np
+from scipy import sparse
+from task1 import get_passages_vocabularies
+
+
+'''
+Vectorized scoring engines over the binary inverted index
+    - queries are tokenized once, in nlp.pipe batches
+    - scores of all query-candidate pairs are computed with array operations
+'''
+def get_queries_term_frequencies(remove_stopwords, queries_text):
+    return [Counter(vocabulary) for vocabulary in get_passages_vocabularies(remove_stopwords, list(queries_text))]
+
+
+'''
+TF-IDF cosine similarity
+    - passages are the rows of a CSR matrix of L2-normalised TF-IDF vectors,
+      with TF normalised by the passage length and IDF = log10(N / df)
+    - queries are the rows of a second CSR matrix built the same way
+    - scores are the sparse product of the two matrices, restricted to the
+      candidate passages and masked to the query-candidate pairs
+'''
+class TfIdfEngine:
+    def __init__(self, inverted_index):
+        self.inverted_index = inverted_index
+        no_docs = len(inverted_index.doc_pids)
+        self.idf = np.log10(inverted_index.no_passages / np.maximum(inverted_index.dfs(), 1))
+
+        # Row d of the passage matrix is the forward index row of the passage
+        # with docid d, no transpose of the postings is needed
+        row_offsets, term_ids, tfs = inverted_index.get_forward_postings(np.arange(no_docs))
+        row_lengths = np.diff(row_offsets)
+        doc_lengths = np.repeat(np.asarray(inverted_index.doc_lengths, dtype=np.float64), row_lengths)
+        norms = np.repeat(np.asarray(inverted_index.tf_idf_norms), row_lengths)
+        data = tfs / doc_lengths * self.idf[term_ids] / norms
+        self.passages_tf_idf = sparse.csr_matrix((data, term_ids, row_offsets), shape=(no_docs, len(inverted_index)))
+
+    def get_queries_matrix(self, queries_term_frequency):
+        rows, cols, data = [], [], []
+        for row, query_term_frequency in enumerate(queries_term_frequency):
+            no_query_terms = sum(query_term_frequency.values())
+            for term, tf in query_term_frequency.items():
+                term_id = self.inverted_index.term_ids.get(term)
+                if term_id is not None:
+                    rows.append(row)
+                    cols.append(term_id)
+                    data.append(tf / no_query_terms * self.idf[term_id])
+        queries_tf_idf = sparse.csr_matrix((data, (rows, cols)), shape=(len(queries_term_frequency), len(self.inverted_index)))
+        # L2-normalise rows, queries without known terms get null scores
+        norms = np.sqrt(np.asarray(queries_tf_idf.multiply(queries_tf_idf).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms) @ queries_tf_idf
+
+    def score(self, queries_term_frequency, queries_candidates):
+        queries_tf_idf = self.get_queries_matrix(queries_term_frequency)
+
+        # Restrict the passage matrix to the candidate passages
+        candidates_docs = [self.inverted_index.get_docids(candidate_passages) for candidate_passages in queries_candidates]
+        docs = np.unique(np.concatenate(candidates_docs)) if candidates_docs else np.empty(0, dtype=np.int64)
+        similarities = (queries_tf_idf @ self.passages_tf_idf[docs].T).tocsr()
+
+        # Mask the product to the candidates of each query
+        query_rows = np.repeat(np.arange(len(queries_candidates)), [len(c) for c in candidates_docs])
+        doc_cols = np.searchsorted(docs, np.concatenate(candidates_docs)) if candidates_docs else docs
+        scores = np.asarray(similarities[query_rows, doc_cols]).ravel()
+        return np.split(scores, np.cumsum([len(c) for c in candidates_docs])[:-1])
+
+
+'''
+BM25 (term-at-a-time)
+    - candidates are mapped to sorted unique docids once per query
+    - the frequencies of all query terms in the candidates are read at once
+      from the forward index rows of the candidates
+    - the RSJ weight of a term is computed once per query, with ri the number
+      of candidates containing the term and R the number of candidates
+    - the contribution of each query term is added to a score accumulator
+      indexed by candidate position
+'''
+class BM25Engine:
+    def __init__(self, inverted_index, k1=1.2, k2=100, b=0.75):
+        self.inverted_index = inverted_index
+        self.k1 = k1
+        self.k2 = k2
+        self.b = b
+
+    def score(self, query_term_frequency, candidate_passages):
+        k1, k2, b = self.k1, self.k2, self.b
+        N = self.inverted_index.no_passages
+        R = len(candidate_passages)
+        # Sorted unique candidate docids, candidate i is candidate_docids[inverse[i]]
+        candidate_docids, inverse = np.unique(self.inverted_index.get_docids(candidate_passages), return_inverse=True)
+        dl = self.inverted_index.get_doc_lengths(candidate_docids)[inverse]
+        K = k1 * ((1 - b) + b * dl / self.inverted_index.avg_dl)
+
+        scores = np.zeros(R)
+        terms = [term for term in query_term_frequency if self.inverted_index.df(term) > 0]
+        candidates_tfs = self.inverted_index.get_term_frequency_matrix(terms, candidate_docids)
+        for term, candidate_tfs in zip(terms, candidates_tfs):
+            qfi = query_term_frequency[term]
+            ni = self.inverted_index.df(term)
+            ri = int(np.count_nonzero(candidate_tfs))
+            fi = candidate_tfs[inverse]
+
+            rsj_weight = log(((ri + 0.5) / (R - ri + 0.5)) / ((ni - ri + 0.5) / (N - ni - R + ri + 0.5)))
+            scores += (rsj_weight 
+                       * (((k1 + 1) * fi) / (K + fi)) 
+                       * (((k2 + 1) * qfi) / (k2 + qfi)))
+        return scores
+
+
+'''
+Query likelihood language models
+    - the query is tokenized once and the frequencies of its terms in the
+      candidates are gathered once from their forward index rows, in a
+      (query terms x candidates) matrix
+    - every smoothing model of the list is evaluated on that matrix with array
+      expressions, so a parameter sweep does not re-read the index
+    - models are (smoothing, parameter) pairs:
+        ('laplace', None): log((tf + 1) / (|D| + |V|))
+        ('lidstone', epsilon): log((tf + epsilon) / (|D| + epsilon * |V|))
+        ('dirichlet', miu): log((tf + miu * cf / |C|) / (|D| + miu)),
+      with cf floored to 1 for terms missing from the collection
+'''
+class QueryLikelihoodEngine:
+    def __init__(self, inverted_index, models):
+        self.inverted_index = inverted_index
+        self.models = list(models)
+        self.v_len = len(inverted_index)
+        for smoothing, _ in self.models:
+            if smoothing not in ('laplace', 'lidstone', 'dirichlet'):
+                raise ValueError('Unknown smoothing: %s' % smoothing)
+
+    def score(self, query_term_frequency, candidate_passages):
+        # Returns a (models x candidates) array of scores
+        candidate_docids, inverse = np.unique(self.inverted_index.get_docids(candidate_passages), return_inverse=True)
+        dl = self.inverted_index.get_doc_lengths(candidate_docids).astype(np.float64)
+
+        # Query term frequencies and candidates term frequencies
+        terms = list(query_term_frequency)
+        qf = np.array([query_term_frequency[term] for term in terms], dtype=np.float64)
+        tf = self.inverted_index.get_term_frequency_matrix(terms, candidate_docids)
+        cf = np.maximum([self.inverted_index.cf(term) for term in terms], 1).astype(np.float64)
+
+        scores = np.empty((len(self.models), len(candidate_docids)))
+        for row, (smoothing, parameter) in enumerate(self.models):
+            if smoothing == 'dirichlet':
+                p_c = cf / self.inverted_index.collection_size
+                term_scores = np.log((tf + parameter * p_c[:, None]) / (dl + parameter))
+            else:
+                epsilon = 1 if smoothing == 'laplace' else parameter
+                term_scores = np.log((tf + epsilon) / (dl + epsilon * self.v_len))
+            scores[row] = qf @ term_scores
+        return scores[:, inverse]
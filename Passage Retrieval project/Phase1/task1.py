@@ -1,8 +1,9 @@
 import spacy
+import atexit
 import concurrent.futures
 from string import punctuation
-import time
-from collections import Counter
+from collections import Counter, deque
+from contextlib import contextmanager
 import csv
 import re
 import matplotlib.pyplot as plt
@@ -11,6 +12,13 @@ from unidecode import unidecode
 from spacy.lang.en import stop_words
 from nltk.stem.snowball import SnowballStemmer
 from functools import partial
+from itertools import islice
+from heavy_hitters import SpaceSavingSummary
+from token_cache import TokenCache, TermCache
+from instrumentation import stage, count, instrumented, merge_task_result, print_report, save_report
+
+
+TOKEN_SPLIT_PATTERN = re.compile("!|\"|\#|\$|%|\&|'|\(|\)|\*|\+|,|\-|\.|/|:|;|<|=|>|\?|@|\[|\\\\|\]|\^|_|`|\{|\||\}|\~| |\n")
 
 
 def preprocess_passage(passage):
@@ -26,69 +34,168 @@ def preprocess_passage(passage):
     return new_passage
 
 
+CACHE_COUNTERS = ('token cache hits', 'token cache misses', 'term cache hits', 'term cache misses')
+
+
+def get_cache_lookups():
+    return (token_cache.hits, token_cache.misses, term_cache.hits, term_cache.misses)
+
+
+@contextmanager
+def counted_cache_lookups():
+    # Hits and misses of the token and term caches during the block are added
+    # to the counters of the report
+    before = get_cache_lookups()
+    try:
+        yield
+    finally:
+        for name, start, end in zip(CACHE_COUNTERS, before, get_cache_lookups()):
+            if end > start:
+                count(name, end - start)
+
+
+def flush_caches():
+    # Term cache entries of single passage calls are written in bulk, the
+    # last ones when the process exits
+    term_cache.flush()
+
+
 def get_passage_vocabulary(remove_stopwords, passage):
+    # Reuse tokens of passages (and queries) seen in previous runs
+    with counted_cache_lookups():
+        tokens = token_cache.get(remove_stopwords, passage)
+        if tokens is None:
+            tokens = tokenize_passage(remove_stopwords, passage)
+            token_cache.put(remove_stopwords, passage, tokens)
+    return tokens
+
+
+def get_passages_vocabularies(remove_stopwords, passages, batch_size=1000):
+    # Batched version of get_passage_vocabulary, uncached passages go through nlp.pipe
+    with counted_cache_lookups():
+        vocabularies = [token_cache.get(remove_stopwords, passage) for passage in passages]
+        uncached_passages = [passage for passage, tokens in zip(passages, vocabularies) if tokens is None]
+        if uncached_passages:
+            docs = tokenizer.pipe((preprocess_passage(passage) for passage in uncached_passages), batch_size=batch_size)
+            new_vocabularies = [get_doc_vocabulary(remove_stopwords, doc) for doc in docs]
+            token_cache.put_many(remove_stopwords, zip(uncached_passages, new_vocabularies))
+            term_cache.flush()
+            new_vocabularies = iter(new_vocabularies)
+            vocabularies = [tokens if tokens is not None else next(new_vocabularies) for tokens in vocabularies]
+    return vocabularies
+
+
+def tokenize_passage(remove_stopwords, passage):
     # Clean passage
     new_passage = preprocess_passage(passage)
     # Tokenize
-    global tokenizer
-    tokens = list(tokenizer(new_passage))
-    # Get lemmas of tokens
-    tokens = [token.lemma_.lower().strip(punctuation) for token in tokens if str(token) != "" and not str(token).isdigit()]
-    new_tokens = [split_token 
-                  for t in tokens 
-                  for split_token in list(filter(lambda x: x != None and x != "", re.split("!|\"|\#|\$|%|\&|'|\(|\)|\*|\+|,|\-|\.|/|:|;|<|=|>|\?|@|\[|\\\\|\]|\^|_|`|\{|\||\}|\~| |\n", t))) 
-                  if not split_token.isdigit()]
-    if remove_stopwords:
-        new_tokens = [stemmer.stem(token) for token in new_tokens if token not in stop_words.STOP_WORDS]
-    else:
-        new_tokens = [stemmer.stem(token) for token in new_tokens]
-    return new_tokens
-
-
-def get_vocabulary_and_term_freq(filename, remove_stopwords):
-    start_time = time.time()
-    task_completion_time = 0
-    with open(filename, "r") as collection:
-        pc_lines = collection.readlines()
-
-        partial_get_passage_vocabulary = partial(get_passage_vocabulary, remove_stopwords)
-        with concurrent.futures.ProcessPoolExecutor(max_workers=12) as executor:
-            pc_vocabularies = executor.map(partial_get_passage_vocabulary, pc_lines)
+    return get_doc_vocabulary(remove_stopwords, tokenizer(new_passage))
 
-        task_completion_time = time.time() - start_time
-        print("All tasks done in %s seconds" % (task_completion_time))
 
-        pc_vocabularies = list(pc_vocabularies)
-        vocabulary = [term for pc_vocab in pc_vocabularies for term in pc_vocab]
-        vocabulary = Counter(vocabulary)
+def get_doc_vocabulary(remove_stopwords, doc):
+    new_tokens = []
+    for token in doc:
+        if str(token) == "" or str(token).isdigit():
+            continue
+        new_tokens.extend(normalize_lemma(remove_stopwords, token.lemma_))
+    return new_tokens
 
-        with open('./vocabulary.csv','w') as vocabulary_f:
-            writer=csv.writer(vocabulary_f)
-            writer.writerows(sorted(vocabulary.items()))
 
-        return vocabulary
+def normalize_lemma(remove_stopwords, lemma):
+    # Split, filter and stem a lemma once, later occurrences are cache hits
+    terms = term_cache.get(remove_stopwords, lemma)
+    if terms is None:
+        terms = [split_token
+                 for split_token in TOKEN_SPLIT_PATTERN.split(lemma.lower().strip(punctuation))
+                 if split_token != "" and not split_token.isdigit()]
+        if remove_stopwords:
+            terms = [stemmer.stem(token) for token in terms if token not in stop_words.STOP_WORDS]
+        else:
+            terms = [stemmer.stem(token) for token in terms]
+        term_cache.put(remove_stopwords, lemma, terms)
+    return terms
 
 
+def read_passage_chunks(filename, chunk_size):
+    # Lines of the collection, chunk_size at a time
+    with open(filename, "r") as collection:
+        while True:
+            chunk = list(islice(collection, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def count_passages_terms(remove_stopwords, passages, batch_size=1000):
+    # Term frequencies of a chunk of passages
+    term_frequency = Counter()
+    for vocabulary in get_passages_vocabularies(remove_stopwords, passages, batch_size=batch_size):
+        term_frequency.update(vocabulary)
+    return term_frequency
+
+
+def map_term_frequencies(filename, remove_stopwords, batch_size=1000, max_workers=12):
+    # Streaming map step: each chunk of batch_size passages is counted by a
+    # worker and the per-chunk Counters are yielded in order; at most
+    # 2 * max_workers chunks are read ahead, so memory does not grow with the collection
+    partial_count_passages_terms = instrumented(partial(count_passages_terms, remove_stopwords, batch_size=batch_size), 'count chunk')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for chunk in read_passage_chunks(filename, batch_size):
+            count('passages', len(chunk))
+            pending.append(executor.submit(partial_count_passages_terms, chunk))
+            if len(pending) >= 2 * max_workers:
+                yield merge_task_result(pending.popleft().result())
+        while pending:
+            yield merge_task_result(pending.popleft().result())
+
+
+def get_vocabulary_and_term_freq(filename, remove_stopwords, batch_size=1000):
+    # Reduce step: per-chunk Counters are merged as they arrive
+    with stage('vocabulary'):
+        vocabulary = Counter()
+        for chunk_term_frequency in map_term_frequencies(filename, remove_stopwords, batch_size):
+            with stage('merge counts'):
+                vocabulary.update(chunk_term_frequency)
+
+    with stage('write vocabulary'), open('./vocabulary.csv','w') as vocabulary_f:
+        writer=csv.writer(vocabulary_f)
+        writer.writerows(sorted(vocabulary.items()))
+
+    return vocabulary
+
+
+def get_approximate_term_freq(filename, remove_stopwords, capacity=100000, batch_size=1000):
+    # Bounded-memory alternative, only the capacity most frequent terms are kept
+    with stage('approximate vocabulary'):
+        summary = SpaceSavingSummary(capacity)
+        for chunk_term_frequency in map_term_frequencies(filename, remove_stopwords, batch_size):
+            with stage('merge counts'):
+                summary.update(chunk_term_frequency)
+    print("Counts overestimated by at most %s" % (summary.min_count))
+    return summary
+
+
+@stage('plot figures')
 def plot_figs(vocabulary, filename1, filename2):
-    t = time.time()
-    # Get normalised term frequencies
+    # Get normalised term frequencies, a SpaceSavingSummary only holds the
+    # most frequent terms but knows the number of tokens and distinct terms
+    approximate = isinstance(vocabulary, SpaceSavingSummary)
     term_frequencies = list(vocabulary.values())
     term_frequencies.sort(reverse=True)
     term_frequencies = np.array(term_frequencies)
-    term_frequencies = term_frequencies / term_frequencies.sum()
+    term_frequencies = term_frequencies / (vocabulary.total if approximate else term_frequencies.sum())
     
     # Get term ranks array
     no_terms = len(term_frequencies)
     term_ranks = np.arange(1, no_terms + 1)
 
     # Get harmonic number
-    h_number = (1 / term_ranks).sum()
+    h_number = (1 / np.arange(1, (vocabulary.no_distinct_terms() if approximate else no_terms) + 1)).sum()
 
     # Get Zipf's law
     zipf_law = 1 / (h_number * term_ranks)
 
-    print("Plots computations done in", time.time() - t)
-
     # Plot Fig 1
     plt.plot(term_ranks, term_frequencies, label='Data', color='black')
     plt.plot(term_ranks, zipf_law, label="Zipf's law", color='blue', linestyle="dashed")
@@ -110,13 +217,27 @@ def plot_figs(vocabulary, filename1, filename2):
     plt.clf()
 
 
-# Initialise global tokenizer
-tokenizer = spacy.load("en_core_web_sm")
+# Initialise global tokenizer, only lemmas are used so the parser and NER are not loaded
+tokenizer = spacy.load("en_core_web_sm", exclude=["parser", "ner"])
 #Initialise global stemmer
 stemmer = SnowballStemmer(language='english')
+# Initialise global tokenization and term normalization caches
+token_cache = TokenCache()
+term_cache = TermCache()
+atexit.register(flush_caches)
 
 
 if __name__ == '__main__':
-    vocabulary = get_vocabulary_and_term_freq('./passage-collection.txt', remove_stopwords=False)
-    print("Vocabulary has %s terms." % (len(vocabulary)))
+    # Bounded-memory approximate counts of the most frequent terms instead of the whole vocabulary
+    approximate = False
+    if approximate:
+        vocabulary = get_approximate_term_freq('./passage-collection.txt', remove_stopwords=False)
+        print("Vocabulary has about %s terms." % (vocabulary.no_distinct_terms()))
+    else:
+        vocabulary = get_vocabulary_and_term_freq('./passage-collection.txt', remove_stopwords=False)
+        print("Vocabulary has %s terms." % (len(vocabulary)))
     plot_figs(vocabulary, "fig1.svg", "fig2.svg")
+
+    # Time and memory of each stage
+    print_report()
+    save_report('task1_metrics.json')
@@ -1,188 +1,105 @@
-import json
 import pandas as pd
-from math import log10, log
-from collections import defaultdict
-from task1 import get_passage_vocabulary
-from collections import Counter
-import numpy as np
-import time
-import concurrent.futures
-from functools import partial
-
-
-def get_candidates_scores_td_idf(passages_tf_idf, IDF, remove_stopwords, query):
-    # Query information
-    qid = query[0]
-    query_text = query[1]
-    candidate_passages = query[2]
-
-    # Compute query normalised TF
-    query_term_frequency = dict(Counter(get_passage_vocabulary(remove_stopwords, query_text)))
-    query_term_frequency = {term: query_term_frequency[term] / sum(query_term_frequency.values())
-                            for term in query_term_frequency}
-    
-    # Compute query TF-IDF
-    query_tf_idf = {term: query_term_frequency[term] * IDF[term] 
-                    for term in query_term_frequency if term in IDF}
-
-    # Get query terms set
-    query_terms = set(query_tf_idf.keys())
-    # Get query TF-IDF representation norm
-    q_norm = np.linalg.norm(np.array(list(query_tf_idf.values())))
-
-    # Get passage scores
-    scores = {}
-    for pid in candidate_passages:
-        passage_tf_idf = passages_tf_idf[pid]
-        # Get passage TF-IDF representation norm
-        p_norm = np.linalg.norm(np.array(list(passage_tf_idf.values())))
-        # Get common words between query and passage
-        common_terms = query_terms.intersection(set(passage_tf_idf.keys()))
-        # Get cosine similarity
-        q_common_terms = np.array([query_tf_idf[t] for t in common_terms])
-        p_common_terms = np.array([passage_tf_idf[t] for t in common_terms])
-        scores[pid] = np.dot(q_common_terms, p_common_terms) / (q_norm * p_norm)
-    
-    # Get 100 most relevant passages
-    scores = {k: v for k, v in sorted(scores.items(), key = lambda item: item[1], reverse=True)}
-    scores = list(scores.items())[:100]
-    scores = [[qid] + list(tup) for tup in scores]
-    return scores
-
-
-def tf_idf_cosine_similarity(queries, inverted_index, no_passages, 
-                             transposed_inverted_index, remove_stopwords):
-    # Compute IDF
-    IDF = {term : log10(no_passages / len(inverted_index[term])) 
-           for term in inverted_index}
-    
-    # Passages normalised TF
-    passages_tf = {pid: {term: transposed_inverted_index[pid][term] / sum(transposed_inverted_index[pid].values())
-                         for term in transposed_inverted_index[pid]} 
-                         for pid in transposed_inverted_index}
-
-    # Passages TF-IDF
-    passages_tf_idf = {pid: {term: passages_tf[pid][term] * IDF[term] 
-                             for term in passages_tf[pid]} 
-                             for pid in passages_tf}
-    
-    # Get results for each query in parallel
-    start_time = time.time()
-    queries_list = queries.values.tolist()
-    partial_tf_idf_cosine_similarity = partial(get_candidates_scores_td_idf, 
-                                               passages_tf_idf, IDF, 
-                                               remove_stopwords)
-    with concurrent.futures.ProcessPoolExecutor(max_workers=12) as executor:
-            tf_idf_cos_sim_results = executor.map(partial_tf_idf_cosine_similarity, 
-                                                  queries_list)
-    task_completion_time = time.time() - start_time
-    print("TF-IDF: All tasks done in %s seconds" % (task_completion_time))
+from inverted_index import get_index_path, open_inverted_index
+from scoring import TfIdfEngine, BM25Engine, get_queries_term_frequencies
+from topk import get_ranking
+from retrieval import MaxScoreRetriever, BM25Model
+from dataset_cache import load_dataset
+from instrumentation import stage, latency, print_report, save_report
+
+
+@stage('tfidf')
+def tf_idf_cosine_similarity(queries, inverted_index, remove_stopwords):
+    # Build the passages TF-IDF matrix
+    with stage('engine build'):
+        tf_idf_engine = TfIdfEngine(inverted_index)
+
+    # Score all queries at once
+    with stage('tokenize queries'):
+        queries_term_frequency = get_queries_term_frequencies(remove_stopwords, queries['query'])
+    with stage('score'):
+        queries_scores = tf_idf_engine.score(queries_term_frequency, queries['candidates'].tolist())
+
+    # Get 100 most relevant passages for each query
+    with stage('top-k'):
+        tf_idf_cos_sim_results = [get_ranking(qid, candidate_passages, scores)
+                                  for qid, candidate_passages, scores
+                                  in zip(queries['qid'].tolist(), queries['candidates'].tolist(), queries_scores)]
 
     # Save results in tfidf.csv
-    tf_idf_cos_sim_results = [result_df_entry 
-                              for query_lvl_entries in tf_idf_cos_sim_results 
-                              for result_df_entry in query_lvl_entries]
-    tf_idf_cos_sim_df = pd.DataFrame(tf_idf_cos_sim_results, 
-                                     columns = ['qid', 'pid', 'score'])
-    tf_idf_cos_sim_df.to_csv('tfidf.csv', sep=',', index=False, header=False)
-
-
-def get_candidates_scores_bm25(inverted_index, transposed_inverted_index, avg_dl, N, remove_stopwords, query):
-    # BM25 parameters
-    k1 = 1.2
-    k2 = 100
-    b = 0.75
-    
-    # Query information
-    qid = query[0]
-    query_text = query[1]
-    candidate_passages = query[2]
-
-    # Tokenise queries and get term frequencies
-    query_term_frequency = dict(Counter(get_passage_vocabulary(remove_stopwords, query_text)))
-
-    # Compute BM25 parameters
-    R = len(candidate_passages)
-    ri_query = {term: len(set([int(pid) for pid in list(inverted_index.get(term, {}).keys())]).intersection(set(candidate_passages)))
-                for term in query_term_frequency}
-    ni_query = {term: len(inverted_index.get(term, {}))
-                for term in query_term_frequency}
-    
-    scores = {}
-    for pid in candidate_passages:
-        # Get passage length
-        passage_term_frequency = transposed_inverted_index[pid]
-        dl = sum(list(passage_term_frequency.values()))
-
-        # Get BM25 score
-        K = k1 * ((1 - b) + b * dl / avg_dl)
-        score = 0
-        for term in query_term_frequency:
-            ni = ni_query[term]
-            qfi = query_term_frequency[term]
-            ri = ri_query[term]
-            fi = passage_term_frequency.get(term, 0)
-            score += (log(((ri + 0.5) / (R - ri + 0.5)) / ((ni - ri + 0.5) / (N - ni - R + ri + 0.5))) 
-                      * (((k1 + 1) * fi) / (K + fi)) 
-                      * (((k2 + 1) * qfi) / (k2 + qfi)))
-        scores[pid] = score
-    
-    # Get 100 most relevant passages
-    scores = {k: v for k, v in sorted(scores.items(), key = lambda item: item[1], reverse=True)}
-    scores = list(scores.items())[:100]
-    scores = [[qid] + list(tup) for tup in scores]
-    return scores
-
-
-def bm25(queries, inverted_index, no_passages, transposed_inverted_index, remove_stopwords):
-    # Get BM25 parameters
-    N = no_passages
-    avg_dl = sum([sum(list(transposed_inverted_index[pid].values())) for pid in transposed_inverted_index]) / no_passages
-    
-    # Get results for each query in parallel
-    start_time = time.time()
-    queries_list = queries.values.tolist()
-    partial_bm25 = partial(get_candidates_scores_bm25, inverted_index, transposed_inverted_index, avg_dl, N, remove_stopwords)
-    with concurrent.futures.ProcessPoolExecutor(max_workers=12) as executor:
-            bm25_results = executor.map(partial_bm25, queries_list)
-    
-    task_completion_time = time.time() - start_time
-    print("BM25: All tasks done in %s seconds" % (task_completion_time))
+    with stage('write csv'):
+        tf_idf_cos_sim_results = [result_df_entry 
+                                  for query_lvl_entries in tf_idf_cos_sim_results 
+                                  for result_df_entry in query_lvl_entries]
+        tf_idf_cos_sim_df = pd.DataFrame(tf_idf_cos_sim_results, 
+                                         columns = ['qid', 'pid', 'score'])
+        tf_idf_cos_sim_df.to_csv('tfidf.csv', sep=',', index=False, header=False)
+
+
+@stage('bm25')
+def bm25(queries, inverted_index, remove_stopwords):
+    # BM25 parameters, passage statistics are precomputed in the index
+    bm25_engine = BM25Engine(inverted_index, k1=1.2, k2=100, b=0.75)
+
+    # Tokenise queries and score their candidates
+    with stage('tokenize queries'):
+        queries_term_frequency = get_queries_term_frequencies(remove_stopwords, queries['query'])
+    bm25_results = []
+    with stage('score and rank'):
+        for qid, candidate_passages, query_term_frequency in zip(queries['qid'].tolist(), queries['candidates'].tolist(), queries_term_frequency):
+            with latency('bm25 query'):
+                bm25_results.append(get_ranking(qid, candidate_passages, bm25_engine.score(query_term_frequency, candidate_passages)))
 
     # Save results in bm25.csv
-    bm25_results = [result_df_entry for query_lvl_entries in bm25_results for result_df_entry in query_lvl_entries]
-    bm25_df = pd.DataFrame(bm25_results, columns = ['qid', 'pid', 'score'])
-    bm25_df.to_csv('bm25.csv', sep=',', index=False, header=False)
+    with stage('write csv'):
+        bm25_results = [result_df_entry for query_lvl_entries in bm25_results for result_df_entry in query_lvl_entries]
+        bm25_df = pd.DataFrame(bm25_results, columns = ['qid', 'pid', 'score'])
+        bm25_df.to_csv('bm25.csv', sep=',', index=False, header=False)
+
+
+@stage('bm25 full collection')
+def bm25_full_collection(queries, inverted_index, remove_stopwords):
+    # First-stage retrieval over all passages of the index, with MaxScore pruning
+    retriever = MaxScoreRetriever(inverted_index, BM25Model(inverted_index, k1=1.2, k2=100, b=0.75))
+
+    # Tokenise queries and retrieve their 100 most relevant passages
+    with stage('tokenize queries'):
+        queries_term_frequency = get_queries_term_frequencies(remove_stopwords, queries['query'])
+    bm25_results = []
+    with stage('retrieve'):
+        for qid, query_term_frequency in zip(queries['qid'].tolist(), queries_term_frequency):
+            with latency('bm25 full collection query'):
+                pids, scores = retriever.retrieve(query_term_frequency, k=100)
+            bm25_results.extend([qid, pid, score] for pid, score in zip(pids.tolist(), scores.tolist()))
+
+    # Save results in bm25_full_collection.csv
+    with stage('write csv'):
+        bm25_df = pd.DataFrame(bm25_results, columns = ['qid', 'pid', 'score'])
+        bm25_df.to_csv('bm25_full_collection.csv', sep=',', index=False, header=False)
 
 
 if __name__ == '__main__':
-    # Get passages
-    candidate_passages_df = pd.read_csv('candidate-passages-top1000.tsv', sep='\t', header=None, names=['qid', 'pid', 'query', 'passage'])
-    passages = candidate_passages_df.drop(columns=['qid', 'query'])
-    passages.drop_duplicates(inplace=True)
-    no_passages = len(passages)
-    
-    # Get queries and their candidates
-    queries = pd.read_csv('test-queries.tsv', sep='\t', header=None, names=['qid', 'query'])
-    query_passage_mapping = candidate_passages_df.drop(columns=['query', 'passage'])
-    query_passage_mapping = query_passage_mapping.groupby('qid')['pid'].apply(list)
-    queries['candidates'] = query_passage_mapping[queries['qid']].values
+    with stage('read queries'):
+        # Get passages, only their qid and pid columns are read
+        dataset = load_dataset('candidate-passages-top1000.tsv', header=None, names=['qid', 'pid', 'query', 'passage'])
+
+        # Get queries and their candidates
+        queries = pd.read_csv('test-queries.tsv', sep='\t', header=None, names=['qid', 'query'])
+        queries['candidates'] = dataset.get_candidates_lists(queries['qid'])
 
     # Read inverted index computed in Task 2
     remove_stopwords = True
-    if remove_stopwords:
-        with open('inverted_index_no_stopwords.json') as inverted_index_json:
-            inverted_index = json.load(inverted_index_json)
-    else:
-        with open('inverted_index.json') as inverted_index_json:
-            inverted_index = json.load(inverted_index_json)
-
-    # Transpose inverted index
-    transposed_inverted_index = defaultdict(dict)
-    for term in inverted_index:
-        for pid in inverted_index[term]:
-            transposed_inverted_index[int(pid)].update({term : inverted_index[term][pid]})
+    with stage('open index'):
+        inverted_index = open_inverted_index(get_index_path(remove_stopwords))
 
     # Solve task
-    tf_idf_cosine_similarity(queries, inverted_index, no_passages, transposed_inverted_index, remove_stopwords)
-    bm25(queries, inverted_index, no_passages, transposed_inverted_index, remove_stopwords)
+    tf_idf_cosine_similarity(queries, inverted_index, remove_stopwords)
+    bm25(queries, inverted_index, remove_stopwords)
+
+    # First-stage retrieval over the whole collection instead of re-ranking the candidates
+    full_collection = False
+    if full_collection:
+        bm25_full_collection(queries, inverted_index, remove_stopwords)
+
+    # Time and memory of each stage
+    print_report()
+    save_report('task3_metrics.json')
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+
+
+'''
+Persistent tokenization cache
+    - entries are keyed on the hash of the raw passage text and on the
+      preprocessing variant (remove_stopwords, tokenizer version)
+    - entries are stored in a SQLite file shared by all scripts and worker
+      processes, with an in-memory LRU in front of it; the file is
+      token_cache.sqlite in the working directory (next to the data files
+      the scripts read) unless the TOKEN_CACHE_PATH environment variable
+      gives another path
+'''
+# Bump when get_passage_vocabulary or the stored format changes, older
+# entries are then ignored
+TOKENIZER_VERSION = 2
+DEFAULT_CACHE_FILE = 'token_cache.sqlite'
+
+
+def get_cache_path(path=None):
+    return os.path.abspath(path or os.environ.get('TOKEN_CACHE_PATH') or DEFAULT_CACHE_FILE)
+
+
+def get_passage_hash(passage):
+    return hashlib.blake2b(passage.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class TokenCache:
+    def __init__(self, path=None, max_memory_entries=100000):
+        self.path = get_cache_path(path)
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.connection_pid = None
+
+    def get_connection(self):
+        # SQLite connections can not be shared with forked workers
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS tokens ('
+                                    'hash TEXT, remove_stopwords INTEGER, version INTEGER, tokens TEXT, '
+                                    'PRIMARY KEY (hash, remove_stopwords, version))')
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def remember(self, key, tokens):
+        self.memory[key] = tokens
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, remove_stopwords, passage):
+        key = (get_passage_hash(passage), bool(remove_stopwords))
+        tokens = self.memory.get(key)
+        if tokens is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return list(tokens)
+        row = self.get_connection().execute('SELECT tokens FROM tokens WHERE hash = ? AND remove_stopwords = ? AND version = ?',
+                                            (key[0], int(key[1]), TOKENIZER_VERSION)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        tokens = json.loads(row[0])
+        self.remember(key, tokens)
+        return list(tokens)
+
+    def put(self, remove_stopwords, passage, tokens):
+        self.put_many(remove_stopwords, [(passage, tokens)])
+
+    def put_many(self, remove_stopwords, passages_tokens):
+        rows = []
+        for passage, tokens in passages_tokens:
+            key = (get_passage_hash(passage), bool(remove_stopwords))
+            self.remember(key, list(tokens))
+            rows.append((key[0], int(key[1]), TOKENIZER_VERSION, json.dumps(tokens)))
+        connection = self.get_connection()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)', rows)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+
+'''
+Persistent term normalization cache
+    - maps a lemma to the terms it normalizes to (punctuation split, digit
+      and stopword filtering, stemming); the mapping only depends on the
+      lemma, and lemmas repeat heavily, so most tokens are a dictionary hit
+    - lookups are in-memory only: the most recently used entries of the
+      SQLite table are loaded once per process and new entries are written
+      in bulk by flush(), called by batched callers and once flush_size new
+      entries are pending
+'''
+class TermCache:
+    def __init__(self, path=None, max_entries=500000, flush_size=10000):
+        self.path = get_cache_path(path)
+        self.max_entries = max_entries
+        self.flush_size = flush_size
+        self.memory = OrderedDict()
+        self.new_entries = []
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.connection_pid = None
+
+    def get_connection(self):
+        # SQLite connections can not be shared with forked workers
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS terms ('
+                                    'lemma TEXT, remove_stopwords INTEGER, version INTEGER, terms TEXT, '
+                                    'PRIMARY KEY (lemma, remove_stopwords, version))')
+            self.connection_pid = os.getpid()
+            # Forked workers inherit the memory of the parent instead
+            if not self.memory:
+                self.load()
+        return self.connection
+
+    def load(self):
+        rows = self.connection.execute('SELECT lemma, remove_stopwords, terms FROM terms WHERE version = ? '
+                                       'ORDER BY rowid DESC LIMIT ?', (TOKENIZER_VERSION, self.max_entries)).fetchall()
+        for lemma, remove_stopwords, terms in reversed(rows):
+            self.memory[(bool(remove_stopwords), lemma)] = tuple(json.loads(terms))
+
+    def get(self, remove_stopwords, lemma):
+        if self.connection_pid != os.getpid():
+            self.get_connection()
+        key = (bool(remove_stopwords), lemma)
+        terms = self.memory.get(key)
+        if terms is None:
+            self.misses += 1
+            return None
+        self.memory.move_to_end(key)
+        self.hits += 1
+        return terms
+
+    def put(self, remove_stopwords, lemma, terms):
+        key = (bool(remove_stopwords), lemma)
+        self.memory[key] = tuple(terms)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+        self.new_entries.append((lemma, int(remove_stopwords), TOKENIZER_VERSION, json.dumps(list(terms))))
+        if len(self.new_entries) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.new_entries:
+            return
+        connection = self.get_connection()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO terms VALUES (?, ?, ?, ?)', self.new_entries)
+        self.new_entries = []
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+'''
+Top-k ranking kernel shared by all rankers
+    - the k highest scores are selected with np.argpartition and only those
+      are sorted
+    - ties are broken deterministically by position (the earlier item ranks
+      first), NaN scores rank last
+'''
+def top_k(scores, k=100):
+    # Indices of the k highest scores, highest first
+    scores = np.asarray(scores, dtype=np.float64)
+    n = len(scores)
+    keys = np.where(np.isnan(scores), -np.inf, scores)
+    if k is None or k >= n:
+        return np.argsort(-keys, kind='stable')
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    # Select the k-th highest score, keep everything above it and the
+    # earliest items equal to it
+    threshold = keys[np.argpartition(-keys, k - 1)[k - 1]]
+    above = np.flatnonzero(keys > threshold)
+    ties = np.flatnonzero(keys == threshold)[:k - len(above)]
+    selected = np.concatenate((above, ties))
+    return selected[np.lexsort((selected, -keys[selected]))]
+
+
+def get_ranking(qid, candidate_passages, scores, k=100):
+    # [[qid, pid, score]] for the k most relevant candidates
+    order = top_k(scores, k)
+    pids = np.asarray(candidate_passages)[order].tolist()
+    scores = np.asarray(scores)[order].tolist()
+    return [[qid, pid, score] for pid, score in zip(pids, scores)]
+
+
+def top_k_groups(scores, group_offsets, k=100):
+    # Top-k of each group of a flat array, group g is [group_offsets[g], group_offsets[g + 1])
+    # Returns the selected indices (grouped, best first) and their ranks (from 1)
+    indices = []
+    ranks = []
+    for start, end in zip(group_offsets[:-1], group_offsets[1:]):
+        order = top_k(scores[start:end], k)
+        indices.append(order + start)
+        ranks.append(np.arange(1, len(order) + 1))
+    if not indices:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(indices), np.concatenate(ranks)
+
+
+def top_k_by_qid(qids, scores, k=100):
+    # Top-k of each query for flat (qid, pid, score) arrays in any order
+    # Returns indices into the input arrays, sorted by qid then rank, and the ranks
+    qids = np.asarray(qids)
+    by_qid = np.argsort(qids, kind='stable')
+    _, group_starts = np.unique(qids[by_qid], return_index=True)
+    group_offsets = np.append(group_starts, len(qids))
+    indices, ranks = top_k_groups(np.asarray(scores, dtype=np.float64)[by_qid], group_offsets, k)
+    return by_qid[indices], ranks
@@ -1,25 +1,209 @@
 import numpy as np
+import pandas as pd
+
+'''
+Groupwise evaluation engine
+    - the ranking is sorted once, by qid and by decreasing score (ties keep
+      their input order), and every query is a contiguous group given by
+      its offsets
+    - per-query metrics are sums over the groups (np.add.reduceat) of
+      per-row values derived from in-group ranks and cumulative sums of the
+      relevancy, so all queries are evaluated together in O(N log N)
+    - relevancy values are gains (NDCG, AP weights); a row is relevant for
+      P@k, Recall@k and MRR when its relevancy is positive
+    - queries without relevant passages score 0 on every metric
+'''
+class RankedGroups:
+    def __init__(self, qids, scores, relevancy):
+        qids = np.asarray(qids)
+        order = np.lexsort((-np.asarray(scores, dtype=np.float64), qids))
+        sorted_qids = qids[order]
+        self.relevancy = np.asarray(relevancy, dtype=np.float64)[order]
+        self.starts = np.flatnonzero(np.r_[True, sorted_qids[1:] != sorted_qids[:-1]]) if len(qids) else np.empty(0, dtype=np.int64)
+        self.qids = sorted_qids[self.starts]
+        self.lengths = np.diff(np.r_[self.starts, len(qids)])
+        # Rank of each row in its query, from 1
+        self.ranks = np.arange(1, len(qids) + 1) - np.repeat(self.starts, self.lengths)
+        self.discounts = 1 / np.log2(self.ranks + 1)
+        self.relevant = self.relevancy > 0
+        self._ideal_relevancy = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def group_sums(self, values):
+        if len(self.starts) == 0:
+            return np.empty(0)
+        return np.add.reduceat(values, self.starts)
+
+    def group_cumsums(self, values):
+        # Cumulative sums restarted at each query
+        cumsums = np.cumsum(values)
+        return cumsums - np.repeat(cumsums[self.starts] - values[self.starts], self.lengths)
+
+    @staticmethod
+    def safe_divide(numerators, denominators):
+        return np.divide(numerators, denominators, out=np.zeros(len(numerators)), where=denominators > 0)
+
+    @property
+    def ideal_relevancy(self):
+        # Relevancy of each query sorted in decreasing order, for the IDCG
+        if self._ideal_relevancy is None:
+            group_ids = np.repeat(np.arange(len(self.starts)), self.lengths)
+            self._ideal_relevancy = self.relevancy[np.lexsort((-self.relevancy, group_ids))]
+        return self._ideal_relevancy
+
+    def no_relevant(self):
+        return self.group_sums(self.relevant.astype(np.float64))
+
+    def average_precisions(self):
+        precisions = self.group_cumsums(self.relevancy) / self.ranks
+        return self.safe_divide(self.group_sums(precisions * self.relevancy), self.group_sums(self.relevancy))
+
+    def ndcgs(self, k=None):
+        in_top_k = self.discounts if k is None else self.discounts * (self.ranks <= k)
+        return self.safe_divide(self.group_sums(self.relevancy * in_top_k), self.group_sums(self.ideal_relevancy * in_top_k))
+
+    def precisions_at_k(self, k):
+        # Queries with less than k passages are still divided by k
+        return self.group_sums((self.relevant & (self.ranks <= k)).astype(np.float64)) / k
+
+    def recalls_at_k(self, k):
+        return self.safe_divide(self.group_sums((self.relevant & (self.ranks <= k)).astype(np.float64)), self.no_relevant())
+
+    def reciprocal_ranks(self):
+        if len(self.starts) == 0:
+            return np.empty(0)
+        return np.maximum.reduceat(np.where(self.relevant, 1 / self.ranks, 0), self.starts)
+
+    def evaluate(self, k=10):
+        # Per-query metrics, one row per qid (sorted)
+        return pd.DataFrame({'ap': self.average_precisions(),
+                             'ndcg': self.ndcgs(),
+                             f'ndcg@{k}': self.ndcgs(k),
+                             f'p@{k}': self.precisions_at_k(k),
+                             f'recall@{k}': self.recalls_at_k(k),
+                             'rr': self.reciprocal_ranks()},
+                            index=pd.Index(self.qids, name='qid'))
+
+
+def evaluate_ranking(data, k=10):
+    # Per-query metrics and their means (MAP, mean NDCG, ..., MRR) of a
+    # ranking with qid, score and relevancy columns
+    per_query = RankedGroups(data['qid'].values, data['score'].values, data['relevancy'].values).evaluate(k)
+    return per_query, per_query.mean()
+
+
+'''
+Scorer of the hyperparameter searches (task3), for GridSearchCV(scoring=...)
+    - the estimator predicts a DataFrame with the qid and score of each row
+      and y_true holds their relevancy; the predictions of a fold are sorted
+      once for both metrics
+    - the keys of the returned dict are the scorer names, refit must name
+      one of them ('mndcg')
+'''
+def ranking_scores(estimator, X, y_true):
+    y_pred = estimator.predict(X)
+    ranked_groups = RankedGroups(y_pred['qid'].values, y_pred['score'].values, np.asarray(y_true))
+    return {'mndcg': ranked_groups.ndcgs().mean(), 'map': ranked_groups.average_precisions().mean()}
+
+
+'''
+Streaming evaluation of run files
+    - the run file (qid, pid, score) is read in chunks and must list the
+      passages of each query contiguously, as the run files written by the
+      rankers do; the last query of a chunk is held back until the next
+      chunk completes it
+    - the relevancy of each row is looked up in a hash index of the
+      (qid, pid) pairs judged relevant, read from the qrels in chunks;
+      passages without a positive judgment are not relevant
+    - memory is bounded by a chunk, the largest query and the relevant
+      judgments, whatever the size of the run or of the qrels
+'''
+RUN_CHUNK_SIZE = 1000000
+
+
+def get_pair_keys(qids, pids):
+    return (np.asarray(qids, dtype=np.int64) << 32) | np.asarray(pids, dtype=np.int64)
+
+
+class RelevanceJudgments:
+    def __init__(self, qids, pids, relevancy):
+        # The last judgment of a pair wins
+        keys = get_pair_keys(qids, pids)[::-1]
+        _, last = np.unique(keys, return_index=True)
+        self.index = pd.Index(keys[last])
+        self.relevancy = np.asarray(relevancy, dtype=np.float64)[::-1][last]
+
+    def __len__(self):
+        return len(self.relevancy)
+
+    def get_relevancy(self, qids, pids):
+        if len(self.relevancy) == 0:
+            return np.zeros(len(qids))
+        positions = self.index.get_indexer(get_pair_keys(qids, pids))
+        return np.where(positions >= 0, self.relevancy[positions], 0.0)
+
+
+def load_relevance_judgments(path, chunk_size=RUN_CHUNK_SIZE, **read_csv_args):
+    # Relevant (qid, pid) pairs of a qrels file with qid, pid and relevancy
+    # columns (validation_data.tsv by default layout), text columns are skipped
+    read_csv_args = {'sep': '\t', **read_csv_args}
+    qids, pids, relevancies = [], [], []
+    for chunk in pd.read_csv(path, chunksize=chunk_size, usecols=['qid', 'pid', 'relevancy'], **read_csv_args):
+        relevancy = chunk['relevancy'].to_numpy(dtype=np.float64)
+        relevant = relevancy > 0
+        qids.append(chunk['qid'].to_numpy(dtype=np.int64)[relevant])
+        pids.append(chunk['pid'].to_numpy(dtype=np.int64)[relevant])
+        relevancies.append(relevancy[relevant])
+    if not qids:
+        return RelevanceJudgments(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+    return RelevanceJudgments(np.concatenate(qids), np.concatenate(pids), np.concatenate(relevancies))
+
+
+def evaluate_run_file(run_path, judgments, k=10, chunk_size=RUN_CHUNK_SIZE, **read_csv_args):
+    # Per-query metrics and their means, as evaluate_ranking, of a run file;
+    # bm25.csv layout (qid,pid,score without header) by default
+    read_csv_args = {'sep': ',', 'header': None, 'names': ['qid', 'pid', 'score'], **read_csv_args}
+    per_query = []
+    evaluated_qids = set()
+    pending = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+
+    def evaluate_queries(qids, pids, scores):
+        if len(qids) == 0:
+            return
+        ranked_groups = RankedGroups(qids, scores, judgments.get_relevancy(qids, pids))
+        no_runs = np.count_nonzero(np.r_[True, qids[1:] != qids[:-1]])
+        if no_runs != len(ranked_groups) or not evaluated_qids.isdisjoint(ranked_groups.qids.tolist()):
+            raise Exception('The passages of each query must be contiguous in the run file!')
+        evaluated_qids.update(ranked_groups.qids.tolist())
+        per_query.append(ranked_groups.evaluate(k))
+
+    for chunk in pd.read_csv(run_path, chunksize=chunk_size, usecols=['qid', 'pid', 'score'], **read_csv_args):
+        qids = np.concatenate((pending[0], chunk['qid'].to_numpy(dtype=np.int64)))
+        pids = np.concatenate((pending[1], chunk['pid'].to_numpy(dtype=np.int64)))
+        scores = np.concatenate((pending[2], chunk['score'].to_numpy(dtype=np.float64)))
+        # Rows of the last query of the chunk may continue in the next one
+        other_rows = np.flatnonzero(qids != qids[-1])
+        last_start = other_rows[-1] + 1 if len(other_rows) else 0
+        evaluate_queries(qids[:last_start], pids[:last_start], scores[:last_start])
+        pending = (qids[last_start:], pids[last_start:], scores[last_start:])
+    evaluate_queries(*pending)
+
+    per_query = pd.concat(per_query) if per_query else RankedGroups([], [], []).evaluate(k)
+    return per_query, per_query.mean()
+
 
 '''
 Average Precision
 '''
 def average_precision(relevancy):
-    n = len(relevancy)
-    avg_precision = 0
-    for k in range(1, n + 1):
-        precision_k = sum(relevancy[:k]) / k
-        avg_precision += (precision_k * relevancy[k - 1])
-    avg_precision = avg_precision / sum(relevancy)
-    return avg_precision
+    relevancy = np.asarray(relevancy, dtype=np.float64)
+    precisions = np.cumsum(relevancy) / np.arange(1, len(relevancy) + 1)
+    return np.sum(precisions * relevancy) / np.sum(relevancy)
 
 def mean_average_precision(data):
-    data_sorted = data.sort_values(by=['qid', 'score'], ascending=[True, False])
-    qids = data_sorted['qid'].unique()
-    average_precisions = []
-    for qid in qids:
-        relevancy = data_sorted[data_sorted['qid'] == qid]['relevancy'].tolist()
-        average_precisions.append(average_precision(relevancy))
-    return np.mean(np.array(average_precisions))
+    return RankedGroups(data['qid'].values, data['score'].values, data['relevancy'].values).average_precisions().mean()
 
 '''
 NDCG
@@ -33,10 +217,4 @@ def ndcg(relevancy):
     return ndcg
 
 def mean_ndcg(data):
-    data_sorted = data.sort_values(by=['qid', 'score'], ascending=[True, False])
-    qids = data_sorted['qid'].unique()
-    ndcgs = []
-    for qid in qids:
-        relevancy = data_sorted[data_sorted['qid'] == qid]['relevancy'].tolist()
-        ndcgs.append(ndcg(relevancy))
-    return np.mean(np.array(ndcgs))
\ No newline at end of file
+    return RankedGroups(data['qid'].values, data['score'].values, data['relevancy'].values).ndcgs().mean()
@@ -1,30 +1,93 @@
-from tqdm import tqdm
+import numpy as np
 import pandas as pd
 
-train_data = pd.read_csv('train_data.tsv', sep='\t')
 
-# Sample subset
-keep = 0.1
-random_state = 14
+'''
+Training set sampling
+    - all relevant passages are kept and, for every query, keep * n of its
+      n non relevant passages are drawn without replacement
+    - the negatives drawn in a query only depend on the number of its
+      negatives and on the seed: they are the rows DataFrame.sample(
+      n=int(n * keep), random_state=random_state) picks in the negatives of
+      the query, so one selection mask is computed per distinct query size
+      and all queries are sampled at once from their in-query positions
+    - the streaming mode reads the training file twice in chunks, first to
+      count the negatives of each query, then to select and write the
+      sampled rows; it gives the same sample as the in-memory mode with
+      memory bounded by a chunk and the number of queries
+    - sampled rows keep the order of the training file
+'''
+def get_selection_mask(group_size, keep, random_state):
+    # Positions picked by DataFrame.sample in a group of group_size rows
+    mask = np.zeros(group_size, dtype=bool)
+    mask[np.random.RandomState(random_state).permutation(group_size)[:int(group_size * keep)]] = True
+    return mask
 
-# Keep all relevant documents
-train_data_sample = train_data[train_data['relevancy'] == 1]
 
-# Get all non relevant entries
-train_data_non_relevant = train_data[train_data['relevancy'] == 0]
-# Get all query ids with non relevant entries
-qids = train_data_non_relevant['qid'].unique().tolist()
-# Compute weight for each query
-num_entries_per_query = train_data_non_relevant.groupby(by='qid').size()
+def select_negatives(group_sizes, positions, keep, random_state):
+    # group_sizes: number of negatives of the query of each negative row,
+    # positions: position of the row among the negatives of its query
+    sizes, size_ids = np.unique(group_sizes, return_inverse=True)
+    if len(sizes) == 0:
+        return np.zeros(0, dtype=bool)
+    masks = np.concatenate([get_selection_mask(size, keep, random_state) for size in sizes.tolist()])
+    mask_offsets = np.r_[0, np.cumsum(sizes)[:-1]]
+    return masks[mask_offsets[size_ids] + positions]
 
-for qid in tqdm(qids):
-    num_select = int(num_entries_per_query[qid] * keep)
-    query_entries = train_data_non_relevant[train_data_non_relevant['qid'] == qid]
-    query_entries_sampled = query_entries.sample(n= num_select, random_state=random_state)
-    train_data_sample = pd.concat([train_data_sample, query_entries_sampled], ignore_index=False)
 
-# Sort sampled data by index
-train_data_sample.sort_index(inplace=True)
+def sample_training_data(train_data, keep=0.1, random_state=14):
+    relevant = (train_data['relevancy'] == 1).to_numpy()
+    non_relevant = (train_data['relevancy'] == 0).to_numpy()
+    negatives = train_data.loc[non_relevant, 'qid']
+    grouped = negatives.groupby(negatives, sort=False)
+    selected = select_negatives(grouped.transform('size').to_numpy(), grouped.cumcount().to_numpy(), keep, random_state)
+    sampled = relevant.copy()
+    sampled[np.flatnonzero(non_relevant)[selected]] = True
+    return train_data[sampled]
 
-# Save sampled data
-train_data_sample.to_csv("train_data_sample.tsv", index=None, sep='\t')
\ No newline at end of file
+
+def count_negatives(filename, chunk_size):
+    # Number of non relevant passages of each query
+    counts = []
+    for chunk in pd.read_csv(filename, sep='\t', usecols=['qid', 'relevancy'], chunksize=chunk_size):
+        counts.append(chunk.loc[chunk['relevancy'] == 0, 'qid'].value_counts())
+    if not counts:
+        return pd.Series(dtype=np.int64)
+    return pd.concat(counts).groupby(level=0).sum()
+
+
+def sample_training_file(filename, output_filename, keep=0.1, random_state=14, chunk_size=1000000):
+    # Streaming version of sample_training_data, from file to file
+    negatives_counts = count_negatives(filename, chunk_size)
+    group_sizes = negatives_counts.to_numpy()
+    # Negatives of each query read so far
+    seen = np.zeros(len(negatives_counts), dtype=np.int64)
+    header = True
+    for chunk in pd.read_csv(filename, sep='\t', chunksize=chunk_size):
+        relevant = (chunk['relevancy'] == 1).to_numpy()
+        non_relevant = (chunk['relevancy'] == 0).to_numpy()
+        negatives = chunk.loc[non_relevant, 'qid']
+        groups = negatives_counts.index.get_indexer(negatives)
+        positions = seen[groups] + negatives.groupby(negatives, sort=False).cumcount().to_numpy()
+        seen += np.bincount(groups, minlength=len(seen))
+        sampled = relevant.copy()
+        sampled[np.flatnonzero(non_relevant)[select_negatives(group_sizes[groups], positions, keep, random_state)]] = True
+        chunk[sampled].to_csv(output_filename, index=None, sep='\t', mode='w' if header else 'a', header=header)
+        header = False
+
+
+if __name__ == '__main__':
+    # Sample subset
+    keep = 0.1
+    random_state = 14
+
+    # Stream the training file instead of loading it when it does not fit in memory
+    streaming = False
+    if streaming:
+        sample_training_file('train_data.tsv', 'train_data_sample.tsv', keep, random_state)
+    else:
+        train_data = pd.read_csv('train_data.tsv', sep='\t')
+        train_data_sample = sample_training_data(train_data, keep, random_state)
+
+        # Save sampled data
+        train_data_sample.to_csv("train_data_sample.tsv", index=None, sep='\t')
@@ -4,11 +4,17 @@ from icu_tokenizer import Tokenizer, Normalizer
 from string import punctuation
 from unidecode import unidecode
 import re
+import os
+import sys
 from tqdm.auto import tqdm
 import numpy as np
 import pandas as pd
 from spacy.lang.en import stop_words
 
+# Stage timings are shared with Phase1
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Phase1'))
+from instrumentation import stage, count, print_report, save_report
+
 
 embedding_vector_size = 100
 normalizer = Normalizer(lang='en', norm_puncts=True)
@@ -51,6 +57,7 @@ def covert_data_to_np(data, labels=True):
     num_samples = data.shape[0]
     X = []
     data_list = data.values.tolist()
+    count('embedded pairs', len(data_list))
     for row in tqdm(data_list):
         query = row[2]
         passage = row[3]
@@ -70,24 +77,31 @@ def covert_data_to_np(data, labels=True):
 if __name__ == '__main__':
     # Get embeddings representation for the training data
     print('Computing embeddings for training data...')
-    data = pd.read_csv('train_data_sample.tsv', sep='\t')
-    embeddings_data = covert_data_to_np(data)
-    with open(f'T2_train_data_no_stopwords_{embedding_vector_size}.npy', 'wb') as f:
-        np.save(f, embeddings_data)
+    with stage('training embeddings'):
+        data = pd.read_csv('train_data_sample.tsv', sep='\t')
+        embeddings_data = covert_data_to_np(data)
+        with open(f'T2_train_data_no_stopwords_{embedding_vector_size}.npy', 'wb') as f:
+            np.save(f, embeddings_data)
     print('Done!\n')
 
     # Get embeddings representation for the validation data
     print('Computing embeddings for validation data...')
-    data = pd.read_csv('validation_data.tsv', sep='\t')
-    embeddings_data = covert_data_to_np(data)
-    with open(f'T2_validation_data_no_stopwords_{embedding_vector_size}.npy', 'wb') as f:
-        np.save(f, embeddings_data)
+    with stage('validation embeddings'):
+        data = pd.read_csv('validation_data.tsv', sep='\t')
+        embeddings_data = covert_data_to_np(data)
+        with open(f'T2_validation_data_no_stopwords_{embedding_vector_size}.npy', 'wb') as f:
+            np.save(f, embeddings_data)
     print('Done!\n')
 
     # Get embeddings representation for the test data
     print('Computing embeddings for test data...')
-    data = pd.read_csv('candidate_passages_top1000.tsv', sep='\t', header=None)
-    test_embeddings_data = covert_data_to_np(data, labels=False)
-    with open(f'T2_test_data_no_stopwords_{embedding_vector_size}.npy', 'wb') as f:
-        np.save(f, test_embeddings_data)
-    print('Done!')
\ No newline at end of file
+    with stage('test embeddings'):
+        data = pd.read_csv('candidate_passages_top1000.tsv', sep='\t', header=None)
+        test_embeddings_data = covert_data_to_np(data, labels=False)
+        with open(f'T2_test_data_no_stopwords_{embedding_vector_size}.npy', 'wb') as f:
+            np.save(f, test_embeddings_data)
+    print('Done!\n')
+
+    # Time and memory of each stage
+    print_report()
+    save_report('task2_data_preparation_metrics.json')
\ No newline at end of file
@@ -1,8 +1,15 @@
-import pandas as pd
 import numpy as np
 from tqdm.auto import tqdm
 import matplotlib.pyplot as plt
 from task1_metrics import mean_average_precision, mean_ndcg
+import os
+import sys
+
+# Ranking kernel is shared with Phase1
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Phase1'))
+from topk import top_k_by_qid
+from dataset_cache import load_dataset
+from instrumentation import stage, print_report, save_report
 
 
 def plot_multiple_train_loss(train_loss, title, y_label, plot_labels, file_name=None):
@@ -21,14 +28,14 @@ def plot_multiple_train_loss(train_loss, title, y_label, plot_labels, file_name=
 
 
 def save_output_file(candidate_passages, scores, alg):
-    candidate_passages.rename(columns={0: 'qid', 1: 'pid', 2: 'query', 3: 'passage'}, inplace=True)
+    # candidate_passages has the qid and pid of each scored candidate
     candidate_passages['score'] = scores
-    candidate_passages.sort_values(by=['qid', 'score'], ascending=[True, False], inplace=True)
-    candidate_passages.drop(columns=['query', 'passage'], inplace=True)
+    # Get 100 most relevant passages for each query
+    indices, ranks = top_k_by_qid(candidate_passages['qid'].values, candidate_passages['score'].values, 100)
+    candidate_passages = candidate_passages.iloc[indices].copy()
+    candidate_passages['rank'] = ranks
     candidate_passages['A2'] = 'A2'
     candidate_passages['alg'] = alg
-    candidate_passages['rank'] = candidate_passages.groupby('qid')['score'].rank(method='first', ascending=False).astype('int')
-    candidate_passages = candidate_passages[candidate_passages['rank'] <= 100]
     col_order = ['qid', 'A2', 'pid', 'rank', 'score', 'alg']
     candidate_passages = candidate_passages[col_order]
     candidate_passages.to_csv(f'{alg}.txt', header=None, index=None, sep=' ')
@@ -109,7 +116,8 @@ if __name__ == '__main__':
     for lr in lrs:
         print(f'Training Logistic Regression model with lr = {lr}...')
         log_reg = LogisticRegression(n_iters=n_iters, lr=lr)
-        losses = log_reg.fit(X_train, y_train)
+        with stage(f'train lr={lr}'):
+            losses = log_reg.fit(X_train, y_train)
         all_losses[lr] = losses
         all_models[lr] = log_reg
         print('Done!\n')
@@ -125,7 +133,7 @@ if __name__ == '__main__':
     
     print(f'Evaluating the Logistic Regression model with lr = {lrs[0]} on the validation set..')
     # Read validation data
-    validation_data = pd.read_csv('validation_data.tsv', sep='\t')
+    validation_data = load_dataset('validation_data.tsv').to_frame(['qid', 'pid', 'relevancy'])
     with open(validation_data_path, 'rb') as f:
         validation_embeddings_data = np.load(f)
     X_val = validation_embeddings_data[:, :-1]
@@ -133,11 +141,12 @@ if __name__ == '__main__':
 
     # Evaluate model on validation set
     model = all_models[lrs[0]]
-    y_val_pred = model.predict(X_val)
-    log_reg_val_data = validation_data[['qid', 'pid', 'relevancy']].astype({'relevancy': 'int32'})
-    log_reg_val_data['score'] = y_val_pred
-    map = mean_average_precision(log_reg_val_data)
-    mndcg = mean_ndcg(log_reg_val_data)
+    with stage('validation'):
+        y_val_pred = model.predict(X_val)
+        log_reg_val_data = validation_data[['qid', 'pid', 'relevancy']].astype({'relevancy': 'int32'})
+        log_reg_val_data['score'] = y_val_pred
+        map = mean_average_precision(log_reg_val_data)
+        mndcg = mean_ndcg(log_reg_val_data)
 
     # Print performance
     print('Performance of the Logistic Regression model on the validation set')
@@ -146,9 +155,14 @@ if __name__ == '__main__':
 
     # Predict on test data
     print('Predicting on test set...')
-    test_data = pd.read_csv('candidate_passages_top1000.tsv', sep='\t', header=None)
+    test_data = load_dataset('candidate_passages_top1000.tsv', header=None, names=['qid', 'pid', 'query', 'passage']).to_frame(['qid', 'pid'])
     with open(test_data_path, 'rb') as f:
         test_embeddings_data = np.load(f)
-    test_scores = model.predict(test_embeddings_data)
-    save_output_file(test_data, test_scores, 'LR')
-    print('Done!')
\ No newline at end of file
+    with stage('test prediction'):
+        test_scores = model.predict(test_embeddings_data)
+        save_output_file(test_data, test_scores, 'LR')
+    print('Done!\n')
+
+    # Time and memory of each stage
+    print_report()
+    save_report('task2_model_fit_eval_metrics.json')
\ No newline at end of file
@@ -1,10 +1,17 @@
 import numpy as np
 import pandas as pd
-from task1_metrics import mean_average_precision, mean_ndcg
+from task1_metrics import mean_average_precision, mean_ndcg, ranking_scores
+import os
+import sys
+
+# Ranking kernel is shared with Phase1
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Phase1'))
+from topk import top_k_by_qid
+from dataset_cache import load_dataset
+from instrumentation import stage, print_report, save_report
 import xgboost as xgb
 from sklearn.model_selection import StratifiedGroupKFold
 from sklearn.base import BaseEstimator
-from sklearn.metrics import make_scorer
 from sklearn.model_selection import GridSearchCV
 
 
@@ -23,11 +30,12 @@ def prepare_data_for_lambdamart(feature_file,
         df = pd.DataFrame(data=data_train)
     if has_labels:
         df.rename(columns={label_column: 'relevancy'}, inplace=True)
+    # Only the qid column of the original file is read
     if has_header:
-        original_data = pd.read_csv(original_file, sep='\t')
+        original_data = load_dataset(original_file)
     else:
-        original_data = pd.read_csv(original_file, sep='\t', header=None, names=['qid', 'pid', 'query', 'passage'])
-    df['qid'] = original_data['qid']
+        original_data = load_dataset(original_file, header=None, names=['qid', 'pid', 'query', 'passage'])
+    df['qid'] = np.asarray(original_data.qids)
     df.sort_values(by='qid', inplace=True)
     if has_labels:
         y_train = df['relevancy']
@@ -73,21 +81,6 @@ class XGBRankerWrapper(BaseEstimator):
         return pd.DataFrame(data=list(zip(qids, scores)), columns=['qid', 'score'])
 
 
-# Score functions that use the metrics defined in Task 1
-def mean_ndcg_score(y_true, y_pred):
-    df = y_pred.copy()
-    df['relevancy'] = y_true.values
-    score = mean_ndcg(df)
-    return score
-
-
-def mean_ap_score(y_true, y_pred):
-    df = y_pred.copy()
-    df['relevancy'] = y_true.values
-    score = mean_average_precision(df)
-    return score
-
-
 # # Task 3
 
 # ## Read training and validation data
@@ -108,10 +101,7 @@ param_grid = {
     'lambda_': [0.1, 1, 10]
 }
 # Scorers
-scoring = {
-    'mndcg': make_scorer(mean_ndcg_score, greater_is_better=True),
-    'map': make_scorer(mean_ap_score, greater_is_better=True)
-}
+scoring = ranking_scores
 
 # Stratified Group 3-fold 
 groups = X_train['qid'].values
@@ -132,22 +122,24 @@ grid_search_cv = GridSearchCV(
 )
 
 # Do grid search cross validation
-grid_search_cv.fit(X_train, y_train)
+with stage('grid search'):
+    grid_search_cv.fit(X_train, y_train)
 
 
 # # Validate best model
 best_estimator = grid_search_cv.best_estimator_
-val_results = best_estimator.predict(X_val)
-val_results['relevancy'] = y_val.values
-mndcg = mean_ndcg(val_results)
-map = mean_average_precision(val_results)
+with stage('validation'):
+    val_results = best_estimator.predict(X_val)
+    val_results['relevancy'] = y_val.values
+    mndcg = mean_ndcg(val_results)
+    map = mean_average_precision(val_results)
 print(f'Performance on validation set of XGBRanker with best parameters {grid_search_cv.best_params_}:')
 print(f'Mean NBCG: {mndcg}')
 print(f'Mean Average Precision: {map}')
 
 
 # Prepare test data
-test_data = pd.read_csv('candidate_passages_top1000.tsv', sep='\t', header=None, names=['qid', 'pid', 'query', 'passage'])
+test_data = load_dataset('candidate_passages_top1000.tsv', header=None, names=['qid', 'pid', 'query', 'passage']).to_frame(['qid', 'pid'])
 test_features = np.load('T2_test_data_no_stopwords_100.npy')
 test_features_df = pd.DataFrame(data=test_features)
 test_features_df['qid'] = test_data['qid'].values
@@ -157,16 +149,22 @@ X_test = test_features_df.drop(columns=['pid'])
 
 
 # Predict on test set
-test_results = best_estimator.predict(X_test)
+with stage('test prediction'):
+    test_results = best_estimator.predict(X_test)
 test_results['pid'] = test_features_df['pid'].values
 
 
 # Save results
-test_results.sort_values(by=['qid', 'score'], ascending=[True, False], inplace=True)
-test_results['rank'] = test_results.groupby('qid')['score'].rank(method='first', ascending=False).astype('int')
-test_results['A2'] = 'A2'
-test_results['alg'] = 'LM'
-test_results_top_100 = test_results[test_results['rank'] <= 100]
+indices, ranks = top_k_by_qid(test_results['qid'].values, test_results['score'].values, 100)
+test_results_top_100 = test_results.iloc[indices].copy()
+test_results_top_100['rank'] = ranks
+test_results_top_100['A2'] = 'A2'
+test_results_top_100['alg'] = 'LM'
 col_order = ['qid', 'A2', 'pid', 'rank', 'score', 'alg']
 test_results_top_100 = test_results_top_100[col_order]
 test_results_top_100.to_csv('LM.txt', header=None, index=None, sep=' ')
+
+
+# Time and memory of each stage
+print_report()
+save_report('task3_metrics.json')
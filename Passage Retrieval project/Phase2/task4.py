@@ -2,8 +2,15 @@ import numpy as np
 from tensorflow.keras.layers import Input, LSTM, Dense, Concatenate, Reshape
 from tensorflow.keras.models import Model, Sequential
 import keras
-import pandas as pd
-from task1_metrics import mean_average_precision, mean_ndcg
+from task1_metrics import RankedGroups, mean_average_precision, mean_ndcg
+import os
+import sys
+
+# Ranking kernel is shared with Phase1
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Phase1'))
+from topk import top_k_by_qid
+from dataset_cache import load_dataset
+from instrumentation import stage, print_report, save_report
 import optuna
 
 
@@ -21,7 +28,7 @@ X_validation = validation_embeddings_data[:, :-1]
 X_query_val = X_validation[:, :100]
 X_passage_val = X_validation[:, 100:]
 y_val = validation_embeddings_data[:, -1]
-val_data = pd.read_csv(f'validation_data.tsv', sep='\t')
+val_data = load_dataset('validation_data.tsv').to_frame(['qid', 'pid', 'relevancy'])
 
 
 # # Define model
@@ -48,14 +55,16 @@ def objective(trial):
     layer_dims = trial.suggest_categorical('layer_dims', hyperparam_search_space['layer_dims'])
     activation = trial.suggest_categorical('activation', hyperparam_search_space['activation'])
     model = get_NN_model(layer_dims=layer_dims, activation=activation, learning_rate=learning_rate)
-    model.fit(X_train, y_train, epochs=10, batch_size=16, validation_data=(X_validation, y_val), verbose=2)
+    with stage('trial training'):
+        model.fit(X_train, y_train, epochs=10, batch_size=16, validation_data=(X_validation, y_val), verbose=2)
 
     # Evaluate on validation data
-    val_preds = model.predict(X_validation)
-    val_data_eval = val_data[['qid', 'pid', 'relevancy']]
-    val_data_eval['score'] = list(val_preds[:, -1])
-    mndcg_score = mean_ndcg(val_data_eval)
-    map_score = mean_average_precision(val_data_eval)
+    with stage('trial evaluation'):
+        val_preds = model.predict(X_validation)
+        # Validation queries are sorted once for both metrics
+        ranked_groups = RankedGroups(val_data['qid'].values, val_preds[:, -1], val_data['relevancy'].values)
+        mndcg_score = ranked_groups.ndcgs().mean()
+        map_score = ranked_groups.average_precisions().mean()
     return mndcg_score, map_score
 
 
@@ -66,7 +75,8 @@ hyperparam_search_space = {
 }
 hyperparam_sampler = optuna.samplers.GridSampler(hyperparam_search_space)
 study = optuna.create_study(study_name='NN hyperparameter tuning', directions=['maximize', 'maximize'], sampler=hyperparam_sampler)
-study.optimize(objective, n_jobs=6, n_trials=18)
+with stage('hyperparameter search'):
+    study.optimize(objective, n_jobs=6, n_trials=18)
 
 
 # ## Hyperparameter tuning results
@@ -90,7 +100,8 @@ print(f'The scores for this configuration are: {trial_with_highest_map.values[0]
 
 # # Retrain model with best parameters
 model = get_NN_model(**trial_with_highest_ndcg.params)
-model.fit(X_train, y_train, epochs=10, batch_size=16, validation_data=(X_validation, y_val), verbose=2)
+with stage('training'):
+    model.fit(X_train, y_train, epochs=10, batch_size=16, validation_data=(X_validation, y_val), verbose=2)
 
 
 # # Evaluate on validation
@@ -107,22 +118,26 @@ print(f'Mean Average Precision: {map}')
 # # Save results on test set
 
 # ## Predict on test set
-test_data = pd.read_csv('candidate_passages_top1000.tsv', sep='\t', header=None, names=['qid', 'pid', 'query', 'passage'])
+test_data = load_dataset('candidate_passages_top1000.tsv', header=None, names=['qid', 'pid', 'query', 'passage']).to_frame(['qid', 'pid'])
 X_test = np.load('T2_test_data_no_stopwords_100.npy')
 X_query_test = X_test[:, :100]
 X_passage_test = X_test[:, 100:]
-test_preds = model.predict(X_test)
+with stage('test prediction'):
+    test_preds = model.predict(X_test)
 test_data['score'] = list(test_preds[:, -1])
-test_data.drop(columns=['query', 'passage'], inplace=True)
 
 
 # ## Save results
-test_data.sort_values(by=['qid', 'score'], ascending=[True, False], inplace=True)
-test_data['rank'] = test_data.groupby('qid')['score'].rank(method='first', ascending=False).astype('int')
-test_data['A2'] = 'A2'
-test_data['alg'] = 'NN'
-test_results_top_100 = test_data[test_data['rank'] <= 100]
+indices, ranks = top_k_by_qid(test_data['qid'].values, test_data['score'].values, 100)
+test_results_top_100 = test_data.iloc[indices].copy()
+test_results_top_100['rank'] = ranks
+test_results_top_100['A2'] = 'A2'
+test_results_top_100['alg'] = 'NN'
 col_order = ['qid', 'A2', 'pid', 'rank', 'score', 'alg']
 test_results_top_100 = test_results_top_100[col_order]
 test_results_top_100.to_csv('NN.txt', header=None, index=None, sep=' ')
 
+
+# Time and memory of each stage
+print_report()
+save_report('task4_metrics.json')
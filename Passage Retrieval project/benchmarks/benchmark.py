@@ -0,0 +1,220 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from functools import partial
+import numpy as np
+import pandas as pd
+
+# Benchmarked code lives in Phase1 (index, scorers) and Phase2 (metrics)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Phase1'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Phase2'))
+import task1
+from token_cache import TokenCache, TermCache
+from index_builder import read_passage_blocks, build_inverted_index
+from inverted_index import InvertedIndex, open_inverted_index
+from scoring import TfIdfEngine, BM25Engine, QueryLikelihoodEngine, get_queries_term_frequencies
+from retrieval import MaxScoreRetriever, BM25Model
+from task1_metrics import mean_average_precision, mean_ndcg
+from synthetic_corpus import generate_corpus
+
+
+'''
+Benchmark suite
+    - a synthetic collection of the chosen scale is generated (see
+      synthetic_corpus.py) and every stage runs on it: tokenization, index
+      build and load, the candidate scorers (BM25, TF-IDF, the three query
+      likelihood models), full-collection BM25 and the evaluation metrics
+    - each benchmark reports its throughput (items per second), the p50, p95
+      and p99 latency of one item and the peak RSS of the process while it
+      ran (the high-water mark is reset before each benchmark where Linux
+      allows it); benchmarks starting a process pool also report the peak
+      RSS of the children, the largest of all children waited for so far
+      (it can not be reset, so it is cumulative over the run)
+    - reports are saved as JSON, compare_reports prints the speedups of a
+      report against a baseline
+'''
+SCALES = {'small': {'no_passages': 10000, 'no_queries': 50, 'candidates_per_query': 1000},
+          'medium': {'no_passages': 100000, 'no_queries': 200, 'candidates_per_query': 1000},
+          'large': {'no_passages': 1000000, 'no_queries': 500, 'candidates_per_query': 1000}}
+QUERY_LIKELIHOOD_MODELS = [('laplace', None), ('lidstone', 0.1), ('dirichlet', 50)]
+
+
+def reset_peak_rss():
+    # Resets VmHWM of the process (Linux >= 4.0), ignored elsewhere
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    # Peak resident set size of the process in MB
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_latency_statistics(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)), 'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max())}
+
+
+def run_benchmark(name, function, tasks, no_items=None, starts_pool=False):
+    # Calls function on every task, no_items is the number of items processed
+    # by all tasks when a task handles more than one (e.g. a batch),
+    # starts_pool when the function runs its own process pool
+    gc.collect()
+    reset_peak_rss()
+    latencies = []
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    for task in tasks:
+        task_start_time = time.perf_counter()
+        function(task)
+        latencies.append(time.perf_counter() - task_start_time)
+    total_time = time.perf_counter() - start_time
+    no_items = len(tasks) if no_items is None else no_items
+    result = {'items': no_items, 'tasks': len(tasks), 'seconds': total_time,
+              'cpu_seconds': time.process_time() - start_cpu_time,
+              'throughput': no_items / total_time if total_time > 0 else float('inf'),
+              'latency_ms': get_latency_statistics(latencies),
+              'peak_rss_mb': get_peak_rss()}
+    if starts_pool:
+        result['peak_children_rss_cumulative_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print("%-32s %10.1f items/s   p50 %9.3f ms   p99 %9.3f ms   peak RSS %8.1f MB"
+          % (name, result['throughput'], result['latency_ms']['p50'], result['latency_ms']['p99'], result['peak_rss_mb']))
+    return result
+
+
+def use_fresh_caches(cache_dir, name):
+    # Cold tokenization and term normalization caches
+    cache_path = os.path.join(cache_dir, name + '.sqlite')
+    task1.flush_caches()
+    task1.token_cache = TokenCache(cache_path)
+    task1.term_cache = TermCache(cache_path)
+
+
+def get_queries(paths, candidate_passages_df):
+    queries = pd.read_csv(paths['queries'], sep='\t', header=None, names=['qid', 'query'])
+    query_passage_mapping = candidate_passages_df.groupby('qid')['pid'].apply(list)
+    queries['candidates'] = query_passage_mapping[queries['qid']].values
+    return queries
+
+
+def run_benchmarks(paths, work_dir, remove_stopwords=True, max_workers=4, batch_size=1000, seed=14):
+    results = {}
+    with open(paths['collection']) as f:
+        passages = f.read().splitlines()
+
+    # Tokenization, cold then warm caches
+    use_fresh_caches(work_dir, 'single')
+    sample = passages[:2000]
+    results['get_passage_vocabulary'] = run_benchmark('get_passage_vocabulary', partial(task1.get_passage_vocabulary, remove_stopwords), sample)
+    results['get_passage_vocabulary_cached'] = run_benchmark('get_passage_vocabulary_cached', partial(task1.get_passage_vocabulary, remove_stopwords), sample)
+    use_fresh_caches(work_dir, 'batched')
+    batches = [passages[i:i + batch_size] for i in range(0, len(passages), batch_size)]
+    results['get_passages_vocabularies'] = run_benchmark('get_passages_vocabularies', partial(task1.get_passages_vocabularies, remove_stopwords),
+                                                         batches, no_items=len(passages))
+
+    # Index build from the candidates file, with cold caches, and index load
+    use_fresh_caches(work_dir, 'build')
+    index_path = os.path.join(work_dir, 'inverted_index')
+    def build(_):
+        passages_blocks = read_passage_blocks(paths['candidates'], block_size=10000, header=None, names=['qid', 'pid', 'query', 'passage'])
+        build_inverted_index(passages_blocks, index_path, remove_stopwords, memory_budget=256, max_workers=max_workers, batch_size=batch_size)
+    candidate_passages_df = pd.read_csv(paths['candidates'], sep='\t', header=None, names=['qid', 'pid', 'query', 'passage'])
+    results['index_build'] = run_benchmark('index_build', build, [None], no_items=candidate_passages_df['pid'].nunique(), starts_pool=True)
+    results['index_load'] = run_benchmark('index_load', InvertedIndex, [index_path] * 20)
+    inverted_index = open_inverted_index(index_path)
+
+    # Candidate scorers, queries are tokenized once
+    queries = get_queries(paths, candidate_passages_df)
+    queries_text = queries['query'].tolist()
+    candidates = queries['candidates'].tolist()
+    results['query_tokenization'] = run_benchmark('query_tokenization', lambda query: get_queries_term_frequencies(remove_stopwords, [query]), queries_text)
+    queries_term_frequency = get_queries_term_frequencies(remove_stopwords, queries_text)
+    tasks = list(zip(queries_term_frequency, candidates))
+
+    bm25_engine = BM25Engine(inverted_index, k1=1.2, k2=100, b=0.75)
+    results['bm25'] = run_benchmark('bm25', lambda task: bm25_engine.score(*task), tasks)
+    tf_idf_engines = []
+    results['tfidf_engine_build'] = run_benchmark('tfidf_engine_build', lambda _: tf_idf_engines.append(TfIdfEngine(inverted_index)), [None])
+    results['tfidf'] = run_benchmark('tfidf', lambda task: tf_idf_engines[0].score([task[0]], [task[1]]), tasks)
+    for smoothing, parameter in QUERY_LIKELIHOOD_MODELS:
+        engine = QueryLikelihoodEngine(inverted_index, [(smoothing, parameter)])
+        results['query_likelihood_' + smoothing] = run_benchmark('query_likelihood_' + smoothing, lambda task: engine.score(*task), tasks)
+    engine = QueryLikelihoodEngine(inverted_index, QUERY_LIKELIHOOD_MODELS)
+    results['query_likelihood_all_models'] = run_benchmark('query_likelihood_all_models', lambda task: engine.score(*task), tasks)
+    retriever = MaxScoreRetriever(inverted_index, BM25Model(inverted_index, k1=1.2, k2=100, b=0.75))
+    results['bm25_full_collection'] = run_benchmark('bm25_full_collection', lambda query_term_frequency: retriever.retrieve(query_term_frequency, k=100),
+                                                    queries_term_frequency)
+
+    # Metrics over a ranking of all candidates, scores are random
+    ranking = pd.read_csv(paths['validation'], sep='\t').drop(columns=['queries', 'passage'])
+    ranking['score'] = np.random.default_rng(seed).random(len(ranking))
+    no_queries = ranking['qid'].nunique()
+    results['mean_average_precision'] = run_benchmark('mean_average_precision', mean_average_precision, [ranking] * 3, no_items=3 * no_queries)
+    results['mean_ndcg'] = run_benchmark('mean_ndcg', mean_ndcg, [ranking] * 3, no_items=3 * no_queries)
+    return results
+
+
+def get_environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+
+def compare_reports(baseline_path, report_path):
+    # Throughput speedup and p95 latency ratio of each benchmark of both reports
+    with open(baseline_path) as f:
+        baseline = json.load(f)['benchmarks']
+    with open(report_path) as f:
+        report = json.load(f)['benchmarks']
+    print("%-32s %10s %10s" % ('benchmark', 'speedup', 'p95 ratio'))
+    for name in baseline:
+        if name in report:
+            print("%-32s %9.2fx %9.2fx" % (name, report[name]['throughput'] / baseline[name]['throughput'],
+                                           report[name]['latency_ms']['p95'] / baseline[name]['latency_ms']['p95']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the retrieval pipeline on a synthetic collection')
+    parser.add_argument('--scale', choices=list(SCALES), default='small')
+    parser.add_argument('--output', default=None, help='JSON report path, benchmark_<scale>_<time>.json by default')
+    parser.add_argument('--compare', default=None, help='baseline JSON report to compare the new report with')
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=14)
+    args = parser.parse_args()
+
+    config = dict(SCALES[args.scale], seed=args.seed)
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        start_time = time.time()
+        paths = generate_corpus(os.path.join(work_dir, 'collection'), **config)
+        print("Synthetic %s collection generated in %s seconds" % (args.scale, time.time() - start_time))
+        benchmarks = run_benchmarks(paths, work_dir, max_workers=args.max_workers, seed=args.seed)
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {'scale': args.scale, 'config': config, 'environment': get_environment(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'benchmarks': benchmarks}
+    output = args.output or 'benchmark_%s_%s.json' % (args.scale, time.strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print("Report saved in %s" % (output))
+    if args.compare:
+        compare_reports(args.compare, output)
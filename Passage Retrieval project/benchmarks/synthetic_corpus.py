@@ -0,0 +1,134 @@
+import csv
+import os
+import numpy as np
+import pandas as pd
+
+
+'''
+Synthetic MS MARCO-shaped collections
+    - terms are drawn from a finite Zipfian distribution, p(rank r) ~ 1 / r^s;
+      the most frequent ranks are common English stopwords, the others
+      pronounceable pseudo-words, so tokenization, stopword removal and
+      stemming do real work
+    - passage and query lengths are Poisson distributed around the MS MARCO
+      averages (about 56 and 6 words)
+    - every query is written from one source passage (most query terms are
+      drawn from it) and its candidates are the source passage, passages
+      sharing its rarest term and random passages, up to
+      candidates_per_query; the source passage is the only relevant one
+    - files follow the coursework layouts:
+        passage-collection.txt          one passage per line
+        candidate-passages-top1000.tsv  qid, pid, query, passage (no header)
+        test-queries.tsv                qid, query (no header)
+        validation_data.tsv             qid, pid, queries, passage, relevancy (header)
+'''
+STOPWORDS = ['the', 'of', 'and', 'to', 'a', 'in', 'is', 'for', 'that', 'it', 'as', 'was', 'with', 'be',
+             'by', 'on', 'not', 'he', 'this', 'are', 'or', 'his', 'from', 'at', 'which', 'but', 'have',
+             'an', 'had', 'they', 'you', 'were', 'their', 'one', 'all', 'we', 'can', 'her', 'has', 'there']
+CONSONANTS = 'bcdfghklmnprstvz'
+VOWELS = 'aeiou'
+
+
+def get_pseudo_word(rank, rng):
+    # Two to four consonant-vowel syllables, suffixed to inflect some of them
+    no_syllables = rng.integers(2, 5)
+    consonants = rng.integers(len(CONSONANTS), size=no_syllables).tolist()
+    vowels = rng.integers(len(VOWELS), size=no_syllables).tolist()
+    word = ''.join(CONSONANTS[c] + VOWELS[v] for c, v in zip(consonants, vowels))
+    return word + ['', '', '', 's', 'ing', 'ed'][rank % 6]
+
+
+def get_vocabulary(vocabulary_size, rng):
+    words = list(STOPWORDS[:vocabulary_size])
+    seen = set(words)
+    while len(words) < vocabulary_size:
+        word = get_pseudo_word(len(words), rng)
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return np.array(words)
+
+
+def get_zipf_probabilities(vocabulary_size, exponent):
+    weights = 1 / np.arange(1, vocabulary_size + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_passages(no_passages, vocabulary, probabilities, mean_length, rng):
+    lengths = np.maximum(rng.poisson(mean_length, no_passages), 1)
+    term_ranks = rng.choice(len(vocabulary), size=int(lengths.sum()), p=probabilities)
+    passages_terms = np.split(term_ranks, np.cumsum(lengths)[:-1])
+    passages = []
+    for terms in passages_terms:
+        words = vocabulary[terms].tolist()
+        words[0] = words[0].capitalize()
+        passages.append(' '.join(words) + '.')
+    return passages, passages_terms
+
+
+def generate_queries(no_queries, vocabulary, probabilities, passages_terms, mean_length, rng):
+    # (source passage, query text) pairs, queries sample their source passage
+    # and the collection distribution for the rest of their terms
+    sources = rng.choice(len(passages_terms), size=no_queries, replace=False)
+    lengths = np.maximum(rng.poisson(mean_length, no_queries), 1)
+    queries = []
+    for source, length in zip(sources.tolist(), lengths.tolist()):
+        from_source = rng.random(length) < 0.8
+        terms = np.where(from_source,
+                         rng.choice(passages_terms[source], size=length),
+                         rng.choice(len(vocabulary), size=length, p=probabilities))
+        queries.append((source, ' '.join(vocabulary[terms].tolist()) + '?'))
+    return queries
+
+
+def get_candidates(source, passages_terms, term_passages, candidates_per_query, rng):
+    # Source passage, passages with its rarest term, then random passages
+    rarest_term = int(passages_terms[source].max())
+    candidates = [source] + [pid for pid in term_passages[rarest_term] if pid != source]
+    candidates = list(dict.fromkeys(candidates))[:candidates_per_query]
+    if len(candidates) < candidates_per_query:
+        others = rng.permutation(len(passages_terms))
+        chosen = set(candidates)
+        candidates += [pid for pid in others.tolist() if pid not in chosen][:candidates_per_query - len(candidates)]
+    return rng.permutation(candidates).tolist()
+
+
+def generate_corpus(output_dir, no_passages=10000, no_queries=200, candidates_per_query=1000, vocabulary_size=50000,
+                    zipf_exponent=1.1, passage_length=56, query_length=6, seed=14):
+    # Writes the collection files in output_dir and returns their paths
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    vocabulary = get_vocabulary(vocabulary_size, rng)
+    probabilities = get_zipf_probabilities(vocabulary_size, zipf_exponent)
+    passages, passages_terms = generate_passages(no_passages, vocabulary, probabilities, passage_length, rng)
+    queries = generate_queries(min(no_queries, no_passages), vocabulary, probabilities, passages_terms, query_length, rng)
+
+    term_passages = {}
+    for pid, terms in enumerate(passages_terms):
+        for term in np.unique(terms).tolist():
+            term_passages.setdefault(term, []).append(pid)
+
+    # Pids and qids are shuffled ids, as in MS MARCO
+    pids = rng.permutation(10 * no_passages)[:no_passages]
+    qids = rng.permutation(10 * no_queries)[:len(queries)]
+    rows = []
+    for qid, (source, query) in zip(qids.tolist(), queries):
+        for candidate in get_candidates(source, passages_terms, term_passages, min(candidates_per_query, no_passages), rng):
+            rows.append((qid, int(pids[candidate]), query, passages[candidate], float(candidate == source)))
+    candidates_df = pd.DataFrame(rows, columns=['qid', 'pid', 'queries', 'passage', 'relevancy'])
+
+    paths = {'collection': os.path.join(output_dir, 'passage-collection.txt'),
+             'candidates': os.path.join(output_dir, 'candidate-passages-top1000.tsv'),
+             'queries': os.path.join(output_dir, 'test-queries.tsv'),
+             'validation': os.path.join(output_dir, 'validation_data.tsv')}
+    with open(paths['collection'], 'w') as f:
+        f.writelines(passage + '\n' for passage in passages)
+    candidates_df.drop(columns=['relevancy']).to_csv(paths['candidates'], sep='\t', header=False, index=False, quoting=csv.QUOTE_NONE)
+    pd.DataFrame({'qid': qids, 'query': [query for _, query in queries]}).to_csv(paths['queries'], sep='\t', header=False, index=False, quoting=csv.QUOTE_NONE)
+    candidates_df.to_csv(paths['validation'], sep='\t', index=False, quoting=csv.QUOTE_NONE)
+    return paths
+
+
+if __name__ == '__main__':
+    paths = generate_corpus('./synthetic', no_passages=10000, no_queries=200)
+    print("Synthetic collection written to %s" % (', '.join(paths.values())))
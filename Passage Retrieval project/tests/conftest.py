@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# Tested code lives in Phase1, Phase2 and benchmarks (synthetic collections)
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for directory in ('Phase1', 'Phase2', 'benchmarks'):
+    sys.path.insert(0, os.path.join(PROJECT_DIR, directory))
+
+# Tokenization caches of the tests are not shared with the scripts (set
+# before task1 creates its caches, inherited by worker processes)
+os.environ['TOKEN_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='token_cache_'), 'token_cache.sqlite')
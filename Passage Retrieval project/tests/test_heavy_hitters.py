@@ -0,0 +1,46 @@
+from collections import Counter
+import numpy as np
+from heavy_hitters import SpaceSavingSummary
+
+
+'''
+Space-saving summaries must keep the exact total, never underestimate a
+kept term, overestimate by at most min_count and keep every term more
+frequent than min_count; distinct terms are estimated within a few percent
+'''
+def get_chunks(no_chunks=50, chunk_size=2000, no_terms=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    return [Counter('t%d' % term for term in (rng.zipf(1.2, chunk_size) % no_terms).tolist()) for _ in range(no_chunks)]
+
+
+def test_space_saving_bounds():
+    chunks = get_chunks()
+    exact = sum(chunks, Counter())
+    summary = SpaceSavingSummary(capacity=500)
+    for chunk in chunks:
+        summary.update(chunk)
+
+    assert summary.total == sum(exact.values())
+    assert len(summary) <= 500
+    for term, count in summary.most_common():
+        assert exact[term] <= count <= exact[term] + summary.min_count
+    kept = dict(summary.most_common())
+    assert all(term in kept for term, count in exact.items() if count > summary.min_count)
+    assert [term for term, _ in summary.most_common(10)] == [term for term, _ in exact.most_common(10)]
+
+
+def test_exact_below_capacity():
+    chunks = get_chunks(no_chunks=5, no_terms=100)
+    exact = sum(chunks, Counter())
+    summary = SpaceSavingSummary(capacity=1000)
+    for chunk in chunks:
+        summary.update(chunk)
+    assert summary.min_count == 0
+    assert dict(summary.most_common()) == dict(exact)
+
+
+def test_no_distinct_terms():
+    for no_terms in (100, 5000, 200000):
+        summary = SpaceSavingSummary(capacity=10)
+        summary.update(Counter('t%d' % term for term in range(no_terms)))
+        assert abs(summary.no_distinct_terms() - no_terms) <= 0.03 * no_terms
@@ -0,0 +1,198 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+import index_updates
+from index_builder import build_inverted_index
+from index_updates import append_passages, delete_passages, merge_index_segments, recover_index, update_inverted_index
+from inverted_index import SegmentedInvertedIndex, open_inverted_index, close_inverted_index
+from scoring import TfIdfEngine, BM25Engine, QueryLikelihoodEngine, get_queries_term_frequencies
+from synthetic_corpus import generate_corpus
+from task1 import tokenize_passage
+
+
+'''
+Incremental index updates
+    - an index built on a synthetic collection and updated to a new version
+      of it (changed, deleted and added passages) must match an index rebuilt
+      from scratch on the new version: passages, vocabulary, term and
+      collection statistics and the scores of every model on the candidates
+      of the queries, before and after the segments are merged
+    - tombstones, updates made during a merge and recovery of interrupted
+      builds and swaps are checked on small hand-written collections
+'''
+QUERY_LIKELIHOOD_MODELS = [('laplace', None), ('lidstone', 0.1), ('dirichlet', 50)]
+REMOVE_STOPWORDS = True
+MAX_WORKERS = 2
+
+
+def get_updated_collection(passages, no_changed, no_deleted, no_added, rng):
+    # New version of a {pid: passage} collection
+    pids = rng.permutation(sorted(passages))
+    updated = dict(passages)
+    for pid in pids[:no_changed].tolist():
+        updated[pid] = passages[pid] + ' ' + passages[int(rng.choice(pids))]
+    for pid in pids[no_changed:no_changed + no_deleted].tolist():
+        del updated[pid]
+    sources = rng.choice(pids, size=no_added).tolist()
+    for new_pid, source in enumerate(sources, start=max(passages) + 1):
+        updated[new_pid] = passages[source][::-1].capitalize()
+    return updated
+
+
+def get_blocks(passages, block_size=500):
+    passages_info = [[pid, passage] for pid, passage in sorted(passages.items())]
+    return [passages_info[i:i + block_size] for i in range(0, len(passages_info), block_size)]
+
+
+def get_small_collection(no_passages=100):
+    return {pid: 'word%d common term%d' % (pid % 7, pid % 13) for pid in range(no_passages)}
+
+
+def assert_indexes_match(updated_index, rebuilt_index, queries_term_frequency, candidates):
+    assert np.array_equal(np.asarray(updated_index.doc_pids), np.asarray(rebuilt_index.doc_pids))
+    assert updated_index.terms == rebuilt_index.terms
+    assert np.array_equal(updated_index.dfs(), rebuilt_index.dfs())
+    assert np.array_equal(np.asarray(updated_index.cfs), np.asarray(rebuilt_index.cfs))
+    assert np.array_equal(np.asarray(updated_index.doc_lengths), np.asarray(rebuilt_index.doc_lengths))
+    assert np.isclose(updated_index.avg_dl, rebuilt_index.avg_dl)
+    engines = [(BM25Engine(updated_index), BM25Engine(rebuilt_index)),
+               (QueryLikelihoodEngine(updated_index, QUERY_LIKELIHOOD_MODELS),
+                QueryLikelihoodEngine(rebuilt_index, QUERY_LIKELIHOOD_MODELS))]
+    for updated_engine, rebuilt_engine in engines:
+        for query_term_frequency, query_candidates in zip(queries_term_frequency, candidates):
+            np.testing.assert_allclose(updated_engine.score(query_term_frequency, query_candidates),
+                                       rebuilt_engine.score(query_term_frequency, query_candidates))
+    updated_scores = TfIdfEngine(updated_index).score(queries_term_frequency, candidates)
+    rebuilt_scores = TfIdfEngine(rebuilt_index).score(queries_term_frequency, candidates)
+    for updated, rebuilt in zip(updated_scores, rebuilt_scores):
+        np.testing.assert_allclose(updated, rebuilt)
+
+
+def get_term(word):
+    # Index term of a word, as lemmatized and stemmed by the tokenizer
+    [term] = tokenize_passage(REMOVE_STOPWORDS, word)
+    return term
+
+
+def get_live_pids(index_path):
+    close_inverted_index(index_path)
+    return sorted(np.asarray(open_inverted_index(index_path).doc_pids).tolist())
+
+
+@pytest.fixture(scope='module')
+def updated_collection(tmp_path_factory):
+    work_dir = str(tmp_path_factory.mktemp('index_updates'))
+    rng = np.random.default_rng(14)
+    paths = generate_corpus(os.path.join(work_dir, 'collection'), no_passages=2000, no_queries=20,
+                            candidates_per_query=100, seed=14)
+    with open(paths['collection']) as f:
+        passages = dict(enumerate(f.read().splitlines()))
+    updated_passages = get_updated_collection(passages, no_changed=150, no_deleted=100, no_added=1000, rng=rng)
+
+    updated_path = os.path.join(work_dir, 'updated_index')
+    rebuilt_path = os.path.join(work_dir, 'rebuilt_index')
+    build_inverted_index(get_blocks(passages), updated_path, REMOVE_STOPWORDS, max_workers=MAX_WORKERS)
+    # Segments are only merged by the tests
+    update_inverted_index(get_blocks(updated_passages), updated_path, REMOVE_STOPWORDS, segment_size=300,
+                          max_segments=len(updated_passages), max_workers=MAX_WORKERS)
+    build_inverted_index(get_blocks(updated_passages), rebuilt_path, REMOVE_STOPWORDS, max_workers=MAX_WORKERS)
+
+    # Queries of the synthetic collection ranked against live passages
+    queries = pd.read_csv(paths['queries'], sep='\t', header=None, names=['qid', 'query'])
+    queries_term_frequency = get_queries_term_frequencies(REMOVE_STOPWORDS, queries['query'].tolist())
+    live_pids = np.array(sorted(updated_passages), dtype=np.int64)
+    candidates = [rng.choice(live_pids, size=100, replace=False) for _ in range(len(queries))]
+    return updated_path, rebuilt_path, queries_term_frequency, candidates
+
+
+def test_updated_index_matches_rebuild(updated_collection):
+    updated_path, rebuilt_path, queries_term_frequency, candidates = updated_collection
+    close_inverted_index(updated_path)
+    updated_index = open_inverted_index(updated_path)
+    assert isinstance(updated_index, SegmentedInvertedIndex)
+    assert len(updated_index.segments) > 1
+    assert_indexes_match(updated_index, open_inverted_index(rebuilt_path), queries_term_frequency, candidates)
+
+
+def test_merged_index_matches_rebuild(updated_collection):
+    updated_path, rebuilt_path, queries_term_frequency, candidates = updated_collection
+    assert merge_index_segments(updated_path, REMOVE_STOPWORDS, max_workers=MAX_WORKERS) is not None
+    close_inverted_index(updated_path)
+    merged_index = open_inverted_index(updated_path)
+    assert not isinstance(merged_index, SegmentedInvertedIndex)
+    assert_indexes_match(merged_index, open_inverted_index(rebuilt_path), queries_term_frequency, candidates)
+
+
+def test_tombstones(tmp_path):
+    index_path = str(tmp_path / 'index')
+    passages = get_small_collection()
+    build_inverted_index(get_blocks(passages), index_path, REMOVE_STOPWORDS, max_workers=1)
+    append_passages(index_path, [[5, 'zebra passage']], REMOVE_STOPWORDS, max_workers=1)
+    delete_passages(index_path, [7, 8], REMOVE_STOPWORDS, max_workers=1)
+    assert get_live_pids(index_path) == sorted(set(passages) - {7, 8})
+
+    # The older version of a replaced passage does not count anymore
+    index = open_inverted_index(index_path)
+    docid = index.get_docids([5])
+    assert index.doc_lengths[docid[0]] == 2
+    assert get_term('zebra') in index.terms
+    assert int(index.dfs()[index.terms.index(get_term('word5'))]) == sum(pid % 7 == 5 for pid in passages) - 1
+
+    merge_index_segments(index_path, REMOVE_STOPWORDS, max_workers=1)
+    assert get_live_pids(index_path) == sorted(set(passages) - {7, 8})
+    assert get_term('word5') in open_inverted_index(index_path).terms
+
+
+def test_updates_during_merge_are_kept(tmp_path, monkeypatch):
+    index_path = str(tmp_path / 'index')
+    build_inverted_index(get_blocks(get_small_collection()), index_path, REMOVE_STOPWORDS, max_workers=1)
+    append_passages(index_path, [[100, 'merged passage']], REMOVE_STOPWORDS, max_workers=1)
+
+    # Another writer appends and deletes while the segments are merged
+    merge_segments = index_updates.merge_segments
+    def merge_segments_with_update(*args, **kwargs):
+        append_passages(index_path, [[101, 'concurrent passage']], REMOVE_STOPWORDS, delete_pids=[3], max_workers=1)
+        return merge_segments(*args, **kwargs)
+    monkeypatch.setattr(index_updates, 'merge_segments', merge_segments_with_update)
+    merge_index_segments(index_path, REMOVE_STOPWORDS, max_workers=1)
+
+    pids = get_live_pids(index_path)
+    assert 100 in pids and 101 in pids and 3 not in pids
+    index = open_inverted_index(index_path)
+    assert isinstance(index, SegmentedInvertedIndex)
+    assert get_term('concurrent') in index.terms
+
+
+def test_interrupted_swap_is_recovered(tmp_path):
+    index_path = str(tmp_path / 'index')
+    build_inverted_index(get_blocks(get_small_collection()), index_path, REMOVE_STOPWORDS, max_workers=1)
+    append_passages(index_path, [[100, 'another passage']], REMOVE_STOPWORDS, max_workers=1)
+    expected_pids = get_live_pids(index_path)
+
+    # Crash between the renames: the index is moved away, the merge not yet in place
+    shutil.copytree(index_path, index_path + '_merged')
+    os.rename(index_path, index_path + '_old')
+    recover_index(index_path)
+    assert get_live_pids(index_path) == expected_pids
+    assert not os.path.exists(index_path + '_old') and not os.path.exists(index_path + '_merged')
+
+    merge_index_segments(index_path, REMOVE_STOPWORDS, max_workers=1)
+    assert get_live_pids(index_path) == expected_pids
+
+
+def test_stale_directories_are_ignored(tmp_path):
+    index_path = str(tmp_path / 'index')
+    passages = get_small_collection()
+    # Leftovers of an interrupted build
+    os.makedirs(os.path.join(index_path + '_building', 'stale'))
+    build_inverted_index(get_blocks(passages), index_path, REMOVE_STOPWORDS, max_workers=1)
+    assert not os.path.exists(index_path + '_building')
+
+    # Leftovers of an interrupted merge
+    append_passages(index_path, [[100, 'new passage']], REMOVE_STOPWORDS, max_workers=1)
+    os.makedirs(os.path.join(index_path + '_old', 'stale'))
+    assert merge_index_segments(index_path, REMOVE_STOPWORDS, max_workers=1) is not None
+    assert not os.path.exists(index_path + '_old')
+    assert get_live_pids(index_path) == sorted(set(passages) | {100})
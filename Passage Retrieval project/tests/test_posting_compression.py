@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from posting_compression import BLOCK_SIZE, CompressedPostings, save_compressed_postings
+
+
+'''
+Compressed posting lists must decode to the raw postings they were built
+from: whole lists, docid ranges, term frequency lookups, postings of sets of
+docids and the whole collection, with lists shorter, as long as and longer
+than a block
+'''
+NO_DOCS = 100000
+
+
+@pytest.fixture(scope='module')
+def postings(tmp_path_factory):
+    rng = np.random.default_rng(3)
+    lengths = [0, 1, 2, BLOCK_SIZE - 1, BLOCK_SIZE, BLOCK_SIZE + 1, 3 * BLOCK_SIZE, 0, 5000, 20000]
+    lengths += rng.integers(0, 400, size=50).tolist()
+    docids = [np.sort(rng.choice(NO_DOCS, size=length, replace=False)) for length in lengths]
+    # Mostly small term frequencies, some large ones
+    tfs = [np.where(rng.random(length) < 0.01, rng.integers(1, 5000, size=length), rng.integers(1, 4, size=length))
+           for length in lengths]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    path = tmp_path_factory.mktemp('postings')
+    save_compressed_postings(str(path), offsets, np.concatenate(docids), np.concatenate(tfs))
+    return CompressedPostings(str(path), offsets), docids, tfs
+
+
+def test_postings(postings):
+    compressed, docids, tfs = postings
+    for term_id, (term_docids, term_tfs) in enumerate(zip(docids, tfs)):
+        decoded_docids, decoded_tfs = compressed.postings(term_id)
+        assert np.array_equal(decoded_docids, term_docids)
+        assert np.array_equal(decoded_tfs, term_tfs)
+
+
+def test_postings_ranges(postings):
+    compressed, docids, tfs = postings
+    rng = np.random.default_rng(4)
+    for term_id, (term_docids, term_tfs) in enumerate(zip(docids, tfs)):
+        for lo, hi in [(0, NO_DOCS), (None, 5000), (5000, None), tuple(np.sort(rng.integers(0, NO_DOCS, size=2)).tolist())]:
+            keep = (term_docids >= (lo or 0)) & (term_docids < (hi if hi is not None else NO_DOCS))
+            decoded_docids, decoded_tfs = compressed.postings(term_id, lo, hi)
+            assert np.array_equal(decoded_docids, term_docids[keep])
+            assert np.array_equal(decoded_tfs, term_tfs[keep])
+
+
+def test_get_term_frequencies(postings):
+    compressed, docids, tfs = postings
+    rng = np.random.default_rng(5)
+    for term_id, (term_docids, term_tfs) in enumerate(zip(docids, tfs)):
+        # Docids of the list mixed with other docids
+        lookup = np.unique(np.concatenate((rng.choice(term_docids, size=min(len(term_docids), 50), replace=False),
+                                           rng.integers(0, NO_DOCS, size=50))))
+        expected = dict(zip(term_docids.tolist(), term_tfs.tolist()))
+        assert compressed.get_term_frequencies(term_id, lookup).tolist() == [expected.get(docid, 0) for docid in lookup.tolist()]
+
+
+def test_find_postings(postings):
+    compressed, docids, tfs = postings
+    rng = np.random.default_rng(6)
+    for no_docids in (1, 10, 1000):
+        lookup = np.unique(rng.integers(0, NO_DOCS, size=no_docids))
+        expected = sorted((term_id, int(tf))
+                          for term_id, (term_docids, term_tfs) in enumerate(zip(docids, tfs))
+                          for tf in term_tfs[np.isin(term_docids, lookup)])
+        term_ids, found_tfs = compressed.find_postings(lookup)
+        assert sorted(zip(term_ids.tolist(), found_tfs.tolist())) == expected
+
+
+@pytest.mark.parametrize('chunk_size', [BLOCK_SIZE, 10 * BLOCK_SIZE, 1 << 20])
+def test_all_postings(postings, chunk_size):
+    compressed, docids, tfs = postings
+    all_docids, all_tfs = compressed.all_postings(chunk_size)
+    assert np.array_equal(all_docids, np.concatenate(docids))
+    assert np.array_equal(all_tfs, np.concatenate(tfs))
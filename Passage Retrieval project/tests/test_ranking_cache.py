@@ -0,0 +1,45 @@
+from inverted_index import write_inverted_index, open_inverted_index, close_inverted_index
+from ranking_cache import RankingCache, get_ranking_key
+
+
+'''
+The ranking cache is an LRU keyed on the normalized query and the candidates,
+emptied when the index it is used with changes
+'''
+def write_index(index_path, postings):
+    write_inverted_index(index_path, postings, True, doc_pids=[1, 2, 3])
+    close_inverted_index(index_path)
+    return open_inverted_index(index_path)
+
+
+def test_ranking_keys():
+    key = get_ranking_key('bm25', {'k1': 1.2, 'b': 0.75}, {'a': 1, 'b': 2}, [3, 1, 2], 10)
+    assert key == get_ranking_key('bm25', {'b': 0.75, 'k1': 1.2}, {'b': 2, 'a': 1}, [3, 1, 2], 10)
+    assert key != get_ranking_key('bm25', {'k1': 1.2, 'b': 0.75}, {'a': 1, 'b': 2}, [1, 2, 3], 10)
+    assert key != get_ranking_key('bm25', {'k1': 1.2, 'b': 0.75}, {'a': 1, 'b': 2}, [3, 1, 2], 5)
+    assert get_ranking_key('bm25', {}, {'a': 1}, None, 10)[3] is None
+
+
+def test_least_recently_used_eviction(tmp_path):
+    index = write_index(str(tmp_path / 'index'), {'a': {1: 1}})
+    cache = RankingCache(max_entries=2)
+    cache.put(index, 'first', [1])
+    cache.put(index, 'second', [2])
+    assert cache.get(index, 'first') == [1]
+    cache.put(index, 'third', [3])
+    assert cache.get(index, 'second') is None
+    assert cache.get(index, 'first') == [1] and cache.get(index, 'third') == [3]
+    assert cache.statistics()['hits'] == 3 and cache.statistics()['misses'] == 1
+
+
+def test_invalidated_by_rebuild(tmp_path):
+    index_path = str(tmp_path / 'index')
+    index = write_index(index_path, {'a': {1: 1}})
+    cache = RankingCache()
+    cache.put(index, 'key', [1])
+    assert cache.get(open_inverted_index(index_path), 'key') == [1]
+
+    rebuilt_index = write_index(index_path, {'a': {2: 1}})
+    assert rebuilt_index.version != index.version
+    assert cache.get(rebuilt_index, 'key') is None
+    assert cache.no_invalidations == 1
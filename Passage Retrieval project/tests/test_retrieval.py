@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from math import log
+from inverted_index import write_inverted_index, open_inverted_index
+from retrieval import MaxScoreRetriever, BM25Model, QueryLikelihoodModel
+from scoring import QueryLikelihoodEngine
+from topk import get_ranking
+
+
+'''
+Full-collection retrieval
+    - MaxScore must return the same passages and scores as exhaustive scoring
+      of the whole collection, for every model, k and window size
+    - exhaustive rankings must match get_ranking over the whole pid-sorted
+      collection, scored by the query likelihood engine and by BM25 without
+      relevance information (the BM25 engine uses the candidates as relevance
+      information, R = number of candidates); the query likelihood models are
+      rewritten as sums over the passage terms, so scores only match up to
+      rounding and the order of near-ties is checked separately: equal
+      scores are ranked by pid
+'''
+QUERY_LIKELIHOOD_MODELS = [('laplace', None), ('lidstone', 0.1), ('dirichlet', 50)]
+NO_TERMS = 300
+
+
+@pytest.fixture(scope='module')
+def inverted_index(tmp_path_factory):
+    # Zipfian passages with even pids, so pids and docids differ
+    rng = np.random.default_rng(0)
+    no_passages = 3000
+    postings = {}
+    for pid in range(0, 2 * no_passages, 2):
+        for term in rng.zipf(1.3, rng.integers(0, 60)).tolist():
+            term_postings = postings.setdefault('t%d' % (term % NO_TERMS), {})
+            term_postings[pid] = term_postings.get(pid, 0) + 1
+    index_path = str(tmp_path_factory.mktemp('retrieval') / 'index')
+    write_inverted_index(index_path, postings, True, doc_pids=list(range(0, 2 * no_passages, 2)))
+    return open_inverted_index(index_path)
+
+
+def get_queries(no_queries=20, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(no_queries):
+        query = {}
+        for _ in range(rng.integers(1, 6)):
+            term = int(rng.zipf(1.3)) % NO_TERMS if rng.random() < 0.8 else int(rng.integers(NO_TERMS))
+            query['t%d' % term] = int(rng.integers(1, 3))
+        queries.append(query)
+    # Unknown terms and an empty query
+    return queries + [{'t1': 1, 'unknown': 1}, {}]
+
+
+def get_models(inverted_index):
+    return [BM25Model(inverted_index)] + [QueryLikelihoodModel(inverted_index, smoothing, parameter)
+                                          for smoothing, parameter in QUERY_LIKELIHOOD_MODELS]
+
+
+@pytest.mark.parametrize('window_size', [256, 8192])
+def test_maxscore_matches_exhaustive(inverted_index, window_size):
+    for model in get_models(inverted_index):
+        retriever = MaxScoreRetriever(inverted_index, model, window_size=window_size)
+        for query_term_frequency in get_queries():
+            for k in (1, 10, 100):
+                pids, scores = retriever.retrieve(query_term_frequency, k)
+                exhaustive_pids, exhaustive_scores = retriever.retrieve(query_term_frequency, k, exhaustive=True)
+                assert np.array_equal(pids, exhaustive_pids)
+                assert np.array_equal(scores, exhaustive_scores)
+
+
+def get_bm25_scores(inverted_index, query_term_frequency, k1=1.2, k2=100, b=0.75):
+    # BM25 of every passage with R = ri = 0
+    N = inverted_index.no_passages
+    docids = np.arange(N)
+    K = k1 * ((1 - b) + b * inverted_index.get_doc_lengths(docids) / inverted_index.avg_dl)
+    terms = [term for term in query_term_frequency if inverted_index.df(term) > 0]
+    scores = np.zeros(N)
+    for term, tfs in zip(terms, inverted_index.get_term_frequency_matrix(terms, docids)):
+        qf, ni = query_term_frequency[term], inverted_index.df(term)
+        scores += log((N - ni + 0.5) / (ni + 0.5)) * ((k1 + 1) * tfs / (K + tfs)) * ((k2 + 1) * qf / (k2 + qf))
+    return scores
+
+
+def test_exhaustive_matches_rankings(inverted_index):
+    pids = np.asarray(inverted_index.doc_pids)
+    engine = QueryLikelihoodEngine(inverted_index, QUERY_LIKELIHOOD_MODELS)
+    for query_term_frequency in get_queries(no_queries=5):
+        all_scores = [get_bm25_scores(inverted_index, query_term_frequency)] + list(engine.score(query_term_frequency, pids))
+        for model, scores in zip(get_models(inverted_index), all_scores):
+            top_pids, top_scores = MaxScoreRetriever(inverted_index, model).retrieve(query_term_frequency, 100)
+            ranking = get_ranking(0, pids, scores, 100)
+            np.testing.assert_allclose(top_scores, [score for _, _, score in ranking])
+            np.testing.assert_allclose(scores[np.searchsorted(pids, top_pids)], top_scores)
+            ties = top_scores[1:] == top_scores[:-1]
+            assert np.all(top_pids[1:][ties] > top_pids[:-1][ties])
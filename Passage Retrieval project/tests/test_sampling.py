@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+from task2_3_4_sample_training_dataset import sample_training_data, sample_training_file
+
+
+'''
+Training set sampling must pick the rows of the original per-query loop,
+DataFrame.sample on the negatives of each query, in the in-memory and in the
+streaming mode
+'''
+def get_training_data(no_queries=60, seed=7):
+    # Queries of various sizes, interleaved rows, a query without negatives
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 300, size=no_queries)
+    qids = rng.permutation(np.repeat(rng.choice(10 ** 6, size=no_queries, replace=False), sizes))
+    relevancy = (rng.random(len(qids)) < 0.05).astype(np.int64)
+    train_data = pd.DataFrame({'qid': qids, 'pid': rng.integers(10 ** 7, size=len(qids)),
+                               'relevancy': relevancy, 'feature': rng.random(len(qids))})
+    only_relevant = pd.DataFrame({'qid': [-1, -1], 'pid': [1, 2], 'relevancy': [1, 1], 'feature': [0.5, 0.5]})
+    return pd.concat([train_data, only_relevant], ignore_index=True)
+
+
+def sample_training_data_per_query(train_data, keep, random_state):
+    # Reference: one DataFrame.sample per query
+    train_data_sample = train_data[train_data['relevancy'] == 1]
+    non_relevant = train_data[train_data['relevancy'] == 0]
+    for _, query_entries in non_relevant.groupby('qid', sort=False):
+        query_entries_sampled = query_entries.sample(n=int(len(query_entries) * keep), random_state=random_state)
+        train_data_sample = pd.concat([train_data_sample, query_entries_sampled])
+    return train_data_sample.sort_index()
+
+
+@pytest.mark.parametrize('keep, random_state', [(0.1, 14), (0.5, 0), (1, 3)])
+def test_sample_matches_dataframe_sample(keep, random_state):
+    train_data = get_training_data()
+    pd.testing.assert_frame_equal(sample_training_data(train_data, keep, random_state),
+                                  sample_training_data_per_query(train_data, keep, random_state))
+
+
+@pytest.mark.parametrize('chunk_size', [97, 1000, 10 ** 6])
+def test_streaming_matches_in_memory(tmp_path, chunk_size):
+    train_data = get_training_data()
+    filename, output_filename = str(tmp_path / 'train_data.tsv'), str(tmp_path / 'train_data_sample.tsv')
+    train_data.to_csv(filename, index=None, sep='\t')
+    sample_training_file(filename, output_filename, keep=0.1, random_state=14, chunk_size=chunk_size)
+    pd.testing.assert_frame_equal(pd.read_csv(output_filename, sep='\t'),
+                                  sample_training_data(train_data, 0.1, 14).reset_index(drop=True))
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import pytest
+from task1_metrics import (RankedGroups, average_precision, ndcg, evaluate_ranking, evaluate_run_file, ranking_scores,
+                           load_relevance_judgments)
+
+
+'''
+Groupwise metrics must match the per-query reference definitions computed
+on each query ranked by decreasing score (ties in input order), and the
+streaming evaluation of run files must match the in-memory one; the scorer
+of task3's grid search returns the metrics under the names its refit uses
+'''
+def get_ranking_data(no_queries=30, seed=0):
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 60, size=no_queries)
+    qids = rng.permutation(np.repeat(np.arange(no_queries) * 7, sizes))
+    return pd.DataFrame({'qid': qids,
+                         'pid': np.arange(len(qids)),
+                         'score': rng.integers(0, 20, size=len(qids)).astype(np.float64),
+                         'relevancy': (rng.random(len(qids)) < 0.1).astype(np.float64)})
+
+
+def get_reference_metrics(data, k):
+    # Metrics of each query from its relevancy list, in ranking order
+    metrics = {}
+    for qid, query in data.groupby('qid'):
+        relevancy = query.sort_values('score', ascending=False, kind='stable')['relevancy'].to_numpy()
+        relevant = relevancy > 0
+        if not relevant.any():
+            metrics[qid] = [0.0] * 6
+            continue
+        metrics[qid] = [average_precision(relevancy), ndcg(relevancy), get_ndcg_at_k(relevancy, k),
+                        relevant[:k].sum() / k, relevant[:k].sum() / relevant.sum(), 1 / (np.argmax(relevant) + 1)]
+    return pd.DataFrame.from_dict(metrics, orient='index', columns=['ap', 'ndcg', f'ndcg@{k}', f'p@{k}', f'recall@{k}', 'rr'])
+
+
+def get_ndcg_at_k(relevancy, k):
+    # The ideal ranking is taken over the whole query
+    discounts = 1 / np.log2(np.arange(2, len(relevancy) + 2))
+    return np.sum(relevancy[:k] * discounts[:k]) / np.sum(np.sort(relevancy)[::-1][:k] * discounts[:k])
+
+
+@pytest.mark.parametrize('k', [1, 10])
+def test_ranked_groups_match_reference(k):
+    data = get_ranking_data()
+    per_query, means = evaluate_ranking(data, k)
+    expected = get_reference_metrics(data, k)
+    np.testing.assert_allclose(per_query.to_numpy(), expected.to_numpy())
+    assert per_query.index.tolist() == expected.index.tolist()
+    np.testing.assert_allclose(means.to_numpy(), expected.mean().to_numpy())
+
+
+def test_empty_ranking():
+    assert len(RankedGroups([], [], [])) == 0
+    assert RankedGroups([], [], []).evaluate().empty
+
+
+def test_run_file_matches_in_memory(tmp_path):
+    data = get_ranking_data().sort_values('qid', kind='stable')
+    run_path, qrels_path = str(tmp_path / 'run.csv'), str(tmp_path / 'qrels.tsv')
+    data[['qid', 'pid', 'score']].to_csv(run_path, index=None, header=False)
+    data[['qid', 'pid', 'relevancy']].to_csv(qrels_path, index=None, sep='\t')
+    judgments = load_relevance_judgments(qrels_path, chunk_size=50)
+    per_query, means = evaluate_run_file(run_path, judgments, k=10, chunk_size=37)
+    expected_per_query, expected_means = evaluate_ranking(data, k=10)
+    pd.testing.assert_frame_equal(per_query, expected_per_query)
+    pd.testing.assert_series_equal(means, expected_means)
+
+
+class FeatureRanker:
+    # Scores the rows of each query by a weighted feature, predictions in
+    # the layout of the task3 estimators
+    def __init__(self, weight=1.0):
+        self.weight = weight
+
+    def get_params(self, deep=True):
+        return {'weight': self.weight}
+
+    def set_params(self, **params):
+        self.weight = params.get('weight', self.weight)
+        return self
+
+    def fit(self, X, y=None):
+        return self
+
+    def predict(self, X):
+        return pd.DataFrame({'qid': X['qid'].values, 'score': self.weight * X['feature'].values})
+
+
+def get_training_data():
+    data = get_ranking_data()
+    # The feature ranks relevant passages first
+    data['feature'] = data['relevancy'] + np.random.default_rng(1).random(len(data))
+    return data[['qid', 'feature']], data['relevancy']
+
+
+def test_ranking_scores():
+    X, y = get_training_data()
+    scores = ranking_scores(FeatureRanker(), X, y)
+    expected = evaluate_ranking(pd.DataFrame({'qid': X['qid'], 'score': X['feature'], 'relevancy': y}))[1]
+    # The refit metric of task3's grid search is one of the scorer keys
+    assert set(scores) == {'mndcg', 'map'}
+    assert np.isclose(scores['mndcg'], expected['ndcg']) and np.isclose(scores['map'], expected['ap'])
+    assert np.isclose(ranking_scores(FeatureRanker(), X, y.to_numpy())['map'], expected['ap'])
+
+
+def test_ranking_scores_grid_search():
+    pytest.importorskip('sklearn')
+    from sklearn.base import BaseEstimator
+    from sklearn.model_selection import GridSearchCV, GroupKFold
+
+    class Ranker(FeatureRanker, BaseEstimator):
+        pass
+
+    X, y = get_training_data()
+    grid_search_cv = GridSearchCV(Ranker(), param_grid={'weight': [-1.0, 1.0]}, scoring=ranking_scores, refit='mndcg',
+                                  cv=GroupKFold(n_splits=3).split(X, y, groups=X['qid']))
+    grid_search_cv.fit(X, y)
+    assert grid_search_cv.best_params_ == {'weight': 1.0}
+    assert {'mean_test_mndcg', 'mean_test_map'} <= set(grid_search_cv.cv_results_)
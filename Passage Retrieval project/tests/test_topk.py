@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from topk import top_k, get_ranking, top_k_groups, top_k_by_qid
+
+
+'''
+The top-k kernel must rank as a stable sort by decreasing score: ties by
+position, NaN scores last
+'''
+def sort_reference(scores, k):
+    keys = np.where(np.isnan(scores), -np.inf, scores)
+    return np.argsort(-keys, kind='stable')[:k]
+
+
+@pytest.mark.parametrize('k', [0, 1, 5, 100, 1000, None])
+def test_top_k_matches_stable_sort(k):
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        # Few distinct values, so there are many ties at the k-th score
+        scores = rng.integers(0, 10, size=rng.integers(0, 300)).astype(np.float64)
+        scores[rng.random(len(scores)) < 0.05] = np.nan
+        expected = sort_reference(scores, k if k is not None else len(scores))
+        assert top_k(scores, k).tolist() == expected.tolist()
+
+
+def test_get_ranking():
+    ranking = get_ranking(7, [30, 10, 20, 40], [1.0, 2.0, 1.0, 0.5], k=3)
+    assert ranking == [[7, 10, 2.0], [7, 30, 1.0], [7, 20, 1.0]]
+
+
+def test_top_k_groups():
+    scores = np.array([1.0, 3.0, 2.0, 5.0, 5.0, 0.0])
+    indices, ranks = top_k_groups(scores, np.array([0, 3, 3, 6]), k=2)
+    assert indices.tolist() == [1, 2, 3, 4]
+    assert ranks.tolist() == [1, 2, 1, 2]
+
+
+def test_top_k_by_qid():
+    rng = np.random.default_rng(1)
+    qids = rng.integers(0, 20, size=2000)
+    scores = rng.integers(0, 50, size=2000).astype(np.float64)
+    indices, ranks = top_k_by_qid(qids, scores, k=10)
+    expected = []
+    for qid in np.unique(qids).tolist():
+        rows = np.flatnonzero(qids == qid)
+        expected.extend(rows[sort_reference(scores[rows], 10)].tolist())
+    assert indices.tolist() == expected
+    assert np.all(ranks[qids[indices] == qids[indices[0]]] == np.arange(1, 11))